@@ -352,6 +352,28 @@ CELERY_TASK_ROUTES = (
     ],
 )
 
+# Every task logs how long each of its stages took, see corgi/core/instrumentation.py
+# If enabled, the timings are also saved in Redis, and exposed for Prometheus at /api/metrics
+TASK_METRICS_ENABLED = strtobool(os.getenv("CORGI_TASK_METRICS_ENABLED", "false"))
+
+# Responses from the read-only API views can be cached, see corgi/api/cache.py
+# Tasks which change data invalidate the cached responses for that data, see corgi/core/cache.py
+# Any Django cache backend can be used, by default the Redis instance Celery already uses
+API_CACHE_ENABLED = strtobool(os.getenv("CORGI_API_CACHE_ENABLED", "false"))
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "api": {
+        "BACKEND": os.getenv("CORGI_API_CACHE_BACKEND", "corgi.core.cache.RedisCache"),
+        "LOCATION": os.getenv("CORGI_API_CACHE_LOCATION", CELERY_BROKER_URL),
+        # Cached responses are invalidated when their data changes
+        # This only limits how long responses are kept, in case that fails
+        "TIMEOUT": int(os.getenv("CORGI_API_CACHE_TIMEOUT", str(24 * 60 * 60))),
+        "KEY_PREFIX": "corgi-api",
+    },
+}
+
 
 # Django REST Framework
 # https://www.django-rest-framework.org/
@@ -369,7 +391,7 @@ REST_FRAMEWORK = {
         "rest_framework.renderers.JSONRenderer",
         "rest_framework.renderers.BrowsableAPIRenderer",
     ],
-    "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
+    "DEFAULT_PAGINATION_CLASS": "corgi.api.pagination.EstimatedCountPagination",
     "PAGE_SIZE": 10,
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
     "EXCEPTION_HANDLER": "corgi.api.exception_handlers.exception_handler",
@@ -413,6 +435,9 @@ else:
 BREW_URL = os.getenv("CORGI_BREW_URL")
 BREW_WEB_URL = os.getenv("CORGI_BREW_WEB_URL")
 BREW_DOWNLOAD_ROOT_URL = os.getenv("CORGI_BREW_DOWNLOAD_ROOT_URL")
+# Immutable build data (archives, RPMs, headers) is cached here, set to "" to disable
+BREW_CACHE_DIR = os.getenv("CORGI_BREW_CACHE_DIR", "/tmp/corgi-brew-cache")
+BREW_CACHE_MAX_BYTES = int(os.getenv("CORGI_BREW_CACHE_MAX_BYTES", str(2 * 1024**3)))
 
 CENTOS_URL = os.getenv("CORGI_CENTOS_URL")
 CENTOS_DOWNLOAD_ROOT_URL = os.getenv("CORGI_CENTOS_DOWNLOAD_ROOT_URL")
@@ -446,6 +471,20 @@ APP_STREAMS_LIFE_CYCLE_URL = os.getenv("CORGI_APP_STREAMS_LIFE_CYCLE_URL", "")
 # Manifest hints url
 MANIFEST_HINTS_URL = os.getenv("CORGI_MANIFEST_HINTS_URL")
 
+# Validate manifests against the SPDX schema "always", "off", or for a "sampled" fraction of them
+SPDX_VALIDATION_MODE = os.getenv("CORGI_SPDX_VALIDATION_MODE", "always")
+SPDX_VALIDATION_SAMPLE_RATE = float(os.getenv("CORGI_SPDX_VALIDATION_SAMPLE_RATE", "0.1"))
+
+# Packages and relationships for each component in product manifests can be cached in the "api"
+# cache, and reused by every stream with that component until the component's generation changes
+MANIFEST_CACHE_ENABLED = strtobool(os.getenv("CORGI_MANIFEST_CACHE_ENABLED", "false"))
+# Each process that generates manifests keeps the provided nodes of the root components it's seen
+# most recently, so streams that share them don't look them up again. This bounds the memory used
+# by each process, at roughly a few hundred bytes per provided node
+MANIFEST_COMPONENT_LINKS_MAX_NODES = int(
+    os.getenv("CORGI_MANIFEST_COMPONENT_LINKS_MAX_NODES", "1000000")
+)
+
 LOOKASIDE_CACHE_BASE_URL = os.getenv("CORGI_LOOKASIDE_CACHE_URL")
 
 # Set to False to disable software composition analysis tasks.
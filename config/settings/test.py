@@ -18,3 +18,9 @@ SESSION_COOKIE_SECURE = False
 
 # Report test coverage in templates
 TEMPLATES[0]["OPTIONS"]["debug"] = True  # noqa: F405
+
+# Always fetch Brew data from (recorded or mocked) responses, never a previous run's cache
+BREW_CACHE_DIR = ""
+
+# Every manifest generated in tests must be valid SPDX
+SPDX_VALIDATION_MODE = "always"
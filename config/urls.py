@@ -8,6 +8,7 @@ from corgi.api.views import (
     TokenAuthTestView,
     authentication_status,
     healthy,
+    metrics,
 )
 
 urlpatterns = [
@@ -35,3 +36,6 @@ if running_dev():
 
 if settings.OIDC_AUTH_ENABLED:
     urlpatterns = [path("oidc/", include("mozilla_django_oidc.urls"))] + urlpatterns
+
+if settings.TASK_METRICS_ENABLED or settings.API_CACHE_ENABLED:
+    urlpatterns = [path("api/metrics", metrics)] + urlpatterns
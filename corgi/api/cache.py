@@ -0,0 +1,114 @@
+"""
+Cache responses from read-only API views, until the data they depend on changes.
+
+Views decorated with cache_response() say which scopes each request depends on. The cache key
+has the request's URL, with its query parameters in a normal order, and the current generation
+of each scope, so responses are invalidated precisely when some task bumps those generations.
+See corgi/core/cache.py for details. Hits and misses for each view are counted in the cache,
+and exposed in the Prometheus text format by render_cache_metrics() / the api/metrics endpoint.
+"""
+import hashlib
+import json
+import logging
+from functools import wraps
+from typing import Any, Callable, Iterable, Optional
+
+import redis
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from corgi.core.cache import CACHE_ALIAS, get_generations
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_PREFIX = "response"
+METRICS_PREFIX = "metrics"
+RESULTS = ("hit", "miss")
+# Names of the views that are cached, like "ComponentViewSet.list"
+CACHED_VIEWS: list[str] = []
+
+# A function that returns the scopes some request depends on, or None if it can't be cached
+ScopesFunction = Callable[[Any, Request, dict[str, Any]], Optional[Iterable[str]]]
+
+
+def get_response_key(request: Request, scopes: Iterable[str]) -> str:
+    """Return the cache key for a request's response, from its URL and the scopes' generations"""
+    params = sorted(request.query_params.lists())
+    generations = sorted(get_generations(scopes).items())
+    normalized = json.dumps((request.build_absolute_uri(request.path), params, generations))
+    return f"{RESPONSE_PREFIX}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
+
+
+def record_result(view_name: str, result: str) -> None:
+    """Count a hit or miss for some view"""
+    cache = caches[CACHE_ALIAS]
+    key = f"{METRICS_PREFIX}:{view_name}:{result}"
+    try:
+        cache.incr(key)
+    except ValueError:
+        # First result for this view, or another request just added it
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def cache_response(get_scopes: ScopesFunction) -> Callable:
+    """Cache the data for successful responses from some view method"""
+
+    def decorator(method: Callable) -> Callable:
+        view_name = method.__qualname__
+        CACHED_VIEWS.append(view_name)
+
+        @wraps(method)
+        def wrapper(view: Any, request: Request, *args: Any, **kwargs: Any) -> Any:
+            if not settings.API_CACHE_ENABLED or request.method != "GET":
+                return method(view, request, *args, **kwargs)
+            scopes = get_scopes(view, request, kwargs)
+            if scopes is None:
+                return method(view, request, *args, **kwargs)
+
+            cache = caches[CACHE_ALIAS]
+            try:
+                key = get_response_key(request, scopes)
+                data = cache.get(key)
+                if data is not None:
+                    record_result(view_name, "hit")
+                    return Response(data)
+                record_result(view_name, "miss")
+            except redis.RedisError as e:
+                # Still serve requests if the cache is down
+                logger.warning(f"Failed to get cached response for {view_name}: {e}")
+                return method(view, request, *args, **kwargs)
+
+            response = method(view, request, *args, **kwargs)
+            if isinstance(response, Response) and response.status_code == 200:
+                try:
+                    cache.set(key, response.data)
+                except redis.RedisError as e:
+                    logger.warning(f"Failed to cache response for {view_name}: {e}")
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def render_cache_metrics() -> str:
+    """Render the hits and misses for each cached view in the Prometheus text format"""
+    keys = {
+        (view_name, result): f"{METRICS_PREFIX}:{view_name}:{result}"
+        for view_name in CACHED_VIEWS
+        for result in RESULTS
+    }
+    counts = caches[CACHE_ALIAS].get_many(keys.values())
+    lines = [
+        "# HELP corgi_api_cache_requests_total Requests for cached API views, by result",
+        "# TYPE corgi_api_cache_requests_total counter",
+    ]
+    for (view_name, result), key in keys.items():
+        lines.append(
+            f'corgi_api_cache_requests_total{{view="{view_name}",result="{result}"}} '
+            f"{counts.get(key, 0)}"
+        )
+    return "\n".join(lines) + "\n"
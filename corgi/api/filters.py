@@ -1,14 +1,25 @@
 import logging
+import re
 
 from django.core.validators import EMPTY_VALUES
 from django.db.models import QuerySet
 from django_filters.rest_framework import BooleanFilter, CharFilter, Filter, FilterSet
+from rest_framework.filters import SearchFilter
 
+from corgi.core.lookups import ILikeContains
 from corgi.core.models import Channel, Component, ComponentQuerySet, SoftwareBuild
 
 logger = logging.getLogger(__name__)
 
 
+class ILikeSearchFilter(SearchFilter):
+    """Search with ILIKE instead of icontains, so trigram indexes on the search fields are used"""
+
+    def construct_search(self, field_name: str) -> str:
+        lookup = super().construct_search(field_name)
+        return re.sub(r"__icontains$", f"__{ILikeContains.lookup_name}", lookup)
+
+
 class EmptyStringFilter(BooleanFilter):
     """Filter or exclude an arbitrary field against an empty string value"""
 
@@ -57,8 +68,8 @@ class ComponentFilter(FilterSet):
     # Custom filters
     re_name = CharFilter(lookup_expr="regex", field_name="name")
     re_purl = CharFilter(lookup_expr="regex", field_name="purl")
-    description = CharFilter(lookup_expr="icontains")
-    related_url = CharFilter(lookup_expr="icontains")
+    description = CharFilter(lookup_expr=ILikeContains.lookup_name)
+    related_url = CharFilter(lookup_expr=ILikeContains.lookup_name)
     tags = TagFilter()
 
     # User gave a filter like ?ofuri= in URL, assume they wanted a stream
@@ -78,7 +89,10 @@ class ComponentFilter(FilterSet):
     re_provides = CharFilter(field_name="provides", lookup_expr="purl__regex")
     re_upstreams = CharFilter(field_name="upstreams", lookup_expr="purl__regex")
 
-    el_match = CharFilter(label="RHEL version for layered products", lookup_expr="icontains")
+    el_match = CharFilter(
+        label="RHEL version prefix for layered products, like 8 or 8.6",
+        method="filter_el_match",
+    )
     released_components = BooleanFilter(
         method="filter_released_components", label="Show only released components"
     )
@@ -131,6 +145,19 @@ class ComponentFilter(FilterSet):
 
         return method(**{"meta_attr__go_component_type": "gomod"})
 
+    @staticmethod
+    def filter_el_match(
+        queryset: QuerySet[Component], name: str, value: str
+    ) -> QuerySet[Component]:
+        """Match components whose RHEL version starts with the given version, like 8 or 8.6
+        Commas separate the parts too, like the array's text in older queries such as 8,6"""
+        parts = [part for part in re.split(r"[.,_-]", value) if part]
+        if not parts:
+            return queryset
+        # The GIN index on el_match finds components with all the parts in any position
+        # then the slice checks they're at the start, in the same order
+        return queryset.filter(**{f"{name}__contains": parts, f"{name}__0_{len(parts)}": parts})
+
     @staticmethod
     def filter_ofuri_or_name(
         queryset: QuerySet[Component], name: str, value: str
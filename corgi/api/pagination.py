@@ -0,0 +1,251 @@
+import base64
+import binascii
+import json
+from typing import Any, Optional
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import BooleanField, QuerySet
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import RawSQL
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class EstimatedCountPagination(LimitOffsetPagination):
+    """Limit / offset pagination that doesn't count every row of large results
+
+    Results are counted exactly only when the query planner estimates there are fewer than
+    exact_count_threshold of them. Otherwise the count is the planner's estimate, and
+    count_estimated is true in the response. ?count=false skips counting the results at all.
+    The next link comes from fetching one extra row, so it's correct even if the count isn't.
+    """
+
+    count_query_param = "count"
+    count_query_description = "Use `false` to skip counting the results."
+    # Counting more rows than this takes longer than fetching a page of them
+    exact_count_threshold = 10000
+
+    def paginate_queryset(
+        self, queryset: QuerySet, request: Request, view: Any = None
+    ) -> Optional[list[Any]]:
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        self.count_results(queryset, request)
+        if self.count and not self.count_estimated and self.count > self.limit:
+            self.display_page_controls = self.template is not None
+
+        results = list(queryset[self.offset : self.offset + self.limit + 1])
+        self.has_next = len(results) > self.limit
+        return results[: self.limit]
+
+    def count_results(self, queryset: QuerySet, request: Request) -> None:
+        """Set the exact or estimated count of the results, unless the client opted out"""
+        self.count = None
+        self.count_estimated = False
+        if request.query_params.get(self.count_query_param, "").lower() in ("false", "0"):
+            return
+        estimate = self.get_estimated_count(queryset)
+        if estimate < self.exact_count_threshold:
+            self.count = self.get_count(queryset)
+        else:
+            self.count = estimate
+            self.count_estimated = True
+
+    @staticmethod
+    def get_estimated_count(queryset: QuerySet) -> int:
+        """Return the number of rows the query planner expects the queryset to have"""
+        queryset = queryset.order_by()
+        try:
+            # Compiled for the queryset's own DB, so subqueries on the same DB are allowed
+            sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        except EmptyResultSet:
+            # Like QuerySet.none(), which never runs any SQL
+            return 0
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            # psycopg2 only decodes json columns when the json type is registered
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def get_next_link(self) -> Optional[str]:
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_paginated_response(self, data: list[Any]) -> Response:
+        response: dict[str, Any] = {}
+        if self.count is not None:
+            response["count"] = self.count
+            response["count_estimated"] = self.count_estimated
+        response["next"] = self.get_next_link()
+        response["previous"] = self.get_previous_link()
+        response["results"] = data
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema: dict[str, Any]) -> dict[str, Any]:
+        response_schema = super().get_paginated_response_schema(schema)
+        properties = response_schema["properties"]
+        # Keep the count_estimated flag right after the count
+        response_schema["properties"] = {
+            "count": properties.pop("count"),
+            "count_estimated": {
+                "type": "boolean",
+                "example": False,
+                "description": "Whether the count is the query planner's estimate",
+            },
+            **properties,
+        }
+        return response_schema
+
+    def get_schema_operation_parameters(self, view: Any) -> list[dict[str, Any]]:
+        parameters = super().get_schema_operation_parameters(view)
+        parameters.extend(
+            self.get_query_parameter(name, description)
+            for name, description in self.get_extra_query_parameters()
+        )
+        return parameters
+
+    def get_extra_query_parameters(self) -> tuple[tuple[str, str], ...]:
+        """Return the name and description of each query parameter besides limit and offset"""
+        return ((self.count_query_param, self.count_query_description),)
+
+    @staticmethod
+    def get_query_parameter(name: str, description: str) -> dict[str, Any]:
+        return {
+            "name": name,
+            "required": False,
+            "in": "query",
+            "description": description,
+            "schema": {"type": "string"},
+        }
+
+
+class KeysetPagination(EstimatedCountPagination):
+    """Limit / offset pagination by default, or keyset pagination when a client asks for it
+
+    Deep offsets make Postgres read and throw away every row before the offset, and counting
+    all the rows again for every page is slow for large listings. With ?pagination=cursor,
+    each page instead starts right after the last row of the previous page, so the index on
+    the queryset's ordering can be used to find it. The next link has an opaque cursor
+    for that position. Only paging forward is supported.
+    """
+
+    pagination_query_param = "pagination"
+    pagination_query_description = "Use `cursor` to page through results with the next link."
+    cursor_query_param = "cursor"
+    cursor_query_description = "The pagination cursor value, from the next link."
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(
+        self, queryset: QuerySet, request: Request, view: Any = None
+    ) -> Optional[list[Any]]:
+        self.use_cursor = (
+            request.query_params.get(self.pagination_query_param) == self.cursor_query_param
+            or self.cursor_query_param in request.query_params
+        )
+        if not self.use_cursor:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.ordering = self.get_ordering(queryset)
+        queryset = queryset.order_by(*self.ordering)
+        self.count_results(queryset, request)
+
+        position = self.decode_cursor(request)
+        if position:
+            queryset = queryset.filter(self.get_position_filter(queryset, position))
+
+        # Fetch one extra row to find out if there's a next page, without counting
+        results = list(queryset[: self.limit + 1])
+        self.next_position = None
+        if len(results) > self.limit:
+            results = results[: self.limit]
+            self.next_position = [
+                queryset.model._meta.get_field(name).value_to_string(results[-1])
+                for name in self.ordering
+            ]
+        return results
+
+    @staticmethod
+    def get_ordering(queryset: QuerySet) -> tuple[str, ...]:
+        """Return the fields a queryset is ordered by, plus its primary key
+        if those fields don't already identify a single row"""
+        opts = queryset.model._meta
+        ordering = tuple(queryset.query.order_by) or tuple(opts.ordering)
+        for name in ordering:
+            if not isinstance(name, str) or name.startswith("-") or LOOKUP_SEP in name:
+                raise ValueError(f"Cursor pagination only supports ascending fields: {name}")
+
+        unique_fields = [{field.name} for field in opts.fields if field.unique]
+        unique_fields.extend(set(constraint.fields) for constraint in opts.total_unique_constraints)
+        if not any(fields <= set(ordering) for fields in unique_fields):
+            ordering += (opts.pk.name,)
+        return ordering
+
+    def get_position_filter(self, queryset: QuerySet, position: list[str]) -> RawSQL:
+        """Return a condition for rows that sort after some position, using a row comparison
+        so Postgres can start reading the index on the ordering fields from that position"""
+        opts = queryset.model._meta
+        quote_name = connections[queryset.db].ops.quote_name
+        columns = ", ".join(
+            f"{quote_name(opts.db_table)}.{quote_name(opts.get_field(name).column)}"
+            for name in self.ordering
+        )
+        placeholders = ", ".join(["%s"] * len(position))
+        return RawSQL(f"({columns}) > ({placeholders})", position, output_field=BooleanField())
+
+    def encode_cursor(self, position: list[str]) -> str:
+        return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+    def decode_cursor(self, request: Request) -> Optional[list[str]]:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+        except (binascii.Error, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if (
+            not isinstance(position, list)
+            or len(position) != len(self.ordering)
+            or not all(isinstance(value, str) for value in position)
+        ):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def get_next_link(self) -> Optional[str]:
+        if not self.use_cursor:
+            return super().get_next_link()
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.next_position)
+        )
+        return remove_query_param(url, self.offset_query_param)
+
+    def get_previous_link(self) -> Optional[str]:
+        if not self.use_cursor:
+            return super().get_previous_link()
+        return None
+
+    def get_extra_query_parameters(self) -> tuple[tuple[str, str], ...]:
+        return (
+            (self.pagination_query_param, self.pagination_query_description),
+            (self.cursor_query_param, self.cursor_query_description),
+            *super().get_extra_query_parameters(),
+        )
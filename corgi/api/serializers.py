@@ -2,14 +2,17 @@ import datetime
 import logging
 from abc import abstractmethod
 from collections import defaultdict
-from typing import Iterable, Optional, Union
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Union
 from urllib.parse import quote
 from uuid import UUID
 
 from django.conf import settings
+from django.db.models import Prefetch, QuerySet
 from django.db.models.manager import Manager
 from drf_spectacular.utils import extend_schema_field
+from packageurl import PackageURL
 from rest_framework import serializers
+from rest_framework.utils.encoders import JSONEncoder
 
 from corgi.api.constants import CORGI_API_URL, CORGI_STATIC_URL
 from corgi.core.constants import MODEL_FILTER_NAME_MAPPING
@@ -47,6 +50,150 @@ def get_component_purl_link(purl: str) -> str:
     return f"{CORGI_API_URL}/components?purl={quote(purl)}"
 
 
+def get_license_expression(license_raw: str) -> str:
+    """Format a raw license string as an SPDX license expression, like Component.license_declared"""
+    return Component.license_clean(license_raw.upper())
+
+
+# Fields that can be exported for each component, the column each field is read from,
+# and a function to format the column's value if it's not the same as the field's value
+COMPONENT_EXPORT_FIELDS: dict[str, tuple[str, Optional[Callable[[Any], Any]]]] = {
+    "link": ("purl", get_component_purl_link),
+    "uuid": ("uuid", None),
+    "type": ("type", None),
+    "namespace": ("namespace", None),
+    "purl": ("purl", None),
+    "name": ("name", None),
+    "description": ("description", None),
+    "related_url": ("related_url", None),
+    "epoch": ("epoch", None),
+    "version": ("version", None),
+    "release": ("release", None),
+    "el_match": ("el_match", None),
+    "arch": ("arch", None),
+    "nvr": ("nvr", None),
+    "nevra": ("nevra", None),
+    "filename": ("filename", None),
+    "copyright_text": ("copyright_text", None),
+    "license_concluded": ("license_concluded_raw", get_license_expression),
+    "license_declared": ("license_declared_raw", get_license_expression),
+    "openlcs_scan_url": ("openlcs_scan_url", None),
+    "openlcs_scan_version": ("openlcs_scan_version", None),
+    "build_id": ("software_build__build_id", None),
+    "build_type": ("software_build__build_type", None),
+    "build_completion_dt": ("software_build__completion_time", None),
+}
+# Same fields as ComponentListSerializer, plus the UUID
+DEFAULT_COMPONENT_EXPORT_FIELDS = (
+    "link",
+    "uuid",
+    "purl",
+    "name",
+    "version",
+    "nvr",
+    "build_completion_dt",
+)
+
+
+class ComponentRowFormatter:
+    """Read only the columns needed for some export fields, and format each row as a dict"""
+
+    def __init__(self, fields: Sequence[str], extra_columns: Sequence[str] = ()) -> None:
+        self.columns = tuple(
+            dict.fromkeys(
+                (*extra_columns, *(COMPONENT_EXPORT_FIELDS[field][0] for field in fields))
+            )
+        )
+        self.formatters = []
+        for field in fields:
+            column, formatter = COMPONENT_EXPORT_FIELDS[field]
+            self.formatters.append((field, self.columns.index(column), formatter))
+
+    def format(self, row: tuple) -> dict[str, Any]:
+        record = {}
+        for field, index, formatter in self.formatters:
+            value = row[index]
+            record[field] = formatter(value) if formatter and value is not None else value
+        return record
+
+
+def export_components(
+    queryset: QuerySet[Component], fields: Sequence[str], chunk_size: int = 2000
+) -> Iterator[bytes]:
+    """Yield some components as newline-delimited JSON, one chunk of rows at a time
+
+    Rows are read from a server-side cursor as tuples of only the needed columns,
+    without creating model instances, so memory use doesn't grow with the number of rows"""
+    row_formatter = ComponentRowFormatter(fields)
+    # Same formatting for dates, UUIDs, etc. as the JSON API responses
+    encoder = JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    lines = []
+    for row in queryset.values_list(*row_formatter.columns).iterator(chunk_size=chunk_size):
+        lines.append(encoder.encode(row_formatter.format(row)))
+        if len(lines) == chunk_size:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# Fields that can be returned for each resolved purl, the export fields plus the product streams
+COMPONENT_RESOLVE_FIELDS = (*COMPONENT_EXPORT_FIELDS, "product_streams")
+DEFAULT_COMPONENT_RESOLVE_FIELDS = ("link", "uuid", "purl", "product_streams")
+MAX_RESOLVE_PURLS = 50000
+
+
+def resolve_component_purls(
+    purls: Sequence[str], fields: Sequence[str], chunk_size: int = 5000
+) -> dict[str, Optional[dict[str, Any]]]:
+    """Map each purl, exactly as given, to some fields of the matching component
+    or None if there's no matching component. Each chunk of purls is looked up in one query,
+    plus one query for the product streams of all the chunk's components, if requested"""
+    # Purls are stored with each segment URL-encoded, like ComponentViewSet.get_object() expects
+    normalized_purls: dict[str, Optional[str]] = {}
+    for purl in purls:
+        try:
+            normalized_purls[purl] = str(PackageURL.from_string(purl))
+        except ValueError:
+            normalized_purls[purl] = None
+
+    include_product_streams = "product_streams" in fields
+    row_formatter = ComponentRowFormatter(
+        [field for field in fields if field != "product_streams"], extra_columns=("uuid", "purl")
+    )
+    components: dict[str, dict[str, Any]] = {}
+    lookup_purls = sorted(set(purl for purl in normalized_purls.values() if purl))
+    for start in range(0, len(lookup_purls), chunk_size):
+        chunk_records: dict[UUID, dict[str, Any]] = {}
+        for row in (
+            Component.objects.filter(purl__in=lookup_purls[start : start + chunk_size])
+            .values_list(*row_formatter.columns)
+            .using("read_only")
+        ):
+            record = row_formatter.format(row)
+            chunk_records[row[0]] = record
+            components[row[1]] = record
+
+        if include_product_streams and chunk_records:
+            for record in chunk_records.values():
+                record["product_streams"] = []
+            for component_pk, name, ofuri in (
+                Component.productstreams.through.objects.filter(component_id__in=chunk_records)
+                .values_list("component_id", "productstream__name", "productstream__ofuri")
+                .order_by("productstream__name")
+                .using("read_only")
+            ):
+                chunk_records[component_pk]["product_streams"].append(
+                    {"name": name, "ofuri": ofuri}
+                )
+
+    return {
+        purl: components.get(normalized_purl) if normalized_purl else None
+        for purl, normalized_purl in normalized_purls.items()
+    }
+
+
 def get_model_ofuri_link(
     model_name: str,
     ofuri: str,
@@ -118,13 +265,23 @@ def get_model_id_link(
     return link
 
 
+def get_related_values(manager: Manager, *fields: str) -> Iterable[tuple]:
+    """Return some fields for each object in a related manager, either from the objects
+    already loaded by prefetch_related(), or else from a new query"""
+    queryset = manager.all()
+    if queryset._result_cache is not None:
+        # Prefetched, and values_list() would ignore the cache and query again
+        return [tuple(getattr(obj, field) for field in fields) for obj in queryset]
+    return queryset.values_list(*fields).using("read_only").iterator()
+
+
 def get_channel_data_list(manager: Manager["Channel"]) -> list[dict[str, str]]:
     """Generic method to get a list of {name, link, uuid} data for a ProductModel subclass."""
     # A little different than get_product_data_list - we're always iterating over a manager
     # And channels have no ofuri, so we return a model UUID link instead
     return [
         {"name": name, "link": get_model_id_link("channels", uuid), "uuid": str(uuid)}
-        for (name, uuid) in manager.values_list("name", "uuid").using("read_only").iterator()
+        for (name, uuid) in get_related_values(manager, "name", "uuid")
     ]
 
 
@@ -146,9 +303,7 @@ def get_product_data_list(
     # we're accessing the reverse side of a relation with many objects (via a manager)
     return [
         {"name": name, "link": get_model_ofuri_link(model_name, ofuri), "ofuri": ofuri}
-        for (name, ofuri) in obj_or_manager.values_list("name", "ofuri")
-        .using("read_only")
-        .iterator()
+        for (name, ofuri) in get_related_values(obj_or_manager, "name", "ofuri")
     ]
 
 
@@ -448,7 +603,7 @@ class ComponentSerializer(ProductTaxonomySerializer):
         if include_exclude_serializer:
             return include_exclude_serializer.data
         return get_component_data_list(
-            instance.provides.values_list("purl", flat=True).using("read_only").iterator()
+            purl for (purl,) in get_related_values(instance.provides, "purl")
         )
 
     def get_sources(self, instance: Component):
@@ -458,7 +613,7 @@ class ComponentSerializer(ProductTaxonomySerializer):
         if include_exclude_serializer:
             return include_exclude_serializer.data
         return get_component_data_list(
-            instance.sources.values_list("purl", flat=True).using("read_only").iterator()
+            purl for (purl,) in get_related_values(instance.sources, "purl")
         )
 
     def get_upstreams(self, instance: Component):
@@ -468,13 +623,52 @@ class ComponentSerializer(ProductTaxonomySerializer):
         if include_exclude_serializer:
             return include_exclude_serializer.data
         return get_component_data_list(
-            instance.upstreams.values_list("purl", flat=True).using("read_only").iterator()
+            purl for (purl,) in get_related_values(instance.upstreams, "purl")
         )
 
     @staticmethod
     def get_manifest(instance: Component) -> str:
         return get_model_id_link("components", instance.uuid, manifest=True)
 
+    def get_prefetches(self) -> list[Union[str, Prefetch]]:
+        """Return the lookups to prefetch_related() for only the fields that will be shown
+        so that a page of components needs a constant number of queries, not some per component
+        """
+        lookups: list[Union[str, Prefetch]] = []
+        related_fields: dict[str, tuple[str, QuerySet, tuple[str, ...]]] = {
+            "products": ("products", Product.objects.all(), ("name", "ofuri")),
+            "product_versions": (
+                "productversions",
+                ProductVersion.objects.all(),
+                ("name", "ofuri"),
+            ),
+            "product_streams": ("productstreams", ProductStream.objects.all(), ("name", "ofuri")),
+            "product_variants": (
+                "productvariants",
+                ProductVariant.objects.all(),
+                ("name", "ofuri"),
+            ),
+            "channels": ("channels", Channel.objects.all(), ("name",)),
+            "provides": ("provides", Component.objects.all(), ("purl",)),
+            "sources": ("sources", Component.objects.all(), ("purl",)),
+            "upstreams": ("upstreams", Component.objects.all(), ("purl",)),
+        }
+        for field_name, (lookup, queryset, only_fields) in related_fields.items():
+            if field_name not in self.fields:
+                continue
+            if field_name not in self._next_level_include_fields and (
+                field_name not in self._next_level_exclude_fields
+            ):
+                # Nested serializers may need any field, otherwise load only the data we show
+                queryset = queryset.only(*only_fields)
+            lookups.append(Prefetch(lookup, queryset=queryset))
+
+        if "tags" in self.fields:
+            lookups.append("tags")
+        if "errata" in self.fields:
+            lookups.append(Component.prefetch_errata())
+        return lookups
+
     class Meta:
         model = Component
         fields = (
@@ -549,6 +743,19 @@ class ComponentListSerializer(IncludeExcludeFieldsSerializer):
         read_only_fields = fields
 
 
+class ComponentResolveSerializer(serializers.Serializer):
+    """Look up the components for many purls at once"""
+
+    purls = serializers.ListField(
+        child=serializers.CharField(), allow_empty=False, max_length=MAX_RESOLVE_PURLS
+    )
+    fields = serializers.ListField(
+        child=serializers.ChoiceField(choices=COMPONENT_RESOLVE_FIELDS),
+        required=False,
+        default=DEFAULT_COMPONENT_RESOLVE_FIELDS,
+    )
+
+
 class ProductModelSerializer(ProductTaxonomySerializer):
     tags = TagSerializer(many=True, read_only=True)
     components = serializers.SerializerMethodField()
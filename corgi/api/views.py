@@ -1,17 +1,18 @@
 import json
 import logging
-from typing import Any, Type, Union
+from typing import Any, Iterator, Optional, Type, Union
 
 import django_filters.rest_framework
 from django.conf import settings
 from django.db import connections
-from django.db.models import QuerySet, Value
-from django.http import Http404
+from django.db.models import F, Q, QuerySet
+from django.http import Http404, HttpRequest, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import OpenApiParameter, extend_schema, extend_schema_view
 from mozilla_django_oidc.contrib.drf import OIDCAuthentication
-from mptt.templatetags.mptt_tags import cache_tree_children
 from packageurl import PackageURL
 from rest_framework import filters, status
 from rest_framework.authentication import TokenAuthentication
@@ -21,14 +22,18 @@ from rest_framework.decorators import (
     authentication_classes,
     permission_classes,
 )
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet, ReadOnlyModelViewSet
 
 from corgi import __version__
 from corgi.core.authentication import RedHatRolePermission
+from corgi.core.files import ProductManifestFile
+from corgi.core.instrumentation import render_metrics
 from corgi.core.models import (
     AppStreamLifeCycle,
     Channel,
@@ -41,18 +46,24 @@ from corgi.core.models import (
     SoftwareBuild,
 )
 
+from .cache import cache_response, render_cache_metrics
 from .constants import CORGI_API_VERSION
 from .filters import (
     ChannelFilter,
     ComponentFilter,
+    ILikeSearchFilter,
     ProductDataFilter,
     SoftwareBuildFilter,
 )
+from .pagination import EstimatedCountPagination, KeysetPagination
 from .serializers import (
+    COMPONENT_EXPORT_FIELDS,
+    DEFAULT_COMPONENT_EXPORT_FIELDS,
     AppStreamLifeCycleSerializer,
     ChannelSerializer,
     ComponentListSerializer,
     ComponentProductStreamSummarySerializer,
+    ComponentResolveSerializer,
     ComponentSerializer,
     ProductSerializer,
     ProductStreamSerializer,
@@ -60,8 +71,10 @@ from .serializers import (
     ProductVariantSerializer,
     ProductVersionSerializer,
     SoftwareBuildSerializer,
+    export_components,
     get_component_purl_link,
     get_model_ofuri_type,
+    resolve_component_purls,
 )
 
 logger = logging.getLogger(__name__)
@@ -88,6 +101,16 @@ EXCLUDE_FIELDS_PARAMETER = OpenApiParameter(
     ),
 )
 
+MAX_DEPTH_PARAMETER = OpenApiParameter(
+    "max_depth",
+    OpenApiTypes.INT,
+    OpenApiParameter.QUERY,
+    description=(
+        "Show only nodes up to this many levels below the component's own nodes. "
+        "Example: `max_depth=1` shows only direct children"
+    ),
+)
+
 
 # Use below as a decorator on all viewsets that support
 # ?include_fields&exclude_fields= parameters
@@ -110,6 +133,17 @@ def healthy(request: Request) -> Response:
     return Response(status=status.HTTP_200_OK)
 
 
+def metrics(request: HttpRequest) -> HttpResponse:
+    """Expose the timings for each stage of every Celery task, and the API cache hits / misses,
+    in the Prometheus text format"""
+    content = ""
+    if settings.TASK_METRICS_ENABLED:
+        content += render_metrics()
+    if settings.API_CACHE_ENABLED:
+        content += render_cache_metrics()
+    return HttpResponse(content, content_type="text/plain; version=0.0.4")
+
+
 class StatusViewSet(GenericViewSet):
     # Note-including a dummy queryset as scheme generation is complaining for reasons unknown
     queryset = Product.objects.none()
@@ -315,52 +349,234 @@ class TokenAuthTestView(APIView):
 # The tuples recursively contain taxonomy dicts
 taxonomy_dict_type = dict[str, Union[str, tuple["taxonomy_dict_type", ...]]]
 
+# Stream taxonomies with more nodes than this, instead of building the whole response in memory
+TAXONOMY_STREAMING_THRESHOLD = 10000
+TAXONOMY_CHUNK_SIZE = 65536
 
-def recursive_component_node_to_dict(
-    node: ComponentNode, component_type: tuple[str, ...]
-) -> taxonomy_dict_type:
-    """Recursively build a dict of purls, links, and children for some ComponentNode"""
-    if not node.obj:
-        raise ValueError(f"Node {node} had no linked obj")
-
-    result = {}
-    if node.type in component_type:
-        result = {
-            "purl": node.purl,
-            "node_type": node.type,
-            "node_id": node.pk,
-            "obj_link": get_component_purl_link(node.purl),
-            "obj_uuid": node.object_id,
-            "namespace": node.obj.namespace,
-            "type": node.obj.type,
-            "name": node.obj.name,
-            "nvr": node.obj.nvr,
-            "release": node.obj.release,
-            "version": node.obj.version,
-            "arch": node.obj.arch,
+
+class ComponentTaxonomy:
+    """The nodes in every tree below some component, fetched in a single query
+
+    Each node's "provides" are all of its descendants, not only its children, and each of those
+    has its own descendants too. The nodes are in depth-first order, so a node's descendants are
+    the nodes right after it, up to the index in descendants_end. The dict for each node is built
+    once, then shared by all of its ancestors' "provides".
+    """
+
+    def __init__(
+        self, obj: Component, component_types: tuple[str, ...], max_depth: Optional[int] = None
+    ) -> None:
+        self.component_types = component_types
+        self.nodes = self.get_nodes(obj, max_depth)
+        self.descendants_end = self.get_descendants_end(self.nodes)
+
+    @staticmethod
+    def get_nodes(obj: Component, max_depth: Optional[int]) -> list[dict[str, Any]]:
+        """Return every node for the component, plus their descendants up to max_depth levels
+        below them, in depth-first order, with the component fields we show for each"""
+        top_nodes = []
+        for tree_id, lft, rght, level in (
+            obj.cnodes.order_by("tree_id", "lft")
+            .values_list("tree_id", "lft", "rght", "level")
+            .using("read_only")
+        ):
+            if top_nodes and top_nodes[-1][0] == tree_id and lft < top_nodes[-1][2]:
+                # Already included as a descendant of the component's previous node
+                continue
+            top_nodes.append((tree_id, lft, rght, level))
+        if not top_nodes:
+            return []
+
+        subtrees = Q()
+        for tree_id, lft, rght, level in top_nodes:
+            subtree = Q(tree_id=tree_id, lft__gte=lft, lft__lt=rght)
+            if max_depth is not None:
+                subtree &= Q(level__lte=level + max_depth)
+            subtrees |= subtree
+        nodes = list(
+            ComponentNode.objects.filter(subtrees)
+            .order_by("tree_id", "lft")
+            .values(
+                "pk",
+                "tree_id",
+                "rght",
+                "type",
+                "purl",
+                "component_id",
+                "component_type",
+                "namespace",
+                "arch",
+                "component__name",
+                "component__nvr",
+                "component__release",
+                "component__version",
+            )
+            .using("read_only")
+        )
+        for node in nodes:
+            if not node["component_id"]:
+                raise ValueError(f"Node {node['pk']} had no linked component")
+        return nodes
+
+    @staticmethod
+    def get_descendants_end(nodes: list[dict[str, Any]]) -> list[int]:
+        """Return the index just past the last descendant of each node, in one pass"""
+        descendants_end = [0] * len(nodes)
+        ancestors: list[int] = []
+        for index, node in enumerate(nodes):
+            # Close every node on the stack that this one isn't nested in
+            while ancestors and (
+                nodes[ancestors[-1]]["tree_id"] != node["tree_id"]
+                or nodes[ancestors[-1]]["rght"] < node["rght"]
+            ):
+                descendants_end[ancestors.pop()] = index
+            ancestors.append(index)
+        for index in ancestors:
+            descendants_end[index] = len(nodes)
+        return descendants_end
+
+    def get_top_indexes(self) -> list[int]:
+        """Return the index of each top-level node, which isn't a descendant of another node"""
+        top_indexes = []
+        index = 0
+        while index < len(self.nodes):
+            top_indexes.append(index)
+            index = self.descendants_end[index]
+        return top_indexes
+
+    def node_to_dict(self, node: dict[str, Any]) -> dict[str, Any]:
+        """Return the fields we show for some node, or none if it's not a type we show"""
+        if node["type"] not in self.component_types:
+            return {}
+        return {
+            "purl": node["purl"],
+            "node_type": node["type"],
+            "node_id": node["pk"],
+            "obj_link": get_component_purl_link(node["purl"]),
+            "obj_uuid": node["component_id"],
+            "namespace": node["namespace"],
+            "type": node["component_type"],
+            "name": node["component__name"],
+            "nvr": node["component__nvr"],
+            "release": node["component__release"],
+            "version": node["component__version"],
+            "arch": node["arch"],
         }
-    children = tuple(
-        recursive_component_node_to_dict(c, component_type)
-        for c in node.get_descendants().prefetch_related("obj").using("read_only")
-    )
-    if children:
-        result["provides"] = children
-    return result
-
-
-def get_component_taxonomy(
-    obj: Component, component_types: tuple[str, ...]
-) -> tuple[taxonomy_dict_type, ...]:
-    """Look up and return the taxonomy for a particular Component."""
-    root_nodes = cache_tree_children(obj.cnodes.get_queryset().all().using("read_only"))
-    dicts = tuple(
-        recursive_component_node_to_dict(
-            node,
-            component_types,
+
+    def to_dicts(self) -> tuple[taxonomy_dict_type, ...]:
+        """Build a dict of purls, links, and descendants for each top-level node"""
+        dicts = [self.node_to_dict(node) for node in self.nodes]
+        for index, result in enumerate(dicts):
+            end = self.descendants_end[index]
+            if end > index + 1:
+                result["provides"] = tuple(dicts[index + 1 : end])
+        return tuple(dicts[index] for index in self.get_top_indexes())
+
+    def iter_json(self) -> Iterator[str]:
+        """Encode the same data as to_dicts() as JSON, in chunks, without building it all first
+        Each node's own fields are encoded once, then reused by all of its ancestors"""
+        encoder = JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+        # Leave off the closing brace, so "provides" can be added
+        heads = [encoder.encode(self.node_to_dict(node))[:-1] for node in self.nodes]
+
+        def iter_node(index: int) -> Iterator[str]:
+            end = self.descendants_end[index]
+            if end == index + 1:
+                yield f"{heads[index]}}}"
+                return
+            separator = "," if len(heads[index]) > 1 else ""
+            yield f'{heads[index]}{separator}"provides":['
+            for descendant in range(index + 1, end):
+                if descendant > index + 1:
+                    yield ","
+                yield from iter_node(descendant)
+            yield "]}"
+
+        def iter_parts() -> Iterator[str]:
+            yield "["
+            for count, index in enumerate(self.get_top_indexes()):
+                if count:
+                    yield ","
+                yield from iter_node(index)
+            yield "]"
+
+        chunk: list[str] = []
+        size = 0
+        for part in iter_parts():
+            chunk.append(part)
+            size += len(part)
+            if size >= TAXONOMY_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk)
+
+
+def get_component_scopes(view: Any, request: Request, kwargs: dict[str, Any]) -> tuple[str]:
+    """Cached responses for some component's details depend only on that component"""
+    return (f"component:{kwargs['uuid']}",)
+
+
+def get_component_list_scopes(
+    view: Any, request: Request, kwargs: dict[str, Any]
+) -> Optional[tuple[str]]:
+    """Return the scopes that a cached list of components depends on"""
+    purl = request.query_params.get("purl")
+    if purl:
+        try:
+            return (f"component:{PackageURL.from_string(purl)}",)
+        except ValueError:
+            return None
+    ofuri = request.query_params.get("ofuri")
+    if ofuri:
+        model, _ = get_model_ofuri_type(ofuri)
+        # The view returns a 404 if there's no matching model, so don't cache it
+        return (f"product_model:{model.pk}",) if model else None
+    # Components with any other filters could change when any component is saved
+    return ("components",)
+
+
+def get_product_stream_list_scopes(
+    view: Any, request: Request, kwargs: dict[str, Any]
+) -> Optional[tuple[str, ...]]:
+    """Return the scopes that a cached list of product streams, or a single stream, depends on"""
+    name = request.query_params.get("name")
+    ofuri = request.query_params.get("ofuri")
+    if name or ofuri:
+        lookup = {"name": name} if name else {"ofuri": ofuri}
+        pk = (
+            ProductStream.objects.db_manager("read_only")
+            .filter(**lookup)
+            .values_list("pk", flat=True)
+            .first()
         )
-        for node in root_nodes
-    )
-    return dicts
+        return ("products", f"product_model:{pk}") if pk else None
+    return ("products", "product_streams")
+
+
+def get_max_depth(request: Request) -> Optional[int]:
+    """Return the ?max_depth= for a taxonomy, or None to show every level"""
+    max_depth = request.query_params.get("max_depth")
+    if not max_depth:
+        return None
+    try:
+        value = int(max_depth)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise ValidationError({"max_depth": "Must be a non-negative integer"})
+    return value
+
+
+def component_taxonomy_response(
+    obj: Component, component_types: tuple[str, ...], request: Request
+) -> Union[Response, StreamingHttpResponse]:
+    """Return the taxonomy for a Component, streamed as JSON if it's very large"""
+    taxonomy = ComponentTaxonomy(obj, component_types, get_max_depth(request))
+    if len(taxonomy.nodes) > TAXONOMY_STREAMING_THRESHOLD:
+        return StreamingHttpResponse(taxonomy.iter_json(), content_type="application/json")
+    return Response(taxonomy.to_dicts())
 
 
 @INCLUDE_EXCLUDE_FIELDS_SCHEMA
@@ -371,12 +587,14 @@ class SoftwareBuildViewSet(ReadOnlyModelViewSet):  # TODO: TagViewMixin disabled
     serializer_class = SoftwareBuildSerializer
     filter_backends = [django_filters.rest_framework.DjangoFilterBackend, filters.SearchFilter]
     filterset_class = SoftwareBuildFilter
+    pagination_class = KeysetPagination
 
 
 class ProductDataViewSet(ReadOnlyModelViewSet):  # TODO: TagViewMixin disabled until auth is added
     filter_backends = [django_filters.rest_framework.DjangoFilterBackend, filters.SearchFilter]
     search_fields = ["name", "description", "meta_attr"]
     filterset_class = ProductDataFilter
+    pagination_class = KeysetPagination
     lookup_url_kwarg = "uuid"
     ordering_field = "name"
 
@@ -460,6 +678,7 @@ class ProductStreamViewSetSet(ProductDataViewSet):
     @extend_schema(
         parameters=[OpenApiParameter("active", OpenApiTypes.STR, OpenApiParameter.QUERY)]
     )
+    @cache_response(get_product_stream_list_scopes)
     def list(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
         view = request.query_params.get("view")
         ps_ofuri = request.query_params.get("ofuri")
@@ -492,12 +711,26 @@ class ProductStreamViewSetSet(ProductDataViewSet):
             raise Http404
 
     @action(methods=["get"], detail=True)
-    def manifest(self, request: Request, uuid: Union[str, None] = None) -> Response:
+    def manifest(
+        self, request: Request, uuid: Union[str, None] = None
+    ) -> Union[Response, HttpResponse, StreamingHttpResponse]:
         obj = self.queryset.filter(uuid=uuid).first()
         if not obj:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        manifest = json.loads(obj.manifest)
-        return Response(manifest)
+        manifest_file = ProductManifestFile(obj)
+        # Weak, since the time each manifest was created is in its content
+        etag = f"W/{quote_etag(manifest_file.get_fingerprint(cpe_mapping=False))}"
+        # Don't generate the manifest again if the client already has the latest version
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified:
+            not_modified["ETag"] = etag
+            return not_modified
+        # Large manifests are written as they're generated, instead of all at once
+        response = StreamingHttpResponse(
+            manifest_file.iter_content(cpe_mapping=False), content_type="application/json"
+        )
+        response["ETag"] = etag
+        return response
 
 
 @INCLUDE_EXCLUDE_FIELDS_SCHEMA
@@ -555,31 +788,32 @@ class ComponentViewSet(ReadOnlyModelViewSet):  # TODO: TagViewMixin disabled unt
         Type[ComponentSerializer], Type[ComponentListSerializer]
     ] = ComponentSerializer
     search_fields = ["name", "description", "release", "version", "meta_attr"]
-    filter_backends = [django_filters.rest_framework.DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [django_filters.rest_framework.DjangoFilterBackend, ILikeSearchFilter]
     filterset_class = ComponentFilter
+    pagination_class = KeysetPagination
     lookup_url_kwarg = "uuid"
 
     def get_queryset(self) -> QuerySet[Component]:
         # 'latest' and 'root components' filter automagically turn on
         # when the ofuri parameter is given
         # We should remove this parameter and rely on standard Django filters instead
+        queryset = self.queryset
+        if self.action == "list":
+            serializer = self.get_serializer()
+            if isinstance(serializer, ComponentSerializer):
+                # Load related data for the whole page at once, not for each component
+                queryset = queryset.prefetch_related(*serializer.get_prefetches())
+
         ofuri = self.request.query_params.get("ofuri")
         if not ofuri:
-            return self.queryset
+            return queryset
 
         model, _ = get_model_ofuri_type(ofuri)
-        if isinstance(model, Product):
-            components_for_model = self.queryset.filter(products__ofuri=ofuri)
-        elif isinstance(model, ProductVersion):
-            components_for_model = self.queryset.filter(productversions__ofuri=ofuri)
-        elif isinstance(model, ProductStream):
-            components_for_model = self.queryset.filter(productstreams__ofuri=ofuri)
-        elif isinstance(model, ProductVariant):
-            components_for_model = self.queryset.filter(productvariants__ofuri=ofuri)
-        else:
+        if not isinstance(model, (Product, ProductVersion, ProductStream, ProductVariant)):
             # No matching model instance found, or invalid ofuri
             raise Http404
-        return components_for_model.root_components().latest_components()
+        # The latest root components are saved for each model, so just join on them
+        return queryset.latest_components_for(model)
 
     @extend_schema(
         parameters=[
@@ -588,6 +822,7 @@ class ComponentViewSet(ReadOnlyModelViewSet):  # TODO: TagViewMixin disabled unt
             OpenApiParameter("purl", OpenApiTypes.STR, OpenApiParameter.QUERY),
         ]
     )
+    @cache_response(get_component_list_scopes)
     def list(self, request: Request, *args: tuple, **kwargs: dict) -> Response:
         # purl are stored with each segment url encoded as per the specification. The purl query
         # param here is url decoded, to ensure special characters such as '@' and '?'
@@ -597,30 +832,32 @@ class ComponentViewSet(ReadOnlyModelViewSet):  # TODO: TagViewMixin disabled unt
         if not purl:
             if view == "product":
                 component_name = self.request.query_params.get("name", "")
-                product_streams_arr = []
-                for c in (
-                    self.get_queryset()
-                    .filter(name=component_name)
-                    .prefetch_related("productstreams")
-                ):
-                    annotated_ps_qs = (
-                        c.productstreams.get_queryset()
-                        .annotate(component_purl=Value(c.purl))
-                        .using("read_only")
+                # One row per (stream, component) pair, from a single join on the m2m table
+                productstreams = (
+                    ProductStream.objects.filter(
+                        components__in=self.get_queryset().filter(name=component_name)
                     )
-                    product_streams_arr.append(annotated_ps_qs)
-
-                ps_qs = ProductStream.objects.none()
-                productstreams = ps_qs.union(*product_streams_arr).using("read_only")
+                    .annotate(component_purl=F("components__purl"))
+                    .only("name", "ofuri")
+                    .order_by("name", "component_purl")
+                    .using("read_only")
+                )
+                # Pairs don't support cursors, since the purl isn't a ProductStream field
+                paginator = EstimatedCountPagination()
+                page = paginator.paginate_queryset(productstreams, request, view=self)
                 serializer = ComponentProductStreamSummarySerializer(
-                    productstreams, many=True, read_only=True
+                    page, many=True, read_only=True
                 )
-                return Response({"count": productstreams.count(), "results": serializer.data})
+                return paginator.get_paginated_response(serializer.data)
             if view == "summary":
                 self.serializer_class = ComponentListSerializer
             return super().list(request)
         return super().retrieve(request)
 
+    @cache_response(get_component_scopes)
+    def retrieve(self, request: Request, *args: Any, **kwargs: Any) -> Response:
+        return super().retrieve(request, *args, **kwargs)
+
     def get_object(self):
         req = self.request
         purl = req.query_params.get("purl")
@@ -637,6 +874,65 @@ class ComponentViewSet(ReadOnlyModelViewSet):  # TODO: TagViewMixin disabled unt
         except Component.DoesNotExist:
             raise Http404
 
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("ofuri", OpenApiTypes.STR, OpenApiParameter.QUERY),
+            OpenApiParameter(
+                "fields",
+                type={
+                    "type": "array",
+                    "items": {"type": "string", "enum": tuple(COMPONENT_EXPORT_FIELDS)},
+                },
+                location=OpenApiParameter.QUERY,
+                description=(
+                    "Export only the specified fields. "
+                    "Multiple values may be separated by commas. "
+                    f"Default: `fields={','.join(DEFAULT_COMPONENT_EXPORT_FIELDS)}`"
+                ),
+            ),
+        ],
+        responses={(200, "application/x-ndjson"): OpenApiTypes.OBJECT},
+    )
+    @action(methods=["get"], detail=False)
+    def export(self, request: Request) -> StreamingHttpResponse:
+        """Stream all matching components as newline-delimited JSON, with one object per line.
+        The response is compressed if the request has an Accept-Encoding: gzip header."""
+        fields_param = request.query_params.get("fields", "")
+        fields = tuple(field.strip() for field in fields_param.split(",") if field.strip())
+        unknown_fields = [field for field in fields if field not in COMPONENT_EXPORT_FIELDS]
+        if unknown_fields:
+            raise ValidationError({"fields": f"Unknown fields: {', '.join(unknown_fields)}"})
+
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(
+            export_components(queryset, fields or DEFAULT_COMPONENT_EXPORT_FIELDS),
+            content_type="application/x-ndjson",
+        )
+
+    @extend_schema(
+        request=ComponentResolveSerializer,
+        responses={
+            200: {
+                "type": "object",
+                "properties": {
+                    "count": {"type": "integer"},
+                    "results": {"type": "object", "additionalProperties": {"type": "object"}},
+                },
+            }
+        },
+    )
+    @action(methods=["post"], detail=False)
+    def resolve(self, request: Request) -> Response:
+        """Look up the components for many purls in one request.
+        Results map each purl to the chosen fields of its component, or null if none matched."""
+        serializer = ComponentResolveSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = resolve_component_purls(
+            serializer.validated_data["purls"], serializer.validated_data["fields"]
+        )
+        count = sum(1 for result in results.values() if result is not None)
+        return Response({"count": count, "results": results})
+
     @action(methods=["get"], detail=True)
     def manifest(self, request: Request, uuid: str = "") -> Response:
         obj = self.queryset.filter(uuid=uuid).first()
@@ -690,28 +986,34 @@ class ComponentViewSet(ReadOnlyModelViewSet):  # TODO: TagViewMixin disabled unt
         if openlcs_scan_version is not None:
             component.openlcs_scan_version = openlcs_scan_version
         component.save()
+        Component.bump_generations((component.pk,))
         response = Response(status=status.HTTP_302_FOUND)
         response["Location"] = f"/api/{CORGI_API_VERSION}/components/{component.uuid}"
         return response
 
+    @extend_schema(parameters=[MAX_DEPTH_PARAMETER])
     @action(methods=["get"], detail=True)
-    def provides(self, request: Request, uuid: Union[str, None] = None) -> Response:
+    @cache_response(get_component_scopes)
+    def provides(
+        self, request: Request, uuid: Union[str, None] = None
+    ) -> Union[Response, StreamingHttpResponse]:
         obj = self.queryset.filter(uuid=uuid).first()
         if not obj:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        dicts = get_component_taxonomy(
-            obj,
-            ComponentNode.PROVIDES_NODE_TYPES,
-        )
-        return Response(dicts)
+        return component_taxonomy_response(obj, ComponentNode.PROVIDES_NODE_TYPES, request)
 
+    @extend_schema(parameters=[MAX_DEPTH_PARAMETER])
     @action(methods=["get"], detail=True)
-    def taxonomy(self, request: Request, uuid: Union[str, None] = None) -> Response:
+    @cache_response(get_component_scopes)
+    def taxonomy(
+        self, request: Request, uuid: Union[str, None] = None
+    ) -> Union[Response, StreamingHttpResponse]:
         obj = self.queryset.filter(uuid=uuid).first()
         if not obj:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        dicts = get_component_taxonomy(obj, tuple(ComponentNode.ComponentNodeType.values))
-        return Response(dicts)
+        return component_taxonomy_response(
+            obj, tuple(ComponentNode.ComponentNodeType.values), request
+        )
 
 
 class AppStreamLifeCycleViewSet(ReadOnlyModelViewSet):
@@ -1,10 +1,13 @@
+import hashlib
 import json
 import logging
 import os
 import re
+import tempfile
+from contextlib import contextmanager
 from datetime import datetime
 from types import SimpleNamespace
-from typing import Any, Generator, Iterable, Optional, Union
+from typing import Any, Callable, Generator, Iterable, Iterator, Optional, Union
 from urllib.parse import urlparse
 
 import koji
@@ -15,6 +18,7 @@ from django.conf import settings
 from config.celery import app
 from corgi.collectors.models import CollectorRhelModule, CollectorRPM, CollectorSRPM
 from corgi.core.constants import CONTAINER_REPOSITORY
+from corgi.core.instrumentation import external_call
 from corgi.core.models import Component, SoftwareBuild
 
 logger = logging.getLogger(__name__)
@@ -42,6 +46,245 @@ class BrewBuildNotFound(Exception):
     pass
 
 
+class BrewCache:
+    """Content-addressed cache on local disk for immutable Brew data
+
+    Each result is stored in a file named after the hash of the call that returned it,
+    so identical calls from any worker share the same entry. Least-recently-used entries
+    are removed once the cache grows beyond max_bytes.
+    """
+
+    # Only check the size of the cache every so often, since it walks the whole directory
+    EVICTION_INTERVAL = 100
+    # Evict down to less than the limit, so we don't need to evict again on the next write
+    EVICTION_RATIO = 0.8
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.writes = 0
+
+    @staticmethod
+    def get_key(server: str, method: str, args: tuple, kwargs: dict[str, Any]) -> str:
+        # Build IDs are only unique within one Brew / Koji instance, so include its URL
+        call = json.dumps([server, method, args, kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(call.encode("utf-8")).hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        """Return (True, value) for a cached result, or (False, None) when it's missing"""
+        path = self._get_path(key)
+        try:
+            with open(path) as cache_file:
+                value = json.load(cache_file)
+        except (OSError, ValueError):
+            return False, None
+        # Mark this entry as recently used, so it's evicted last
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True, value
+
+    def set(self, key: str, value: Any) -> None:
+        try:
+            data = json.dumps(value)
+        except (TypeError, ValueError):
+            # Some results (e.g. binary RPM headers) can't be stored as JSON, so just refetch them
+            logger.debug("Not caching Brew result for %s, it isn't JSON-serializable", key)
+            return
+        path = self._get_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file, then rename, so other workers never read partial data
+            with tempfile.NamedTemporaryFile(
+                "w", dir=os.path.dirname(path), suffix=".tmp", delete=False
+            ) as cache_file:
+                cache_file.write(data)
+            os.replace(cache_file.name, path)
+        except OSError as exc:
+            logger.warning("Couldn't write Brew cache entry %s: %s", path, exc)
+            return
+
+        self.writes += 1
+        if self.writes % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove least-recently-used entries until the cache is smaller than max_bytes"""
+        entries = []
+        total_bytes = 0
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Already removed by some other worker
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+        if total_bytes <= self.max_bytes:
+            return
+
+        target_bytes = self.max_bytes * self.EVICTION_RATIO
+        for _, size, path in sorted(entries):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+        logger.info("Evicted Brew cache entries, %s bytes remain", total_bytes)
+
+
+class BrewCall:
+    """The result of one call in a BrewSession multicall, like koji.VirtualCall"""
+
+    def __init__(self) -> None:
+        self.value: Any = None
+        self.virtual_call: Optional[koji.VirtualCall] = None
+
+    @property
+    def result(self) -> Any:
+        if self.virtual_call is not None:
+            # Raises the call's error, if it failed
+            return self.virtual_call.result
+        return self.value
+
+
+class BrewMultiCall:
+    """Collects calls made in a BrewSession.multicall() block, to send together on exit"""
+
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, tuple, dict[str, Any], BrewCall]] = []
+
+    def __getattr__(self, name: str) -> Callable[..., BrewCall]:
+        def add_call(*args: Any, **kwargs: Any) -> BrewCall:
+            call = BrewCall()
+            self.calls.append((name, args, kwargs, call))
+            return call
+
+        return add_call
+
+
+class BrewSession:
+    """Wraps a koji.ClientSession, so immutable build data is only fetched from Brew once
+
+    Any call not defined here is passed through to the wrapped session unchanged.
+    Results from prefetch() are returned once, for the next call with the same arguments.
+    """
+
+    # Calls whose results never change for the same arguments, once a build is complete
+    # Build state and tags change over time, so e.g. getBuild and listTags are never cached
+    CACHED_METHODS = frozenset(
+        ("getBuildType", "getRPMHeaders", "getTaskRequest", "listArchives", "listRPMs")
+    )
+
+    def __init__(self, session: koji.ClientSession, cache: Optional[BrewCache] = None) -> None:
+        self.session = session
+        self.cache = cache
+        self.prefetched: dict[str, Any] = {}
+
+    def _get_key(self, name: str, args: tuple, kwargs: dict[str, Any]) -> str:
+        return BrewCache.get_key(self.session.baseurl, name, args, kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        method = getattr(self.session, name)
+        if not callable(method):
+            return method
+        cached = self.cache is not None and name in self.CACHED_METHODS
+
+        def cached_method(*args: Any, **kwargs: Any) -> Any:
+            key = ""
+            if self.prefetched or cached:
+                key = self._get_key(name, args, kwargs)
+            if key in self.prefetched:
+                return self.prefetched.pop(key)
+            if cached:
+                found, value = self.cache.get(key)  # type: ignore[union-attr]
+                if found:
+                    return value
+            with external_call("koji"):
+                value = method(*args, **kwargs)
+            if cached and value is not None:
+                self.cache.set(key, value)  # type: ignore[union-attr]
+            return value
+
+        return cached_method
+
+    def prefetch(self, calls: Iterable[tuple[str, tuple]]) -> None:
+        """Make many (method name, args) calls in one multicall, and keep their results
+        until the same calls are made again, so callers don't need to know about the batch"""
+        with self.multicall() as multicall:
+            pending = [(name, args, getattr(multicall, name)(*args)) for name, args in calls]
+        for name, args, call in pending:
+            try:
+                value = call.result
+            except Exception:
+                # Failed calls are just made again later, so the caller sees the usual error
+                continue
+            self.prefetched[self._get_key(name, args, {})] = value
+
+    @contextmanager
+    def multicall(
+        self, strict: bool = False, batch: Optional[int] = None
+    ) -> Iterator[BrewMultiCall]:
+        """Same as koji.ClientSession.multicall(), but cached results aren't requested again
+
+        All calls that aren't cached are pipelined into one request, or one per batch"""
+        multicall = BrewMultiCall()
+        yield multicall
+
+        uncached_calls = []
+        for name, args, kwargs, call in multicall.calls:
+            key = ""
+            if self.cache is not None and name in self.CACHED_METHODS:
+                key = self._get_key(name, args, kwargs)
+                found, call.value = self.cache.get(key)
+                if found:
+                    continue
+            uncached_calls.append((name, args, kwargs, call, key))
+        if not uncached_calls:
+            return
+
+        # The calls are sent when the block exits
+        with external_call("koji"), self.session.multicall(
+            strict=strict, batch=batch
+        ) as session_multicall:
+            for name, args, kwargs, call, _ in uncached_calls:
+                call.virtual_call = getattr(session_multicall, name)(*args, **kwargs)
+
+        for _, _, _, call, key in uncached_calls:
+            if not key:
+                continue
+            try:
+                value = call.result
+            except Exception:
+                # Failed calls raise their error when the caller checks the result
+                continue
+            if value is not None:
+                self.cache.set(key, value)  # type: ignore[union-attr]
+
+
+# One cache for each directory per process, so writes from every Brew instance (one per task)
+# count towards the cache's next eviction
+_brew_caches: dict[tuple[str, int], BrewCache] = {}
+
+
+def get_brew_cache() -> Optional[BrewCache]:
+    """Return the cache for Brew data, or None if it's disabled in settings"""
+    if not settings.BREW_CACHE_DIR:
+        return None
+    cache_settings = (settings.BREW_CACHE_DIR, settings.BREW_CACHE_MAX_BYTES)
+    if cache_settings not in _brew_caches:
+        _brew_caches[cache_settings] = BrewCache(*cache_settings)
+    return _brew_caches[cache_settings]
+
+
 class Brew:
     """Interface to the Brew API for build data collection.
 
@@ -89,19 +332,22 @@ class Brew:
     # A list of component names, for which build analysis will be skipped.
     COMPONENT_EXCLUDES = json.loads(os.getenv("CORGI_COMPONENT_EXCLUDES", "[]"))
 
-    koji_session: koji.ClientSession = None
+    # Calls made by get_component_data() with only the integer build ID as an argument
+    # listArchives is only needed for images, and listRPMs only for RPMs, but both are cheap
+    PREFETCHED_METHODS = ("getBuild", "getBuildType", "listTags", "listArchives", "listRPMs")
+
+    koji_session: BrewSession = None
 
     def __init__(self, source: str = ""):
         if source == SoftwareBuild.Type.CENTOS:
-            self.koji_session = koji.ClientSession(settings.CENTOS_URL)
+            session = koji.ClientSession(settings.CENTOS_URL)
         elif source == SoftwareBuild.Type.KOJI:
-            self.koji_session = koji.ClientSession(settings.BREW_URL)
+            session = koji.ClientSession(settings.BREW_URL)
         elif source == SoftwareBuild.Type.BREW:
-            self.koji_session = koji.ClientSession(
-                settings.BREW_URL, opts={"serverca": settings.CA_CERT}
-            )
+            session = koji.ClientSession(settings.BREW_URL, opts={"serverca": settings.CA_CERT})
         else:
             raise ValueError(f"Tried to create Brew collector with invalid type: {source}")
+        self.koji_session = BrewSession(session, get_brew_cache())
 
     def get_source_of_build(self, build_info: dict[str, Any]) -> str:
         """Find the source used to build the Koji build."""
@@ -474,10 +720,23 @@ class Brew:
         noarch_rpms_by_id: dict[int, dict[str, Any]] = {}
         rpm_build_ids: set[int] = set()
 
+        # List the RPMs in every image archive with a single multicall, instead of one by one
+        with self.koji_session.multicall() as multicall:
+            archive_rpm_calls = {
+                archive["id"]: multicall.listRPMs(imageID=archive["id"])
+                for archive in archives
+                if archive["btype"] == "image" and archive["type_name"] == "tar"
+            }
+
         for archive in archives:
             if archive["btype"] == "image" and archive["type_name"] == "tar":
                 noarch_rpms_by_id, child_image_component = self._extract_image_components(
-                    archive, build_id, build_info["nvr"], noarch_rpms_by_id, rpm_build_ids
+                    archive,
+                    build_id,
+                    build_info["nvr"],
+                    noarch_rpms_by_id,
+                    rpm_build_ids,
+                    rpms=archive_rpm_calls[archive["id"]].result,
                 )
                 child_image_components.append(child_image_component)
             if archive["btype"] == "remote-sources":
@@ -620,6 +879,7 @@ class Brew:
         build_nvr: str,
         noarch_rpms_by_id: dict[int, dict[str, Any]],
         rpm_build_ids: set[int],
+        rpms: Optional[list[dict[str, Any]]] = None,
     ) -> tuple[dict[int, dict[str, Any]], dict[str, Any]]:
         logger.info("Processing image archive %s", archive["filename"])
         docker_config = archive["extra"]["docker"]["config"]
@@ -635,7 +895,8 @@ class Brew:
         child_component["meta"]["brew_archive_id"] = archive["id"]
         child_component["meta"]["digests"] = archive["extra"]["docker"]["digests"]
         child_component["meta"]["source"] = ["koji.listArchives"]
-        rpms = self.koji_session.listRPMs(imageID=archive["id"])
+        if rpms is None:
+            rpms = self.koji_session.listRPMs(imageID=archive["id"])
         arch_specific_rpms = []
         for rpm in rpms:
             rpm_component = {
@@ -942,6 +1203,14 @@ class Brew:
 
         return module
 
+    def prefetch_builds(self, build_ids: Iterable[int]) -> None:
+        """Fetch the data for many builds at once, instead of separately for each build
+        Only calls that need nothing besides the build ID are made, in a single multicall.
+        Then get_component_data() uses these results, and only makes the remaining calls."""
+        self.koji_session.prefetch(
+            (method, (build_id,)) for build_id in build_ids for method in self.PREFETCHED_METHODS
+        )
+
     # Force clients to call this using an int build_id
     def get_component_data(self, build_id: int) -> dict[str, Any]:
         logger.info("Retrieving Brew build: %s", build_id)
@@ -968,7 +1237,8 @@ class Brew:
             return {}
 
         # Determine build type
-        build_type_info = self.koji_session.getBuildType(build)
+        # Look up by ID, so the result can be cached no matter what else in the build changed
+        build_type_info = self.koji_session.getBuildType(build_id)
         build_type = next(
             (type_ for type_ in build_type_info.keys() if type_ in self.SUPPORTED_BUILD_TYPES),
             "unknown",
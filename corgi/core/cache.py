@@ -0,0 +1,176 @@
+"""
+Data generations for cached API responses, and a Redis backend for Django's cache framework.
+
+Each cached response depends on one or more scopes, like "component:<uuid>" for a component
+or "product_model:<uuid>" for a product / version / stream / variant. Every scope has a
+generation, which is part of the cache key for any response that depends on that scope.
+Code that changes some data bumps the generation for every scope it touched, so any cached
+responses for those scopes are never used again, and eventually expire from the cache.
+The packages and relationships for each component in product manifests are cached the same way,
+see ProductManifestFile in corgi/core/files.py.
+"""
+import hashlib
+import logging
+import pickle
+import time
+from typing import Any, Iterable, Optional
+
+import redis
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# The alias for the cache in settings.CACHES that's used for API responses and generations
+CACHE_ALIAS = "api"
+GENERATION_PREFIX = "generation"
+
+
+class RedisCache(BaseCache):
+    """A minimal Redis cache backend, until we upgrade to Django 4.0 which includes one
+    LOCATION is a redis:// URL. Values are pickled, except for integers, so incr() is atomic"""
+
+    def __init__(self, server: str, params: dict[str, Any]) -> None:
+        super().__init__(params)
+        self._client = redis.Redis.from_url(server)
+
+    @staticmethod
+    def _dump(value: Any) -> bytes:
+        if type(value) is int:
+            return str(value).encode("ascii")
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _load(value: Optional[bytes]) -> Any:
+        try:
+            return int(value)  # type: ignore[arg-type]
+        except ValueError:
+            return pickle.loads(value)  # type: ignore[arg-type]
+
+    def _get_expiry(self, timeout: Any) -> Optional[int]:
+        """Return the number of seconds until a key expires, or None if it never expires"""
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else int(timeout)
+
+    def _make_key(self, key: str, version: Optional[int]) -> str:
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def add(
+        self, key: str, value: Any, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None
+    ) -> bool:
+        expiry = self._get_expiry(timeout)
+        if expiry is not None and expiry <= 0:
+            return False
+        key = self._make_key(key, version)
+        return bool(self._client.set(key, self._dump(value), ex=expiry, nx=True))
+
+    def get(self, key: str, default: Any = None, version: Optional[int] = None) -> Any:
+        value = self._client.get(self._make_key(key, version))
+        return default if value is None else self._load(value)
+
+    def set(
+        self, key: str, value: Any, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None
+    ) -> None:
+        expiry = self._get_expiry(timeout)
+        key = self._make_key(key, version)
+        if expiry is not None and expiry <= 0:
+            self._client.delete(key)
+        else:
+            self._client.set(key, self._dump(value), ex=expiry)
+
+    def touch(
+        self, key: str, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None
+    ) -> bool:
+        expiry = self._get_expiry(timeout)
+        key = self._make_key(key, version)
+        if expiry is None:
+            return bool(self._client.persist(key))
+        return bool(self._client.expire(key, max(expiry, 0)))
+
+    def delete(self, key: str, version: Optional[int] = None) -> bool:
+        return bool(self._client.delete(self._make_key(key, version)))
+
+    def has_key(self, key: str, version: Optional[int] = None) -> bool:
+        return bool(self._client.exists(self._make_key(key, version)))
+
+    def get_many(self, keys: Iterable[str], version: Optional[int] = None) -> dict[str, Any]:
+        keys = tuple(keys)
+        if not keys:
+            return {}
+        values = self._client.mget([self._make_key(key, version) for key in keys])
+        return {key: self._load(value) for key, value in zip(keys, values) if value is not None}
+
+    def set_many(
+        self, data: dict[str, Any], timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None
+    ) -> list[str]:
+        # One round-trip for all the keys
+        with self._client.pipeline(transaction=False) as pipe:
+            expiry = self._get_expiry(timeout)
+            for key, value in data.items():
+                key = self._make_key(key, version)
+                if expiry is not None and expiry <= 0:
+                    pipe.delete(key)
+                else:
+                    pipe.set(key, self._dump(value), ex=expiry)
+            pipe.execute()
+        return []
+
+    def incr(self, key: str, delta: int = 1, version: Optional[int] = None) -> int:
+        key = self._make_key(key, version)
+        if not self._client.exists(key):
+            raise ValueError(f"Key '{key}' not found")
+        return self._client.incrby(key, delta)
+
+    def clear(self) -> None:
+        """Delete only the keys for this cache, since Redis is also Celery's broker"""
+        for key in self._client.scan_iter(match=f"{self.key_prefix}:*"):
+            self._client.delete(key)
+
+
+def generations_enabled() -> bool:
+    """Return whether anything uses generations, so they must be bumped when data changes"""
+    return settings.API_CACHE_ENABLED or settings.MANIFEST_CACHE_ENABLED
+
+
+def _get_generation_key(scope: str) -> str:
+    # Scopes can have characters and lengths that some cache backends don't allow in keys
+    return f"{GENERATION_PREFIX}:{hashlib.sha256(scope.encode('utf-8')).hexdigest()}"
+
+
+def get_generations(scopes: Iterable[str]) -> dict[str, int]:
+    """Return the current generation of each scope, and start one for any scope without one"""
+    cache = caches[CACHE_ALIAS]
+    keys = {scope: _get_generation_key(scope) for scope in scopes}
+    generations = cache.get_many(keys.values())
+    for key in keys.values():
+        if key not in generations:
+            # The generation may have been evicted, so don't reuse an older one.
+            # Generations are timestamps, so a new one is always greater than any before it
+            cache.add(key, time.time_ns(), timeout=None)
+            generations[key] = cache.get(key)
+    return {scope: generations[key] for scope, key in keys.items()}
+
+
+def bump_generations(scopes: Iterable[str]) -> None:
+    """Start a new generation for some scopes, after the current transaction commits
+    Otherwise, a request could cache data from before the change under the new generation"""
+    if not generations_enabled():
+        return
+    keys = {_get_generation_key(scope) for scope in scopes}
+    if not keys:
+        return
+
+    def bump() -> None:
+        generation = time.time_ns()
+        try:
+            caches[CACHE_ALIAS].set_many(dict.fromkeys(keys, generation), timeout=None)
+        except redis.RedisError as e:
+            # Cached responses still expire after the TIMEOUT in settings.CACHES
+            logger.warning(f"Failed to bump generations for {len(keys)} scopes: {e}")
+
+    transaction.on_commit(bump)
@@ -0,0 +1,52 @@
+"""
+Sort keys for RPM epoch / version / release strings, so the database can find the latest
+version of a component with ORDER BY instead of calling rpm.labelCompare on every pair
+
+Comparing two keys byte by byte gives the same result as labelCompare(), which compares the
+epochs, then the versions, then the releases using rpmvercmp(). rpmvercmp() splits each string
+into segments of ASCII letters or digits, which are compared in order. Other characters only
+separate segments, except "~" which sorts before anything, even the end of a string,
+and "^" which sorts after the end of a string, but before any other segment.
+Letters sort before digits, letters compare like strcmp(), and digits compare as numbers.
+
+Each segment is encoded as a type byte, ordered as described above, and then its value:
+letters end with a NUL byte, so shorter strings sort first like strcmp(), and numbers
+without leading zeros are prefixed with their length, so longer numbers sort first.
+"""
+import re
+
+TILDE = b"\x01"
+END = b"\x02"
+CARET = b"\x03"
+ALPHA = b"\x04"
+DIGITS = b"\x05"
+
+# Same as rpmvercmp(), which only treats ASCII letters and digits as alphanumeric
+SEGMENT_RE = re.compile(r"~|\^|[a-zA-Z]+|[0-9]+")
+
+
+def _digits_key(digits: str) -> bytes:
+    digits = digits.lstrip("0")
+    # 2 bytes is plenty, no real version has a number with 65535 digits
+    return DIGITS + len(digits).to_bytes(2, "big") + digits.encode("ascii")
+
+
+def _vercmp_key(value: str) -> bytes:
+    """Return a key that sorts the same way as rpmvercmp() compares some version or release"""
+    key = bytearray()
+    for segment in SEGMENT_RE.findall(value):
+        if segment == "~":
+            key += TILDE
+        elif segment == "^":
+            key += CARET
+        elif segment.isdigit():
+            key += _digits_key(segment)
+        else:
+            key += ALPHA + segment.encode("ascii") + b"\x00"
+    key += END
+    return bytes(key)
+
+
+def get_evr_key(epoch: int, version: str, release: str) -> bytes:
+    """Return a key that sorts the same way as labelCompare() compares (epoch, version, release)"""
+    return _digits_key(str(epoch)) + _vercmp_key(version) + _vercmp_key(release)
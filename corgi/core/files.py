@@ -1,16 +1,88 @@
+import hashlib
 import json
 import logging
+import random
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from itertools import chain, islice
+from typing import IO, Any, Callable, Iterable, Iterator, Optional, Union
 
 import jsonschema
+import redis
 from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import QuerySet
 from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.html import escape
 
+from corgi.core.cache import CACHE_ALIAS, get_generations
 from corgi.core.fixups import cpe_lookup
 from corgi.core.mixins import TimeStampedModel
 
 logger = logging.getLogger(__name__)
 
+NOASSERTION = "NOASSERTION"
+FRAGMENT_PREFIX = "manifest_fragment"
+# The nodes some root component provides, and the upstreams it's generated from
+ComponentLinks = tuple[Iterable[tuple[str, str, str]], tuple[str, ...]]
+
+
+class ManifestFragment(str):
+    """Packages or relationships for one component, already encoded as they are in a manifest"""
+
+
+# A package or relationship in a manifest, or a fragment with some of them
+ManifestItem = Union[dict[str, Any], ManifestFragment]
+
+
+class ComponentLinksCache:
+    """Links for the root components a process has seen, shared by the manifests it writes
+
+    Most of the memory is used by the provided nodes, so the cache is bounded by their total
+    number instead of by the number of components. Least-recently-used components are evicted
+    once there are more than max_nodes provided nodes.
+    """
+
+    def __init__(self, max_nodes: int) -> None:
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self._links: OrderedDict[str, ComponentLinks] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._links)
+
+    def get(self, key: str) -> Optional[ComponentLinks]:
+        links = self._links.get(key)
+        if links is not None:
+            self._links.move_to_end(key)
+        return links
+
+    def set(self, key: str, links: ComponentLinks) -> None:
+        old_links = self._links.pop(key, None)
+        if old_links is not None:
+            self.nodes -= len(old_links[0])
+        self._links[key] = links
+        self.nodes += len(links[0])
+        # Always keep the links just added, even for a component with more than max_nodes
+        while self.nodes > self.max_nodes and len(self._links) > 1:
+            _, (evicted_nodes, _) = self._links.popitem(last=False)
+            self.nodes -= len(evicted_nodes)
+
+
+def provided_relationship(node_purl: str, node_type: str) -> str:
+    """Relate a provided component to its parent component, based on purl and provided node type"""
+    # Purls for Component.Type.CONTAINER_IMAGE, models.py imports this file so we can't use it here
+    if node_purl.startswith("pkg:oci/"):
+        # Arch-specific container is a variant of (arch-independent / noarch) index-container
+        return "VARIANT_OF"
+    elif node_type == "PROVIDES_DEV":
+        return "DEV_DEPENDENCY_OF"
+    else:
+        return "CONTAINED_BY"
+
 
 class ManifestFile(ABC):
     """A data file that represents a generic manifest in machine-readable SPDX / JSON format."""
@@ -19,20 +91,47 @@ class ManifestFile(ABC):
     # v2.2.2/schemas/spdx-schema.json
     SCHEMA_FILE = settings.BASE_DIR / "corgi/web/static/spdx-22-schema.json"
 
-    @property
-    @abstractmethod
-    def file_name(self) -> str:
-        """Name of the Django template, not the final file itself."""
-        pass
+    # Validators for the schema, and for the items in some of its lists, loaded once per process
+    _validators: dict[str, jsonschema.protocols.Validator] = {}
 
     def __init__(self, obj: TimeStampedModel) -> None:
         self.obj = obj  # Model instance to manifest (either Component or Product)
 
+    @abstractmethod
     def render_content(self) -> str:
-        kwargs_for_template = {"obj": self.obj}
-        content = render_to_string(self.file_name, kwargs_for_template)
+        pass
 
-        return self._validate_and_clean(content)
+    @classmethod
+    def _load_schema(cls) -> dict[str, Any]:
+        with open(str(cls.SCHEMA_FILE), "r") as schema_file:
+            return json.load(schema_file)
+
+    @classmethod
+    def get_validator(cls, name: str = "document") -> jsonschema.protocols.Validator:
+        """Return the validator for a whole document, or for each item in its packages
+        or relationships. The schema is only loaded and checked the first time."""
+        if not ManifestFile._validators:
+            schema = cls._load_schema()
+            validator_class = jsonschema.validators.validator_for(schema)
+            validator_class.check_schema(schema)
+            properties = schema["properties"]
+            # The item schemas don't refer to any other part of the schema, so validating each item
+            # against them is the same as validating the whole document at once
+            ManifestFile._validators = {
+                "document": validator_class(schema),
+                "packages": validator_class(properties["packages"]["items"]),
+                "relationships": validator_class(properties["relationships"]["items"]),
+            }
+        return ManifestFile._validators[name]
+
+    @staticmethod
+    def should_validate() -> bool:
+        """Return whether to validate the next manifest, based on the SPDX_VALIDATION_MODE"""
+        if settings.SPDX_VALIDATION_MODE == "off":
+            return False
+        elif settings.SPDX_VALIDATION_MODE == "sampled":
+            return random.random() < settings.SPDX_VALIDATION_SAMPLE_RATE
+        return True
 
     @classmethod
     def _validate_and_clean(cls, content: str) -> str:
@@ -42,10 +141,8 @@ class ManifestFile(ABC):
         # But this may output ugly Unicode like "\u000A",
         # so we convert from JSON back to JSON to get "\n" instead
         content = json.loads(content)
-
-        with open(str(cls.SCHEMA_FILE), "r") as schema_file:
-            schema = json.load(schema_file)
-        jsonschema.validate(content, schema)
+        if cls.should_validate():
+            cls.get_validator().validate(content)
 
         return json.dumps(content, indent=2, sort_keys=True)
 
@@ -56,30 +153,448 @@ class ComponentManifestFile(ManifestFile):
     file_name = "component_manifest.json"  # Name of the Django template, not the final file itself.
     # We use the same template file for all components we want to manifest
 
+    def render_content(self) -> str:
+        kwargs_for_template = {"obj": self.obj}
+        content = render_to_string(self.file_name, kwargs_for_template)
+
+        return self._validate_and_clean(content)
+
 
 class ProductManifestFile(ManifestFile):
-    """A data file that represents a product manifest in machine-readable SPDX / JSON format."""
+    """A data file that represents a product manifest in machine-readable SPDX / JSON format.
 
-    file_name = "product_manifest.json"  # Name of the Django template, not the final file itself.
-    # We use the same template file for all products we want to manifest
-    # We can subclass this to handle different Product subclasses with different properties
-    # Or to handle different ways of generating manifest properties from Product properties
+    Large streams have hundreds of thousands of packages, so the manifest is written one package
+    or relationship at a time as they're read from the database, instead of rendering a template.
+    The output is the same as json.dumps(manifest, indent=2, sort_keys=True) for the whole
+    manifest, and packages and relationships are sorted by UUID so it only changes when the data
+    does. Each package and relationship is validated against the SPDX schema as it's written.
+    """
 
-    def render_content(self, cpe_mapping=True) -> str:
+    # Everything needed to build a package for a component, including its download_url
+    PACKAGE_FIELDS = (
+        "uuid",
+        "type",
+        "namespace",
+        "name",
+        "version",
+        "release",
+        "arch",
+        "nevra",
+        "purl",
+        "filename",
+        "related_url",
+        "copyright_text",
+        "license_concluded_raw",
+        "license_declared_raw",
+    )
+    # Everything needed to look up the provided / upstream components for a component
+    RELATIONSHIP_FIELDS = ("uuid", "type", "software_build")
+    # Change this when the manifest's format changes, so that every manifest is written again
+    # Cached fragments include it too, so they're all built again
+    FINGERPRINT_VERSION = "1"
+    # Fragments for this many components are read from the cache at once
+    FRAGMENT_BATCH_SIZE = 1000
+    _encoder = json.JSONEncoder(indent=2, sort_keys=True)
 
-        components = self.obj.components  # type: ignore[attr-defined]
-        released_components = components.manifest_components()
+    def __init__(
+        self, obj: TimeStampedModel, component_links: Optional[ComponentLinksCache] = None
+    ) -> None:
+        super().__init__(obj)
+        # When given, the provided nodes and upstreams of each released component are kept here,
+        # so streams that share components, and are generated by the same process, share them too
+        self.component_links = component_links
+        # Whether the manifest currently being generated is validated
+        self.validating = False
+
+    def render_content(self, cpe_mapping: bool = True) -> str:
+        return "".join(self.iter_content(cpe_mapping=cpe_mapping))
+
+    def write(self, fh: IO[str], cpe_mapping: bool = True) -> None:
+        """Write the manifest to an open file, without building the whole manifest in memory"""
+        fh.writelines(self.iter_content(cpe_mapping=cpe_mapping))
+
+    def iter_content(self, cpe_mapping: bool = True) -> Iterator[str]:
+        """Encode the manifest as JSON, in chunks, validating each package and relationship
+        as it's generated instead of the whole document at the end"""
+        document: dict[str, Any] = self.get_document()
+        packages = self.iter_packages(self.get_cpes(cpe_mapping))
+        relationships = self.iter_relationships()
+        self.validating = self.should_validate()
+        if self.validating:
+            self.get_validator().validate({**document, "packages": [], "relationships": []})
+            packages = self._iter_validated(packages, self.get_validator("packages"))
+            relationships = self._iter_validated(relationships, self.get_validator("relationships"))
+        document["packages"] = packages
+        document["relationships"] = relationships
+        return self._iter_json(document)
+
+    @property
+    def spdx_id(self) -> str:
+        return f"SPDXRef-{self.obj.uuid}"  # type: ignore[attr-defined]
+
+    def get_fingerprint(self, cpe_mapping: bool = True) -> str:
+        """Return a hash of the data in the manifest, without generating it
+
+        This covers every field of each package, the links between components that the
+        relationships come from, and the product's CPEs, but not the time the manifest was created.
+        So the fingerprint only changes when the manifest's content does.
+        """
+        fingerprint = hashlib.sha256(self.FINGERPRINT_VERSION.encode("utf-8"))
+        released_components = self.get_released_components()
+        distinct_upstreams = self.obj.upstreams_queryset  # type: ignore[attr-defined]
         distinct_provides = self.obj.provides_queryset  # type: ignore[attr-defined]
+        rows = chain(
+            (
+                (
+                    self.obj.uuid,  # type: ignore[attr-defined]
+                    self.obj.name,  # type: ignore[attr-defined]
+                    self.obj.version,  # type: ignore[attr-defined]
+                    self.obj.lifecycle_url,  # type: ignore[attr-defined]
+                    *self.get_cpes(cpe_mapping),
+                ),
+            ),
+            released_components.values_list(*self.PACKAGE_FIELDS).iterator(),
+            distinct_upstreams.values_list(*self.PACKAGE_FIELDS).order_by("uuid").iterator(),
+            distinct_provides.values_list(*self.PACKAGE_FIELDS).order_by("uuid").iterator(),
+            self.iter_provided_nodes(released_components),
+            released_components.values_list("uuid", "upstreams__uuid")
+            .order_by("uuid", "upstreams__uuid")
+            .iterator(),
+        )
+        for row in rows:
+            fingerprint.update(json.dumps(row, default=str).encode("utf-8"))
+            fingerprint.update(b"\n")
+        return fingerprint.hexdigest()
+
+    @staticmethod
+    def iter_provided_nodes(released_components: QuerySet) -> Iterator[tuple[str, ...]]:
+        """Yield the UUID of each released component, with the UUID, purl, and node type of each
+        node it provides, in one query. The relationships are generated from these, so that
+        moving a component between PROVIDES and PROVIDES_DEV changes the manifest's fingerprint
+        """
+        node_model = released_components.model._meta.get_field("cnodes").related_model
+        node_table = node_model._meta.db_table
+        released_uuids = released_components.order_by().values("uuid")
+        try:
+            released_sql, params = released_uuids.query.get_compiler(released_uuids.db).as_sql()
+        except EmptyResultSet:
+            return
+        node_types = tuple(node_type.value for node_type in node_model.PROVIDES_NODE_TYPES)
+        # Same as get_provides_nodes_queryset(), for every released component at once
+        sql = f"""
+            SELECT DISTINCT root.object_id, node.object_id, node.purl, node.type
+            FROM {node_table} AS root
+            INNER JOIN {node_table} AS node ON (
+                node.tree_id = root.tree_id AND node.lft > root.lft AND node.rght < root.rght
+            )
+            WHERE root.object_id IN ({released_sql}) AND node.type IN %s
+            ORDER BY 1, 2, 3, 4
+        """
+        with connections[released_components.db].cursor() as cursor:
+            cursor.execute(sql, (*params, node_types))
+            yield from cursor
+
+    def get_cpes(self, cpe_mapping: bool = True) -> Iterable[str]:
+        if cpe_mapping:
+            return cpe_lookup(self.obj.name)  # type: ignore[attr-defined]
+        return self.obj.cpes  # type: ignore[attr-defined]
+
+    def get_released_components(self) -> QuerySet:
+        components = self.obj.components  # type: ignore[attr-defined]
+        return components.manifest_components(product_model=self.obj).order_by("uuid")
+
+    def get_document(self) -> dict[str, Any]:
+        """Return every field of the manifest except for packages and relationships"""
+        created = timezone.localtime()
+        name = self.obj.name  # type: ignore[attr-defined]
+        return {
+            "creationInfo": {
+                "created": f"{created:%Y-%m-%dT%H:%M}:00Z",
+                "creators": ["Organization: Red Hat Product Security (secalert@redhat.com)"],
+                "licenseListVersion": "3.8",
+            },
+            "dataLicense": "CC0-1.0",
+            "documentDescribes": [self.spdx_id],
+            "documentNamespace": "https://access.redhat.com/security/data/sbom/beta/spdx/"
+            f"{name}-{self.obj.uuid}",  # type: ignore[attr-defined]
+            "name": name,
+            "SPDXID": "SPDXRef-DOCUMENT",
+            "spdxVersion": "SPDX-2.2",
+        }
+
+    def iter_packages(self, cpes: Iterable[str]) -> Iterator[ManifestItem]:
+        """Yield a package for each released component, then for each of their distinct
+        upstreams and provided components, and finally for the product itself"""
+        yield from self.iter_component_packages(self.get_released_components())
+
         distinct_upstreams = self.obj.upstreams_queryset  # type: ignore[attr-defined]
+        yield from self.iter_component_packages(distinct_upstreams.order_by("uuid"), upstream=True)
+
+        distinct_provides = self.obj.provides_queryset  # type: ignore[attr-defined]
+        yield from self.iter_component_packages(distinct_provides.order_by("uuid"))
+
+        yield self.get_product_package(cpes)
+
+    def iter_component_packages(
+        self, components: QuerySet, upstream: bool = False
+    ) -> Iterator[ManifestItem]:
+        """Yield a package for each component, or its cached fragment if MANIFEST_CACHE_ENABLED"""
+        if not settings.MANIFEST_CACHE_ENABLED:
+            for component in components.only(*self.PACKAGE_FIELDS).iterator():
+                yield self.get_component_package(component, upstream=upstream)
+            return
+
+        fragments = self._iter_fragments(
+            components,
+            kind="upstream" if upstream else "package",
+            fields=self.PACKAGE_FIELDS,
+            get_items=lambda component: [self.get_component_package(component, upstream=upstream)],
+        )
+        for _, fragment in fragments:
+            yield fragment
 
-        kwargs_for_template = {
-            "obj": self.obj,
-            "released_components": released_components,
-            "distinct_provides": distinct_provides,
-            "distinct_upstreams": distinct_upstreams,
-            "cpes": cpe_lookup(self.obj.name) if cpe_mapping else self.obj.cpes,  # type: ignore[attr-defined] # noqa
+    @staticmethod
+    def get_component_package(component: Any, upstream: bool = False) -> dict[str, Any]:
+        # Fields without escapejs in the original template were HTML-escaped,
+        # so they're still escaped to keep existing manifests the same
+        package: dict[str, Any] = {
+            "copyrightText": component.copyright_text or NOASSERTION,
+            "downloadLocation": component.download_url or NOASSERTION,
+            "externalRefs": [
+                {
+                    "referenceCategory": "PACKAGE_MANAGER",
+                    "referenceLocator": component.purl,
+                    "referenceType": "purl",
+                }
+            ],
+            "filesAnalyzed": False,
+            "homepage": component.related_url
+            if component.related_url and component.type != component.Type.RPM
+            else NOASSERTION,
+            "licenseComments": "Licensing information is automatically generated "
+            "and may be incomplete or incorrect.",
+            "licenseConcluded": escape(component.license_concluded) or NOASSERTION,
+            "licenseDeclared": escape(component.license_declared) or NOASSERTION,
+            "name": component.name,
+            "packageFileName": escape(component.filename) or NOASSERTION,
+            "SPDXID": f"SPDXRef-{component.uuid}",
+            # Upstream components aren't supplied by Red Hat
+            "supplier": NOASSERTION if upstream else "Organization: Red Hat",
+            "versionInfo": component.nevra,
         }
+        if not upstream:
+            package["originator"] = NOASSERTION
+        return package
 
-        content = render_to_string(self.file_name, kwargs_for_template)
+    def get_product_package(self, cpes: Iterable[str]) -> dict[str, Any]:
+        package: dict[str, Any] = {
+            "copyrightText": NOASSERTION,
+            "downloadLocation": NOASSERTION,
+            "filesAnalyzed": False,
+            "homepage": escape(self.obj.lifecycle_url)  # type: ignore[attr-defined]
+            or "https://www.redhat.com/",
+            "licenseComments": "Licensing information is provided for individual components "
+            "only at this time.",
+            "licenseConcluded": NOASSERTION,
+            "licenseDeclared": NOASSERTION,
+            "name": self.obj.name,  # type: ignore[attr-defined]
+            "packageFileName": NOASSERTION,
+            "SPDXID": self.spdx_id,
+            "supplier": "Organization: Red Hat",
+            "versionInfo": escape(self.obj.version),  # type: ignore[attr-defined]
+        }
+        external_refs = [
+            {
+                "referenceCategory": "SECURITY",
+                "referenceLocator": escape(cpe),
+                "referenceType": "cpe22Type",
+            }
+            for cpe in cpes
+        ]
+        if external_refs:
+            package["externalRefs"] = external_refs
+        return package
 
-        return self._validate_and_clean(content)
+    def iter_relationships(self) -> Iterator[ManifestItem]:
+        """Yield the relationships of each released component to the components it provides
+        and the upstreams it's generated from, and to the product itself"""
+        released_components = self.get_released_components()
+        if settings.MANIFEST_CACHE_ENABLED:
+            fragments = self._iter_fragments(
+                released_components,
+                kind="relationships",
+                fields=self.RELATIONSHIP_FIELDS,
+                get_items=self.get_component_relationships,
+            )
+            for component_uuid, fragment in fragments:
+                if fragment:
+                    yield fragment
+                yield self.get_relationship(f"SPDXRef-{component_uuid}", "PACKAGE_OF", self.spdx_id)
+        else:
+            released_components = released_components.only(*self.RELATIONSHIP_FIELDS)
+            for component in released_components.iterator():
+                yield from self.get_component_relationships(component)
+                yield self.get_relationship(f"SPDXRef-{component.uuid}", "PACKAGE_OF", self.spdx_id)
+        # Document describes stream being manifested
+        yield self.get_relationship("SPDXRef-DOCUMENT", "DESCRIBES", self.spdx_id)
+
+    def get_component_relationships(self, component: Any) -> list[dict[str, str]]:
+        """Return the relationships of some released component to the components it provides
+        and the upstreams it's generated from. These are the same in every stream."""
+        component_id = f"SPDXRef-{component.uuid}"
+        provides_nodes, upstream_ids = self.get_component_links(component)
+        # subcomponent is built from, or contained in, component
+        relationships = [
+            self.get_relationship(
+                f"SPDXRef-{node_id}", provided_relationship(node_purl, node_type), component_id
+            )
+            for node_purl, node_type, node_id in provides_nodes
+        ]
+        relationships.extend(
+            self.get_relationship(f"SPDXRef-{node_id}", "GENERATES", component_id)
+            for node_id in upstream_ids
+        )
+        return relationships
+
+    def get_component_links(self, component: Any) -> ComponentLinks:
+        """Return the (purl, type, UUID) of each node that some root component provides,
+        and the UUIDs of the upstreams it's generated from"""
+        key = str(component.uuid)
+        if self.component_links is not None:
+            links = self.component_links.get(key)
+            if links is not None:
+                return links
+
+        provides_nodes = component.get_provides_nodes_queryset()
+        upstream_ids: tuple[str, ...] = ()
+        # RPM upstream data is human-generated and unreliable
+        if component.type != component.Type.RPM:
+            # Upstreams of the root index container. Arch-specific containers have the same
+            # upstreams, so no need to report these separately
+            upstream_ids = tuple(sorted(component.get_upstreams_pks()))
+        if self.component_links is None:
+            return provides_nodes, upstream_ids
+        links = (tuple(provides_nodes), upstream_ids)
+        self.component_links.set(key, links)
+        return links
+
+    @staticmethod
+    def get_relationship(
+        element_id: str, relationship_type: str, related_id: str
+    ) -> dict[str, str]:
+        return {
+            "relatedSpdxElement": related_id,
+            "relationshipType": relationship_type,
+            "spdxElementId": element_id,
+        }
+
+    def _iter_fragments(
+        self,
+        components: QuerySet,
+        kind: str,
+        fields: Iterable[str],
+        get_items: Callable[[Any], list[dict[str, Any]]],
+    ) -> Iterator[tuple[str, ManifestFragment]]:
+        """Yield the UUID of each component, and its packages or relationships as a fragment
+
+        Fragments are cached for each component and its current generation, which is bumped when
+        the component or its taxonomy changes, so streams with the same components share them.
+        Only the components in each batch without a current fragment are read from the database.
+        Fragments are validated when they're built, if the manifest they're built for is.
+        """
+        cache = caches[CACHE_ALIAS]
+        validator_name = "relationships" if kind == "relationships" else "packages"
+        component_uuids = (str(pk) for pk in components.values_list("uuid", flat=True).iterator())
+        while batch := list(islice(component_uuids, self.FRAGMENT_BATCH_SIZE)):
+            try:
+                generations = get_generations(f"component:{pk}" for pk in batch)
+                keys = {
+                    pk: f"{FRAGMENT_PREFIX}:{self.FINGERPRINT_VERSION}:{kind}:{pk}:"
+                    f"{generations[f'component:{pk}']}"
+                    for pk in batch
+                }
+                cached = cache.get_many(keys.values())
+            except redis.RedisError as e:
+                # Still generate manifests if the cache is down
+                logger.warning(f"Failed to get cached manifest fragments: {e}")
+                keys, cached = {}, {}
+
+            fragments = {
+                pk: ManifestFragment(cached[keys[pk]]) for pk in keys if keys[pk] in cached
+            }
+            missing = [pk for pk in batch if pk not in fragments]
+            if missing:
+                # Look up the components by UUID alone, since querysets like provides_queryset
+                # already filter on every UUID in the stream, which is slow to send for each batch
+                missing_components = (
+                    components.model.objects.filter(uuid__in=missing)
+                    .only(*fields)
+                    .using("read_only")
+                )
+                built = {
+                    str(component.uuid): self._encode_fragment(get_items(component), validator_name)
+                    for component in missing_components
+                }
+                fragments.update(built)
+                try:
+                    cache.set_many({keys[pk]: str(built[pk]) for pk in built if pk in keys})
+                except redis.RedisError as e:
+                    logger.warning(f"Failed to cache {len(built)} manifest fragments: {e}")
+
+            for pk in batch:
+                # The component may have been removed from the stream since the batch was read
+                if pk in fragments:
+                    yield pk, fragments[pk]
+
+    def _encode_fragment(
+        self, items: list[dict[str, Any]], validator_name: str
+    ) -> ManifestFragment:
+        """Encode some packages or relationships as they are in the manifest's lists"""
+        if self.validating:
+            validator = self.get_validator(validator_name)
+            for item in items:
+                validator.validate(item)
+        encoded_items = (self._indent(self._encoder.encode(item), level=2) for item in items)
+        return ManifestFragment(",\n    ".join(encoded_items))
+
+    @staticmethod
+    def _iter_validated(
+        items: Iterator[ManifestItem], validator: jsonschema.protocols.Validator
+    ) -> Iterator[ManifestItem]:
+        for item in items:
+            # Fragments were validated when they were built
+            if not isinstance(item, ManifestFragment):
+                validator.validate(item)
+            yield item
+
+    @classmethod
+    def _iter_json(cls, document: dict[str, Any]) -> Iterator[str]:
+        """Encode a document like json.dumps(document, indent=2, sort_keys=True) does,
+        except that iterators are encoded one item at a time, as lists"""
+        encoder = cls._encoder
+        yield "{"
+        for index, key in enumerate(sorted(document)):
+            separator = "," if index else ""
+            yield f"{separator}\n  {encoder.encode(key)}: "
+            value = document[key]
+            if isinstance(value, Iterator):
+                yield from cls._iter_json_list(value, encoder)
+            else:
+                yield cls._indent(encoder.encode(value), level=1)
+        yield "\n}"
+
+    @classmethod
+    def _iter_json_list(cls, items: Iterator[Any], encoder: json.JSONEncoder) -> Iterator[str]:
+        separator = "["
+        for item in items:
+            if not isinstance(item, ManifestFragment):
+                item = cls._indent(encoder.encode(item), level=2)
+            yield f"{separator}\n    {item}"
+            separator = ","
+        yield "[]" if separator == "[" else "\n  ]"
+
+    @staticmethod
+    def _indent(content: str, level: int) -> str:
+        """Indent encoded JSON that's nested some levels deep in a document"""
+        # Encoded strings never have literal newlines, so only the whitespace changes
+        return content.replace("\n", "\n" + "  " * level)
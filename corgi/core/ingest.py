@@ -0,0 +1,416 @@
+"""
+Bulk ingestion of component trees. Collectors describe a build's components and the nodes
+that link them in a ComponentTree, which is then written with a few INSERT ... ON CONFLICT
+statements instead of one update_or_create() and get_or_create() call per component and node
+"""
+import logging
+from typing import Any, Optional
+
+from django.db import connection, models, transaction
+
+from corgi.core.instrumentation import span
+from corgi.core.models import Component, ComponentNode
+
+logger = logging.getLogger(__name__)
+
+# Postgres allows at most 65535 parameters per statement
+# Components have ~25 columns, so this keeps each statement well under the limit
+BATCH_SIZE = 1000
+
+# Same fields, in the same order, as the "unique_components" constraint
+ComponentKey = tuple[str, str, str, str, str]
+
+# Fields that ingestion sets on existing components. Other fields like license_concluded_raw
+# are written by other tasks, e.g. OpenLCS, and must not be overwritten by a concurrent ingestion
+INGESTED_FIELDS = (
+    "description",
+    "el_match",
+    "epoch",
+    "evr_key",
+    "filename",
+    "last_changed",
+    "license_declared_raw",
+    "meta_attr",
+    "namespace",
+    "nevra",
+    "nvr",
+    "purl",
+    "related_url",
+    "software_build",
+)
+# Fields compared when reconciling, to decide if an existing component needs to be written
+# last_changed is always set when writing, so it would never match
+RECONCILED_FIELDS = tuple(name for name in INGESTED_FIELDS if name != "last_changed")
+
+
+class ComponentTree:
+    """Components and ComponentNodes for some build, collected in memory and written in bulk
+
+    Components are identified by the same fields that update_or_create() used,
+    and their changes are applied in the order they were added. Nodes are identified by
+    their type and parent, like get_or_create() in save_node(). New nodes are appended
+    as the last child of their parent, like MPTT does. So saving a tree has the same result
+    as saving each component and node one at a time, just without the round-trips.
+
+    When reprocessing a build, save(reconcile=True) compares this tree with the stored tree.
+    Only components that changed are written, and stored nodes that are no longer
+    in this tree are deleted, so saving an unchanged tree writes almost nothing.
+    """
+
+    def __init__(self) -> None:
+        # Each component's changes, in the order they were added
+        self.changes: dict[ComponentKey, list[dict[str, Any]]] = {}
+        # The saved Component instances, populated by save()
+        self.components: dict[ComponentKey, Component] = {}
+        self.roots: dict[tuple[str, ComponentKey], dict[str, Any]] = {}
+        # What save() changed in the DB
+        self.summary = {
+            "components_created": 0,
+            "components_updated": 0,
+            "components_unchanged": 0,
+            "nodes_created": 0,
+            "nodes_deleted": 0,
+        }
+
+    def add_component(
+        self,
+        component_type: str,
+        name: str,
+        version: str = "",
+        release: str = "",
+        arch: str = "noarch",
+        defaults: Optional[dict[str, Any]] = None,
+        meta: Optional[dict[str, Any]] = None,
+        license_declared_raw: str = "",
+    ) -> ComponentKey:
+        """Add or update a component, returning a key that can be used to add its nodes
+
+        defaults are set on the component, like update_or_create(). Any meta keys
+        are added to its existing meta_attr, and a non-empty license_declared_raw
+        is set like set_license_declared_safely()"""
+        key = (name, component_type, arch, version, release)
+        self.changes.setdefault(key, []).append(
+            {
+                "defaults": defaults or {},
+                "meta": meta or {},
+                "license_declared_raw": license_declared_raw,
+            }
+        )
+        return key
+
+    def add_node(
+        self, node_type: str, parent: Optional[dict[str, Any]], key: ComponentKey
+    ) -> dict[str, Any]:
+        """Add a node for a component under some parent node, or as a root node if parent is None.
+        Returns the existing node if this component was already added with the same type"""
+        siblings = parent["children"] if parent else self.roots
+        node = siblings.get((node_type, key))
+        if not node:
+            node = {"type": node_type, "key": key, "children": {}}
+            siblings[(node_type, key)] = node
+        return node
+
+    def save(self, reconcile: bool = False) -> list[ComponentNode]:
+        """Write all components, then all nodes, and return the saved root nodes
+
+        If reconcile is True, components whose ingested fields are unchanged aren't written,
+        and stored nodes that aren't in this tree are deleted, see _remove_stale_nodes()"""
+        self._save_components(reconcile)
+        return [self._save_nodes(root, reconcile) for root in self.roots.values()]
+
+    @staticmethod
+    def _apply_change(component: Component, change: dict[str, Any]) -> None:
+        for field_name, value in change["defaults"].items():
+            setattr(component, field_name, value)
+        if change["meta"]:
+            component.meta_attr = component.meta_attr | change["meta"]
+        license_declared_raw = change["license_declared_raw"]
+        if license_declared_raw and license_declared_raw != component.license_declared_raw:
+            component.license_declared_raw = license_declared_raw
+
+    @span("save_components")
+    def _save_components(self, reconcile: bool) -> None:
+        # Sort the keys so concurrent ingestions of overlapping trees
+        # always lock the same component rows in the same order, and can't deadlock
+        keys = sorted(self.changes)
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start : start + BATCH_SIZE]
+            existing = {
+                (c.name, c.type, c.arch, c.version, c.release): c
+                for c in Component.objects.raw(
+                    f"SELECT * FROM {Component._meta.db_table} "
+                    "WHERE (name, type, arch, version, release) IN %s",
+                    [tuple(batch)],
+                )
+            }
+            components = []
+            # Existing components whose namespace changed, which is also copied to their nodes
+            namespace_changed_pks = []
+            for key in batch:
+                component = existing.get(key)
+                if component:
+                    old_values = _get_reconciled_values(component)
+                    old_namespace = component.namespace
+                else:
+                    name, component_type, arch, version, release = key
+                    component = Component(
+                        name=name, type=component_type, arch=arch, version=version, release=release
+                    )
+                for change in self.changes[key]:
+                    self._apply_change(component, change)
+                # Same as Component.save(), but we don't want to call save() for every component
+                component.set_computed_fields()
+                self.components[key] = component
+                if not component._state.adding:
+                    if reconcile and _get_reconciled_values(component) == old_values:
+                        self.summary["components_unchanged"] += 1
+                        continue
+                    self.summary["components_updated"] += 1
+                    if component.namespace != old_namespace:
+                        namespace_changed_pks.append(component.pk)
+                else:
+                    self.summary["components_created"] += 1
+                components.append(component)
+            if components:
+                self._upsert_components(components)
+            if namespace_changed_pks:
+                self._update_node_namespaces(namespace_changed_pks)
+
+    def _upsert_components(self, components: list[Component]) -> None:
+        """INSERT new components and UPDATE existing components in a single statement"""
+        columns = (Component._meta.get_field(name).column for name in INGESTED_FIELDS)
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns)
+        sql, params = _insert_sql(Component, components)
+        sql = (
+            f"{sql} ON CONFLICT ON CONSTRAINT unique_components DO UPDATE SET {updates} "
+            "RETURNING uuid, name, type, arch, version, release"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            # Another task may have inserted the same component since we looked it up
+            # In that case, the existing row was updated, so use its UUID instead of ours
+            for pk, *key in cursor.fetchall():
+                component = self.components[tuple(key)]  # type: ignore[index]
+                component.pk = pk
+                component._state.adding = False
+
+    @staticmethod
+    def _update_node_namespaces(component_pks: list[str]) -> None:
+        """Copy the new namespace of some components to their existing nodes"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {ComponentNode._meta.db_table} AS node "
+                "SET namespace = component.namespace "
+                f"FROM {Component._meta.db_table} AS component "
+                "WHERE node.component_id = component.uuid AND component.uuid = ANY(%s) "
+                "AND node.namespace <> component.namespace",
+                [component_pks],
+            )
+
+    @span("save_nodes")
+    def _save_nodes(self, root: dict[str, Any], reconcile: bool) -> ComponentNode:
+        """Merge the nodes under some root into its existing tree,
+        then compute the nested-set values for the whole tree in one pass"""
+        root_component = self.components[root["key"]]
+        with transaction.atomic():
+            root_node, _ = ComponentNode.objects.get_or_create(
+                type=root["type"],
+                parent=None,
+                purl=root_component.purl,
+                defaults={"obj": root_component},
+            )
+            # Lock the whole tree, so any concurrent MPTT inserts
+            # wait until we're done renumbering it
+            existing_nodes = (
+                ComponentNode.objects.filter(tree_id=root_node.tree_id)
+                .order_by("lft")
+                .select_for_update()
+                .values_list("pk", "parent_id", "type", "purl", "lft", "rght")
+            )
+            db_nodes: dict[int, dict[str, Any]] = {}
+            for pk, parent_id, node_type, purl, lft, rght in existing_nodes:
+                db_node = {
+                    "pk": pk,
+                    "type": node_type,
+                    "lft": lft,
+                    "rght": rght,
+                    "children": {},
+                    "matched": False,
+                }
+                db_nodes[pk] = db_node
+                # Ordering by lft means parents are always seen before their children
+                if parent_id is not None:
+                    db_nodes[parent_id]["children"][(node_type, purl)] = db_node
+
+            new_nodes = self._merge_nodes(root, db_nodes[root_node.pk])
+            if reconcile:
+                stale_pks = self._remove_stale_nodes(db_nodes[root_node.pk])
+                for pk in stale_pks:
+                    del db_nodes[pk]
+                self._delete_nodes(stale_pks)
+            # Computing and writing the nested-set values replaces MPTT's own tree updates
+            with span("mptt"):
+                self._number_nodes(db_nodes[root_node.pk])
+            self._insert_nodes(new_nodes, root_node.tree_id)
+            self.summary["nodes_created"] += len(new_nodes)
+
+            changed_nodes = [
+                (db_node["pk"], db_node["new_lft"], db_node["new_rght"])
+                for db_node in db_nodes.values()
+                if (db_node["lft"], db_node["rght"]) != (db_node["new_lft"], db_node["new_rght"])
+            ]
+            with span("mptt"):
+                for start in range(0, len(changed_nodes), BATCH_SIZE):
+                    batch = changed_nodes[start : start + BATCH_SIZE]
+                    values = ", ".join(["(%s, %s, %s)"] * len(batch))
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            f"UPDATE {ComponentNode._meta.db_table} AS node "
+                            "SET lft = new.lft, rght = new.rght "
+                            f"FROM (VALUES {values}) AS new (id, lft, rght) "
+                            "WHERE node.id = new.id",
+                            [value for row in batch for value in row],
+                        )
+
+        # Callers use the root node to find its descendants, so it must be up-to-date
+        root_node.rght = db_nodes[root_node.pk]["new_rght"]
+        return root_node
+
+    def _merge_nodes(
+        self, root: dict[str, Any], db_root: dict[str, Any]
+    ) -> list[tuple[dict[str, Any], dict[str, Any]]]:
+        """Add new nodes to the existing tree, matching children by their type and purl
+        Returns a list of (new node, parent node) pairs, parents always before their children"""
+        new_nodes = []
+        db_root["matched"] = True
+        stack = [(root, db_root)]
+        while stack:
+            node, db_node = stack.pop()
+            matched_children = []
+            for child in node["children"].values():
+                component = self.components[child["key"]]
+                child_key = (child["type"], component.purl)
+                db_child = db_node["children"].get(child_key)
+                if db_child:
+                    db_child["matched"] = True
+                if not db_child:
+                    db_child = {
+                        "pk": None,
+                        "type": child["type"],
+                        "component": component,
+                        "children": {},
+                        "matched": True,
+                    }
+                    db_node["children"][child_key] = db_child
+                    new_nodes.append((db_child, db_node))
+                matched_children.append((child, db_child))
+            # Reversed so that children are merged in the order they were added
+            stack.extend(reversed(matched_children))
+        return new_nodes
+
+    @staticmethod
+    def _remove_stale_nodes(db_root: dict[str, Any]) -> list[int]:
+        """Detach stored nodes that weren't matched by _merge_nodes(), and their descendants,
+        from the tree. Returns the IDs of all the detached nodes so they can be deleted
+
+        PROVIDES nodes directly under the root are always kept. Other tasks add nodes there,
+        e.g. components found by software composition analysis, or the RPMs in a module."""
+        stale_pks = []
+        stack = [(db_root, True)]
+        while stack:
+            db_node, matched = stack.pop()
+            if not matched:
+                stale_pks.append(db_node["pk"])
+            for child_key, child in tuple(db_node["children"].items()):
+                if not matched:
+                    stack.append((child, False))
+                elif child["matched"]:
+                    stack.append((child, True))
+                elif db_node is db_root and child["type"] in ComponentNode.PROVIDES_NODE_TYPES:
+                    continue
+                else:
+                    del db_node["children"][child_key]
+                    stack.append((child, False))
+        return stale_pks
+
+    def _delete_nodes(self, pks: list[int]) -> None:
+        for start in range(0, len(pks), BATCH_SIZE):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {ComponentNode._meta.db_table} WHERE id = ANY(%s)",
+                    [pks[start : start + BATCH_SIZE]],
+                )
+        self.summary["nodes_deleted"] += len(pks)
+
+    @staticmethod
+    def _number_nodes(db_root: dict[str, Any]) -> None:
+        """Set new_lft, new_rght, and level for every node with a single depth-first walk"""
+        counter = 0
+        stack: list[tuple[dict[str, Any], int, bool]] = [(db_root, 0, False)]
+        while stack:
+            db_node, level, visited = stack.pop()
+            counter += 1
+            if visited:
+                db_node["new_rght"] = counter
+                continue
+            db_node["new_lft"] = counter
+            db_node["level"] = level
+            stack.append((db_node, level, True))
+            # Reversed so that the first child is visited first
+            for child in reversed(db_node["children"].values()):
+                stack.append((child, level + 1, False))
+
+    @staticmethod
+    def _insert_nodes(new_nodes: list[tuple[dict[str, Any], dict[str, Any]]], tree_id: int) -> None:
+        if not new_nodes:
+            return
+        # Reserve IDs for all the new nodes up front, so children can refer to their parents
+        # in the same INSERT statement
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [ComponentNode._meta.db_table, len(new_nodes)],
+            )
+            for (db_node, _), (pk,) in zip(new_nodes, cursor.fetchall()):
+                db_node["pk"] = pk
+
+        nodes = []
+        for db_node, db_parent in new_nodes:
+            node = ComponentNode(
+                pk=db_node["pk"],
+                parent_id=db_parent["pk"],
+                type=db_node["type"],
+                tree_id=tree_id,
+                lft=db_node["new_lft"],
+                rght=db_node["new_rght"],
+                level=db_node["level"],
+            )
+            node.set_component_fields(db_node["component"])
+            nodes.append(node)
+        for start in range(0, len(nodes), BATCH_SIZE):
+            sql, params = _insert_sql(ComponentNode, nodes[start : start + BATCH_SIZE])
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+
+
+def _get_reconciled_values(component: Component) -> tuple[Any, ...]:
+    # Use attnames so software_build is compared by its ID, without loading the build
+    values = (
+        getattr(component, Component._meta.get_field(name).attname) for name in RECONCILED_FIELDS
+    )
+    # Binary fields are loaded as memoryviews, which are never equal to the bytes we compute
+    return tuple(bytes(value) if isinstance(value, memoryview) else value for value in values)
+
+
+def _insert_sql(model: type[models.Model], objs: list[Any]) -> tuple[str, list[Any]]:
+    """Build a multi-row INSERT statement for some unsaved model instances"""
+    fields = model._meta.concrete_fields
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    row = f"({', '.join(['%s'] * len(fields))})"
+    params = [
+        field.get_db_prep_save(field.pre_save(obj, obj._state.adding), connection)
+        for obj in objs
+        for field in fields
+    ]
+    sql = f"INSERT INTO {model._meta.db_table} ({columns}) VALUES {', '.join([row] * len(objs))}"
+    return sql, params
@@ -0,0 +1,213 @@
+"""
+Lightweight per-stage timing for Celery tasks, to find out where the time in a slow task went.
+Code marks the stages of a task with span("name"), and calls to other services with
+external_call("service"). Each span records its wall time, the number and duration of DB queries,
+and the time spent waiting on other services. Spans can be nested, and the totals for a span
+include any spans nested inside it. Outside a task, span() and external_call() do nothing.
+
+Every task logs its per-stage breakdown when it finishes. When TASK_METRICS_ENABLED is set,
+each task's stage durations are also added to histograms in Redis, which are shared by all
+workers and exposed in the Prometheus text format by render_metrics() / the api/metrics endpoint.
+"""
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+import redis
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# The whole task is recorded as a stage with this name
+TASK_STAGE = "total"
+METRICS_KEY = "corgi-task-metrics"
+# Upper bounds, in seconds, of the histogram buckets for task and stage durations
+# The longest is CELERY_LONGEST_SOFT_TIME_LIMIT, anything slower goes in the +Inf bucket
+BUCKETS = ("0.1", "0.5", "1", "5", "10", "30", "60", "300", "900", "2400", "+Inf")
+STAGE_FIELDS = ("calls", "wall_time", "db_queries", "db_time", "external_calls", "external_time")
+
+_local = threading.local()
+
+
+class TaskProfile:
+    """Stage timings for one run of some task"""
+
+    def __init__(self, task_name: str) -> None:
+        self.task_name = task_name
+        self.stages: dict[str, dict[str, float]] = {}
+        # Names of the spans that are running, outermost first
+        self.active = [TASK_STAGE]
+        self.start = time.monotonic()
+
+    def get_stage(self, name: str) -> dict[str, float]:
+        if name not in self.stages:
+            self.stages[name] = dict.fromkeys(STAGE_FIELDS, 0)
+        return self.stages[name]
+
+    def add(self, field: str, value: float) -> None:
+        """Add a value to every running span, so the totals include nested spans"""
+        for name in set(self.active):
+            self.get_stage(name)[field] += value
+
+    def execute_wrapper(
+        self, execute: Callable, sql: str, params: Any, many: bool, context: dict[str, Any]
+    ) -> Any:
+        """Time every DB query, see Django's connection.execute_wrapper()"""
+        if get_profile() is not self:
+            # Queries from eager tasks running inside this one are recorded by their own profile
+            return execute(sql, params, many, context)
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add("db_queries", 1)
+            self.add("db_time", time.monotonic() - start)
+
+    def as_dict(self) -> dict[str, dict[str, float]]:
+        return {
+            name: {field: round(value, 3) for field, value in stage.items()}
+            for name, stage in self.stages.items()
+        }
+
+
+def get_profile() -> Optional[TaskProfile]:
+    """Return the profile for the task that's running in this thread, if any"""
+    profiles = getattr(_local, "profiles", None)
+    return profiles[-1] if profiles else None
+
+
+def start_task(task_name: str) -> TaskProfile:
+    """Start recording stages for a task, until finish_task() is called"""
+    profile = TaskProfile(task_name)
+    if not hasattr(_local, "profiles"):
+        _local.profiles = []
+    # Eager tasks can run inside other tasks, so each has its own profile
+    _local.profiles.append(profile)
+    for connection in connections.all():
+        connection.execute_wrappers.append(profile.execute_wrapper)
+    return profile
+
+
+def finish_task() -> Optional[TaskProfile]:
+    """Stop recording stages for the current task, then log and save its timings"""
+    profile = get_profile()
+    if not profile:
+        return None
+    _local.profiles.pop()
+    for connection in connections.all():
+        if profile.execute_wrapper in connection.execute_wrappers:
+            connection.execute_wrappers.remove(profile.execute_wrapper)
+
+    stage = profile.get_stage(TASK_STAGE)
+    stage["calls"] = 1
+    stage["wall_time"] = time.monotonic() - profile.start
+    logger.info(f"Task {profile.task_name} stages: {json.dumps(profile.as_dict())}")
+    if settings.TASK_METRICS_ENABLED:
+        try:
+            save_metrics(profile)
+        except redis.RedisError as e:
+            # Metrics are nice to have, but they shouldn't break the task that's being measured
+            logger.warning(f"Failed to save metrics for task {profile.task_name}: {e}")
+    return profile
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Record the time and queries for some stage of the current task
+    Can also be used as a decorator, to record every call to some function"""
+    profile = get_profile()
+    if not profile:
+        yield
+        return
+
+    # Only the outermost span counts, if a span with the same name is nested inside itself
+    outermost = name not in profile.active
+    profile.active.append(name)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        profile.active.pop()
+        if outermost:
+            stage = profile.get_stage(name)
+            stage["calls"] += 1
+            stage["wall_time"] += time.monotonic() - start
+
+
+@contextmanager
+def external_call(service: str) -> Iterator[None]:
+    """Record the time the current task spends waiting on some other service, like Brew
+    Each service is also recorded as a stage of its own"""
+    profile = get_profile()
+    if not profile:
+        yield
+        return
+
+    with span(service):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            profile.add("external_calls", 1)
+            profile.add("external_time", time.monotonic() - start)
+
+
+def get_redis() -> redis.Redis:
+    return redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+
+def save_metrics(profile: TaskProfile) -> None:
+    """Add some task's stage timings to the histograms in Redis, in a single round-trip
+    Each hash field is "<labels>|<name>", e.g. 'task="...",stage="total"|bucket|0.5'"""
+    with get_redis().pipeline(transaction=False) as pipe:
+        for name, stage in profile.stages.items():
+            labels = f'task="{profile.task_name}",stage="{name}"'
+            bucket = next(
+                bucket
+                for bucket in BUCKETS
+                if bucket == "+Inf" or stage["wall_time"] <= float(bucket)
+            )
+            pipe.hincrby(METRICS_KEY, f"{labels}|bucket|{bucket}", 1)
+            pipe.hincrby(METRICS_KEY, f"{labels}|count", 1)
+            pipe.hincrbyfloat(METRICS_KEY, f"{labels}|sum", stage["wall_time"])
+            pipe.hincrby(METRICS_KEY, f"{labels}|db_queries", int(stage["db_queries"]))
+            pipe.hincrbyfloat(METRICS_KEY, f"{labels}|db_time", stage["db_time"])
+            pipe.hincrbyfloat(METRICS_KEY, f"{labels}|external_time", stage["external_time"])
+        pipe.execute()
+
+
+def render_metrics() -> str:
+    """Render the saved task metrics in the Prometheus text format"""
+    metrics: dict[str, dict[str, float]] = defaultdict(dict)
+    for field, value in get_redis().hgetall(METRICS_KEY).items():
+        labels, name = field.decode().split("|", maxsplit=1)
+        metrics[labels][name] = float(value)
+
+    lines = [
+        "# HELP corgi_task_stage_seconds Wall time for each stage of a Celery task",
+        "# TYPE corgi_task_stage_seconds histogram",
+    ]
+    for labels, values in sorted(metrics.items()):
+        count = 0
+        for bucket in BUCKETS:
+            count += int(values.get(f"bucket|{bucket}", 0))
+            lines.append(f'corgi_task_stage_seconds_bucket{{{labels},le="{bucket}"}} {count}')
+        lines.append(f"corgi_task_stage_seconds_sum{{{labels}}} {values.get('sum', 0)}")
+        lines.append(f"corgi_task_stage_seconds_count{{{labels}}} {int(values.get('count', 0))}")
+
+    for name, metric, description in (
+        ("db_queries", "db_queries", "DB queries made in each stage of a Celery task"),
+        ("db_time", "db_seconds", "Time spent on DB queries in each stage of a Celery task"),
+        ("external_time", "external_seconds", "Time spent waiting on other services in each stage"),
+    ):
+        metric = f"corgi_task_stage_{metric}_total"
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} counter")
+        for labels, values in sorted(metrics.items()):
+            lines.append(f"{metric}{{{labels}}} {values.get(name, 0)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,24 @@
+"""
+Custom lookups for model fields. Registering a lookup changes every field of that type,
+so this module is imported by corgi/core/models.py, and the lookups exist wherever models do.
+"""
+from django.db.models import CharField, JSONField, TextField
+from django.db.models.lookups import IContains
+
+
+@CharField.register_lookup
+@TextField.register_lookup
+@JSONField.register_lookup
+class ILikeContains(IContains):
+    """Case-insensitive "contains" using ILIKE, so Postgres can use a pg_trgm index on the column
+    The builtin icontains compares UPPER() of both sides, which only an index on UPPER() can serve
+    """
+
+    lookup_name = "ilike_contains"
+
+    def as_sql(self, compiler, connection):
+        lhs_sql, params = self.process_lhs(compiler, connection)
+        rhs_sql, rhs_params = self.process_rhs(compiler, connection)
+        params.extend(rhs_params)
+        # Matches the ::text cast in the trigram index on JSON fields
+        return f"{lhs_sql}::text ILIKE {rhs_sql}", params
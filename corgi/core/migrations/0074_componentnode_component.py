@@ -0,0 +1,59 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0073_fix_component_upstreams_and_software_builds"),
+    ]
+
+    operations = [
+        # Adding a column with a constant default only updates the catalog in Postgres 11+
+        # so none of these rewrite or lock core_componentnode for long
+        migrations.AddField(
+            model_name="componentnode",
+            name="component_type",
+            field=models.CharField(default="", max_length=20),
+        ),
+        migrations.AddField(
+            model_name="componentnode",
+            name="namespace",
+            field=models.CharField(default="", max_length=20),
+        ),
+        migrations.AddField(
+            model_name="componentnode",
+            name="arch",
+            field=models.CharField(default="", max_length=1024),
+        ),
+        # Django would validate the new foreign key against every existing row
+        # while holding a lock that blocks writes, so add it as NOT VALID instead
+        # and validate it in the next migration, after the data has been backfilled
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name="componentnode",
+                    name="component",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="cnodes",
+                        to="core.component",
+                    ),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    sql=[
+                        "ALTER TABLE core_componentnode ADD COLUMN component_id uuid NULL",
+                        "ALTER TABLE core_componentnode "
+                        "ADD CONSTRAINT core_componentnode_component_id_fk "
+                        "FOREIGN KEY (component_id) REFERENCES core_component (uuid) "
+                        "DEFERRABLE INITIALLY DEFERRED NOT VALID",
+                    ],
+                    reverse_sql=["ALTER TABLE core_componentnode DROP COLUMN component_id"],
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,69 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+# Each chunk is committed separately, so only these rows are locked at any one time
+BATCH_SIZE = 10000
+
+
+def backfill_component_fields(apps, schema_editor):
+    """Copy each node's linked component and its denormalized fields onto the node"""
+    ComponentNode = apps.get_model("core", "ComponentNode")
+    bounds = ComponentNode.objects.aggregate(models.Min("id"), models.Max("id"))
+    if bounds["id__min"] is None:
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        for start in range(bounds["id__min"], bounds["id__max"] + 1, BATCH_SIZE):
+            # Nodes created in the meantime by code that hasn't been deployed yet
+            # may still be missing these values, so always check component_id
+            cursor.execute(
+                "UPDATE core_componentnode AS node "
+                "SET component_id = component.uuid, component_type = component.type, "
+                "namespace = component.namespace, arch = component.arch "
+                "FROM core_component AS component "
+                "WHERE component.uuid = node.object_id "
+                "AND node.id >= %s AND node.id < %s AND node.component_id IS NULL",
+                [start, start + BATCH_SIZE],
+            )
+
+        # Code that hasn't been deployed yet keeps creating nodes without these values,
+        # even after the ranges above were read, so repeat until no linked node is missing them.
+        # Orphaned nodes whose component was deleted can't be linked, so they're skipped
+        while True:
+            cursor.execute(
+                "UPDATE core_componentnode AS node "
+                "SET component_id = component.uuid, component_type = component.type, "
+                "namespace = component.namespace, arch = component.arch "
+                "FROM core_component AS component "
+                "WHERE component.uuid = node.object_id AND node.id IN ("
+                "SELECT missing.id FROM core_componentnode AS missing "
+                "INNER JOIN core_component AS missing_component "
+                "ON missing_component.uuid = missing.object_id "
+                "WHERE missing.component_id IS NULL LIMIT %s)",
+                [BATCH_SIZE],
+            )
+            if cursor.rowcount == 0:
+                break
+
+
+class Migration(migrations.Migration):
+    # Don't hold locks on core_componentnode until the whole table is done
+    # CREATE INDEX CONCURRENTLY also can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("core", "0074_componentnode_component"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_component_fields, migrations.RunPython.noop),
+        # Doesn't block writes, unlike the check when the constraint was added
+        migrations.RunSQL(
+            "ALTER TABLE core_componentnode VALIDATE CONSTRAINT core_componentnode_component_id_fk",
+            migrations.RunSQL.noop,
+        ),
+        AddIndexConcurrently(
+            model_name="componentnode",
+            index=models.Index(fields=("component", "type"), name="core_cn_component_type_idx"),
+        ),
+    ]
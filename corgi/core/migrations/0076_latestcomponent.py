@@ -0,0 +1,54 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0075_componentnode_component_data"),
+    ]
+
+    # The table starts empty, 0079_latestcomponent_data fills it once every component has an evr_key
+    operations = [
+        migrations.CreateModel(
+            name="LatestComponent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("product_model_type", models.CharField(max_length=20)),
+                ("product_model_uuid", models.UUIDField()),
+                (
+                    "namespace",
+                    models.CharField(
+                        choices=[("UPSTREAM", "Upstream"), ("REDHAT", "Redhat")], max_length=20
+                    ),
+                ),
+                ("name", models.TextField()),
+                ("arch", models.CharField(max_length=1024)),
+                ("released", models.BooleanField()),
+                (
+                    "component",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="latest",
+                        to="core.component",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="latestcomponent",
+            index=models.Index(fields=("namespace", "name", "arch"), name="core_latest_group_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="latestcomponent",
+            constraint=models.UniqueConstraint(
+                fields=("product_model_uuid", "namespace", "name", "arch", "released"),
+                name="unique_latest_component",
+            ),
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+from corgi.core.evr import get_evr_key
+
+# Each chunk is committed separately, so only these rows are locked at any one time
+BATCH_SIZE = 10000
+
+
+def backfill_evr_keys(apps, schema_editor):
+    """Compute the EVR sort key for every existing component"""
+    Component = apps.get_model("core", "Component")
+    last_pk = None
+    with schema_editor.connection.cursor() as cursor:
+        while True:
+            # Components created in the meantime by code that was already deployed
+            # have a key already, so only fill in the missing ones
+            components = Component.objects.filter(evr_key=b"").order_by("uuid")
+            if last_pk:
+                components = components.filter(uuid__gt=last_pk)
+            batch = tuple(
+                components.values_list("uuid", "epoch", "version", "release")[:BATCH_SIZE]
+            )
+            if not batch:
+                break
+            cursor.execute(
+                "UPDATE core_component AS component SET evr_key = batch.evr_key "
+                "FROM unnest(%s::uuid[], %s::bytea[]) AS batch (uuid, evr_key) "
+                "WHERE component.uuid = batch.uuid",
+                [
+                    [pk for pk, *_ in batch],
+                    [get_evr_key(epoch, version, release) for _, epoch, version, release in batch],
+                ],
+            )
+            last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+    # Don't hold locks on core_component until the whole table is done
+    # CREATE INDEX CONCURRENTLY also can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("core", "0076_latestcomponent"),
+    ]
+
+    operations = [
+        # Adding a column with a constant default only updates the catalog in Postgres 11+
+        migrations.AddField(
+            model_name="component",
+            name="evr_key",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.RunPython(backfill_evr_keys, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name="component",
+            index=models.Index(
+                fields=("namespace", "name", "arch", "evr_key"), name="compon_latest_evr_idx"
+            ),
+        ),
+    ]
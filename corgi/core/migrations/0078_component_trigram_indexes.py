@@ -0,0 +1,40 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+from django.db import migrations, models
+from django.db.models.functions import Cast
+
+TRIGRAM_FIELDS = ("name", "purl", "description", "related_url", "version", "release")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    # and doesn't block writes to core_component while the indexes are built
+    atomic = False
+
+    dependencies = [
+        ("core", "0077_component_evr_key"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        *(
+            AddIndexConcurrently(
+                model_name="component",
+                index=GinIndex(
+                    fields=(field,), name=f"compon_{field}_trgm_idx", opclasses=("gin_trgm_ops",)
+                ),
+            )
+            for field in TRIGRAM_FIELDS
+        ),
+        AddIndexConcurrently(
+            model_name="component",
+            index=GinIndex(
+                OpClass(Cast("meta_attr", output_field=models.TextField()), name="gin_trgm_ops"),
+                name="compon_meta_attr_trgm_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="component",
+            index=GinIndex(fields=("el_match",), name="compon_el_match_idx"),
+        ),
+    ]
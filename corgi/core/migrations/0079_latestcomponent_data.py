@@ -0,0 +1,98 @@
+from django.db import migrations, transaction
+from django.db.models import Q
+
+from corgi.core.constants import ROOT_COMPONENTS_CONDITION
+
+# Number of (namespace, name, arch) groups to refresh in each transaction
+BATCH_SIZE = 100
+# Component fields that link root components to each kind of ProductModel
+PRODUCT_FIELDS = ("products", "productversions", "productstreams", "productvariants")
+
+
+def backfill_latest_components(apps, schema_editor):
+    """Save the latest root components in every product model
+    Same as LatestComponent.refresh() for every (namespace, name, arch) group, in batches"""
+    Component = apps.get_model("core", "Component")
+    roots = Component.objects.filter(ROOT_COMPONENTS_CONDITION)
+    groups = list(roots.values_list("namespace", "name", "arch").order_by().distinct())
+    groups.sort()
+    for start in range(0, len(groups), BATCH_SIZE):
+        with transaction.atomic(using=schema_editor.connection.alias):
+            refresh_groups(apps, schema_editor, groups[start : start + BATCH_SIZE])
+
+
+def refresh_groups(apps, schema_editor, groups):
+    """Find the latest root components in each (namespace, name, arch) group again"""
+    Component = apps.get_model("core", "Component")
+    LatestComponent = apps.get_model("core", "LatestComponent")
+    with schema_editor.connection.cursor() as cursor:
+        # Ingestion tasks refresh the same groups while this runs, so take the same locks they do
+        for group in groups:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", ["/".join(group)])
+
+    group_query = Q()
+    for namespace, name, arch in groups:
+        group_query |= Q(namespace=namespace, name=name, arch=arch)
+
+    # Component UUID to (group, EVR key, released) for every root component in these groups
+    versions = {}
+    for pk, namespace, name, arch, evr_key, released_errata_tags in (
+        Component.objects.filter(group_query)
+        .filter(ROOT_COMPONENTS_CONDITION)
+        .values_list(
+            "pk",
+            "namespace",
+            "name",
+            "arch",
+            "evr_key",
+            "software_build__meta_attr__released_errata_tags",
+        )
+        .iterator()
+    ):
+        versions[pk] = ((namespace, name, arch), bytes(evr_key), released_errata_tags != [])
+
+    # (product model type, product model UUID, group, released) to latest component UUID
+    latest = {}
+    for field_name in PRODUCT_FIELDS:
+        field = Component._meta.get_field(field_name)
+        product_model_type = field.related_model.__name__
+        links = field.remote_field.through.objects.filter(
+            component_id__in=list(versions)
+        ).values_list("component_id", field.m2m_reverse_name())
+        for component_pk, product_model_pk in links.iterator():
+            group, evr_key, is_released = versions[component_pk]
+            for released in (False, True) if is_released else (False,):
+                key = (product_model_type, product_model_pk, group, released)
+                latest_pk = latest.get(key)
+                if latest_pk is None or evr_key > versions[latest_pk][1]:
+                    latest[key] = component_pk
+
+    LatestComponent.objects.filter(group_query).delete()
+    rows = []
+    for (product_model_type, product_model_pk, group, released), pk in latest.items():
+        namespace, name, arch = group
+        rows.append(
+            LatestComponent(
+                product_model_type=product_model_type,
+                product_model_uuid=product_model_pk,
+                namespace=namespace,
+                name=name,
+                arch=arch,
+                released=released,
+                component_id=pk,
+            )
+        )
+    LatestComponent.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+    # Commit each batch of groups separately, instead of locking every group until the end
+    atomic = False
+
+    dependencies = [
+        ("core", "0078_component_trigram_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_latest_components, migrations.RunPython.noop),
+    ]
@@ -2,22 +2,22 @@ import logging
 import re
 import uuid as uuid
 from abc import abstractmethod
-from typing import Any, Iterator, Union
+from typing import Any, Iterable, Iterator, Optional, Union
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres import fields
-from django.contrib.postgres.aggregates import JSONBAgg
-from django.db import models
-from django.db.models import Q, QuerySet
-from django.db.models.expressions import RawSQL
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.db import connection, models, transaction
+from django.db.models import Prefetch, Q, QuerySet
+from django.db.models.functions import Cast
 from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
 from packageurl import PackageURL
 from packageurl.contrib import purl2url
-from rpm import labelCompare
 
+from corgi.core.cache import bump_generations, generations_enabled
 from corgi.core.constants import (
     CONTAINER_DIGEST_FORMATS,
     EL_MATCH_RE,
@@ -25,7 +25,11 @@ from corgi.core.constants import (
     ROOT_COMPONENTS_CONDITION,
     SRPM_CONDITION,
 )
+from corgi.core.evr import get_evr_key
 from corgi.core.files import ComponentManifestFile, ProductManifestFile
+
+# Registers the custom lookups on model fields, wherever models are used
+from corgi.core.lookups import ILikeContains  # noqa: F401
 from corgi.core.mixins import TimeStampedModel
 
 logger = logging.getLogger(__name__)
@@ -195,6 +199,17 @@ class ComponentNode(NodeModel):
     )
     # Saves an expensive django dereference into node object
     purl = models.CharField(max_length=1024, default="")
+    # Same as the GenericForeignKey, but can be joined / filtered on like any other ForeignKey
+    # Indexed below together with type, instead of separately
+    component = models.ForeignKey(
+        "Component", on_delete=models.CASCADE, null=True, related_name="cnodes", db_index=False
+    )
+    # Copied from the linked component, so tree walks don't need to join or dereference it
+    # type and arch are part of a component's unique key
+    # namespace can change when a build is ingested again, see ComponentTree._save_components()
+    component_type = models.CharField(max_length=20, default="")
+    namespace = models.CharField(max_length=20, default="")
+    arch = models.CharField(max_length=1024, default="")
 
     class Meta(NodeModel.Meta):
         constraints = (
@@ -225,11 +240,21 @@ class ComponentNode(NodeModel):
             ),
             models.Index(fields=("lft", "tree_id"), name="core_cn_lft_tree_idx"),
             models.Index(fields=("lft", "rght", "tree_id"), name="core_cn_lft_rght_tree_idx"),
+            models.Index(fields=("component", "type"), name="core_cn_component_type_idx"),
             *NodeModel.Meta.indexes,
         )
 
+    def set_component_fields(self, component: "Component") -> None:
+        """Link this node to some component, and copy the fields we denormalize from it"""
+        self.obj = component
+        self.component = component
+        self.purl = component.purl
+        self.component_type = component.type
+        self.namespace = component.namespace
+        self.arch = component.arch
+
     def save(self, *args, **kwargs):
-        self.purl = self.obj.purl
+        self.set_component_fields(self.obj)
         super().save(*args, **kwargs)
 
 
@@ -315,20 +340,43 @@ class SoftwareBuild(TimeStampedModel):
         )
 
         product_details = get_product_details(variant_names, stream_names)
-        components = set()
-        for component in self.components.get_queryset().iterator():
-            components.add(component)
-            # This is needed for container image builds which pull in components not
-            # built at Red Hat, and therefore not assigned a build_id
-            for cnode in component.cnodes.get_queryset().iterator():
-                for d in cnode.get_descendants().iterator():
-                    components.add(d.obj)
-
-        for component in components:
-            component.save_product_taxonomy(product_details)
-
+        if not any(product_details.values()):
+            # Nothing to link, so don't bother walking the component trees
+            return None
+
+        component_pks = self.get_tree_component_pks()
+        Component.bulk_save_product_taxonomy(component_pks, product_details)
+        # Refresh once for the whole build, now that every component is linked
+        LatestComponent.refresh_for_components(self.components.values_list("pk", flat=True))
+        Component.bump_generations(component_pks)
         return None
 
+    def get_tree_component_pks(self) -> list[str]:
+        """Return the UUIDs of this build's components and all their descendants in one query
+
+        Descendants are needed for container image builds which pull in components not
+        built at Red Hat, and therefore not assigned a build_id"""
+        component_table = Component._meta.db_table
+        node_table = ComponentNode._meta.db_table
+        # Nested-set intervals let us find every descendant with a single join,
+        # instead of dereferencing the GenericForeignKey on each descendant node
+        sql = f"""
+            SELECT component.uuid FROM {component_table} AS component
+            WHERE component.software_build_uuid = %s
+            UNION
+            SELECT descendant.component_id FROM {component_table} AS component
+            INNER JOIN {node_table} AS node ON node.component_id = component.uuid
+            INNER JOIN {node_table} AS descendant ON (
+                descendant.tree_id = node.tree_id
+                AND descendant.lft > node.lft
+                AND descendant.rght < node.rght
+            )
+            WHERE component.software_build_uuid = %s
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.pk, self.pk])
+            return [row[0] for row in cursor.fetchall()]
+
 
 class SoftwareBuildTag(Tag):
     tagged_model = models.ForeignKey(
@@ -635,7 +683,7 @@ class ProductStream(ProductModel):
         """Returns unique aggregate "provides" for the latest components in this stream,
         for use in templates"""
         unique_provides = (
-            self.components.manifest_components()
+            self.components.manifest_components(product_model=self)
             .using(using)
             .values_list("provides__pk", flat=True)
             .distinct()
@@ -657,7 +705,7 @@ class ProductStream(ProductModel):
         unique_upstreams = (
             # RPM upstream data is human-generated and unreliable
             self.components.exclude(type=Component.Type.RPM)
-            .manifest_components()
+            .manifest_components(product_model=self)
             .using(using)
             .values_list("upstreams__pk", flat=True)
             .distinct()
@@ -892,101 +940,62 @@ class ComponentQuerySet(models.QuerySet):
         include: bool = True,
     ) -> "ComponentQuerySet":
         """Return components from latest builds across all product streams."""
-        latest_components = self.latest_components_q(self)
-        if latest_components:
-            if include:
-                return self.filter(latest_components)
-            else:
-                return self.exclude(latest_components)
-        else:
-            # Don't modify the ComponentQuerySet
-            return self
-
-    @classmethod
-    def latest_components_q(cls, queryset: models.QuerySet) -> Q:
-        component_versions = cls._versions_by_name(queryset)
-        latest_components = Q()
-        # We need to build tuples of the nevras for comparison with the rpm.labelCompare function
-        # We can discard the namespace, name, arch part of results as it was only used for grouping.
-        for _, _, _, versions in component_versions:
-            latest_version = cls._version_dict_to_tuple(versions[0])
-            for version in versions:
-                current_version = cls._version_dict_to_tuple(version)
-                if labelCompare(current_version[1:], latest_version[1:]) == 1:
-                    latest_version = current_version
-            if latest_version:
-                # use the first entry in the tuple (the uuid) in the query
-                latest_components |= Q(pk=latest_version[0])
-        return latest_components
-
-    @staticmethod
-    def _version_dict_to_tuple(version_dict):
-        return (
-            version_dict["uuid"],
-            version_dict["epoch"],
-            version_dict["version"],
-            version_dict["release"],
-        )
-
-    @staticmethod
-    def _versions_by_name(queryset: models.QuerySet) -> Iterator[Any]:
-        """This builds a json object 'nevras' so that we can group multiple
-        epoch/version/release (EVR) by namespace/name/arch.
-        We select the uuid as well to identify the latest EVR for that namespace/name/arch"""
-        return (
-            queryset.values_list("namespace", "name", "arch")
-            .annotate(
-                nevras=JSONBAgg(
-                    RawSQL(
-                        "json_build_object(" "'uuid', core_component.uuid, "
-                        # the rpm.labelCompare function expects the epoch to be a string
-                        "'epoch', epoch::VARCHAR, "
-                        # Avoids AmbiguousColumn: column reference "version" is ambiguous
-                        "'version', core_component.version, " "'release', release)",
-                        (),
-                    )
-                )
-            )
-            .order_by()
-            .distinct()
-            .iterator()
+        # evr_key sorts the same way as rpm.labelCompare, so the database can find
+        # the latest component for each namespace / name / arch with a single DISTINCT ON
+        latest_components = (
+            self.order_by("namespace", "name", "arch", "-evr_key")
+            .distinct("namespace", "name", "arch")
+            .values("pk")
         )
+        if include:
+            return self.filter(pk__in=latest_components)
+        else:
+            return self.exclude(pk__in=latest_components)
 
     def latest_components_by_streams(
         self,
         include: bool = True,
     ) -> "ComponentQuerySet":
-        """Return only root components from latest builds for each product stream."""
-        product_stream_uuids = (
-            self.root_components()
-            .exclude(productstreams__isnull=True)
-            .values_list("productstreams__uuid", flat=True)
-            # Clear ordering inherited from parent Queryset, if any
-            # So .distinct() works properly and doesn't have duplicates
-            .order_by()
-            .distinct()
-        )
-        query = Q()
-        for ps_uuid in product_stream_uuids:
-            root_components_for_stream = (
-                self.root_components()
-                .prefetch_related("productstreams")
-                .filter(productstreams=ps_uuid)
+        """Return only root components from latest builds for each product stream.
+        Uses the latest components that were saved for each stream, see LatestComponent"""
+        roots = self.root_components()
+        latest_in_streams = (
+            LatestComponent.objects.filter(
+                product_model_type=ProductStream.__name__, released=False, component__in=roots
             )
-            query |= self.latest_components_q(root_components_for_stream)
+            .values("component_id")
+            .using(self.db)
+        )
         if include:
             # Show only the latest components
-            if not query:
-                # no latest components, don't do any further filtering
-                return Component.objects.none()
-            return self.root_components().filter(query)
+            return roots.filter(pk__in=latest_in_streams)
         else:
             # Show only the older / non-latest components
-            if not query:
+            if not latest_in_streams.exists():
                 # No latest components to hide??
                 # So show everything / return unfiltered queryset
                 return self
-            return self.root_components().exclude(query)
+            return roots.exclude(pk__in=latest_in_streams)
+
+    def latest_components_for(
+        self, product_model: "ProductModel", released: bool = False
+    ) -> "ComponentQuerySet":
+        """Return only the latest root components in some product, version, stream, or variant
+        If released is True, return the latest released components instead"""
+        saved = LatestComponent.objects.filter(
+            product_model_uuid=product_model.pk, released=released
+        ).using(self.db)
+        if saved.exists():
+            return self.filter(
+                latest__product_model_uuid=product_model.pk, latest__released=released
+            )
+        # Nothing was saved for this model yet, e.g. before its latest components were backfilled
+        # So find them the slow way, instead of showing no components at all
+        roots = self.filter(**{f"{product_model._meta.model_name}s": product_model})
+        roots = roots.root_components()
+        if released:
+            roots = roots.released_components()
+        return roots.latest_components()
 
     def released_components(self, include: bool = True) -> "ComponentQuerySet":
         """Show only released components by default, or unreleased components if include=False"""
@@ -1015,12 +1024,21 @@ class ComponentQuerySet(models.QuerySet):
         # Falsey values return the filtered queryset (only internal components)
         return self.filter(redhat_com_query)
 
-    def manifest_components(self, quick=False) -> "ComponentQuerySet":
+    def manifest_components(
+        self, quick=False, product_model: Optional["ProductModel"] = None
+    ) -> "ComponentQuerySet":
         """filter latest components takes a long time, dont bother with that if we're just
-        checking there is anything to manifest"""
+        checking there is anything to manifest
+
+        When the product model being manifested is given, use the latest components saved for it
+        These are all root components, and all released unless we're in community mode"""
         non_container_source_components = self.exclude(name__endswith="-container-source").using(
             "read_only"
         )
+        if not quick and product_model is not None:
+            return non_container_source_components.latest_components_for(
+                product_model, released=not settings.COMMUNITY_MODE_ENABLED
+            )
         if settings.COMMUNITY_MODE_ENABLED:
             roots = non_container_source_components.root_components()
         else:
@@ -1090,6 +1108,8 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
     version = models.CharField(max_length=1024)
     release = models.CharField(max_length=1024, default="")
     arch = models.CharField(max_length=1024, default="")
+    # Sorts the same way as rpm.labelCompare on (epoch, version, release), see corgi/core/evr.py
+    evr_key = models.BinaryField(default=b"")
 
     purl = models.CharField(max_length=1024, default="", unique=True)
     nvr = models.CharField(max_length=1024, default="")
@@ -1109,10 +1129,9 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
     sources = models.ManyToManyField("Component", related_name="provides")
     provides: models.Manager["Component"]
 
-    # Specify related_query_name to add e.g. component field
-    # that can be used to filter from a cnode to its related component
-    # TODO: Or just switch from GenericForeignKey to regular ForeignKey?
-    cnodes = GenericRelation(ComponentNode, related_query_name="%(class)s")
+    # implicit field "cnodes" from ComponentNode's ForeignKey
+    # The "component" field on ComponentNode can be used to filter from a cnode to its component
+    cnodes: models.Manager[ComponentNode]
     software_build = models.ForeignKey(
         SoftwareBuild,
         on_delete=models.CASCADE,
@@ -1175,6 +1194,22 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
                 name="compon_latest_idx",
                 condition=ROOT_COMPONENTS_CONDITION,
             ),
+            models.Index(
+                fields=("namespace", "name", "arch", "evr_key"),
+                name="compon_latest_evr_idx",
+            ),
+            # Trigram indexes for the regex, ILIKE and search filters in the API
+            *(
+                GinIndex(
+                    fields=(field,), name=f"compon_{field}_trgm_idx", opclasses=("gin_trgm_ops",)
+                )
+                for field in ("name", "purl", "description", "related_url", "version", "release")
+            ),
+            GinIndex(
+                OpClass(Cast("meta_attr", output_field=models.TextField()), name="gin_trgm_ops"),
+                name="compon_meta_attr_trgm_idx",
+            ),
+            GinIndex(fields=("el_match",), name="compon_el_match_idx"),
         )
 
     def __str__(self) -> str:
@@ -1521,6 +1556,34 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
     def is_srpm(self):
         return self.type == Component.Type.RPM and self.arch == "src"
 
+    def is_root(self) -> bool:
+        """Same as ROOT_COMPONENTS_CONDITION, but for a single component"""
+        return self.is_srpm() or (
+            self.type == Component.Type.CONTAINER_IMAGE and self.arch == "noarch"
+        )
+
+    @classmethod
+    def bump_generations(cls, component_pks: Iterable[str]) -> None:
+        """Invalidate cached API responses and manifest fragments for some components,
+        and the product models they're in
+        Scopes are described in corgi/core/cache.py"""
+        if not generations_enabled():
+            return
+        component_pks = tuple(component_pks)
+        scopes = {"components", "product_streams"}
+        for pk, purl in cls.objects.filter(pk__in=component_pks).values_list("pk", "purl"):
+            scopes.add(f"component:{pk}")
+            scopes.add(f"component:{purl}")
+        for field_name in LatestComponent.PRODUCT_FIELDS:
+            field = cls._meta.get_field(field_name)
+            product_model_pks = (
+                field.remote_field.through.objects.filter(component_id__in=component_pks)
+                .values_list(field.m2m_reverse_name(), flat=True)
+                .distinct()
+            )
+            scopes.update(f"product_model:{pk}" for pk in product_model_pks)
+        bump_generations(scopes)
+
     def get_nvr(self) -> str:
         release = f"-{self.release}" if self.release else ""
         return f"{self.name}-{self.version}{release}"
@@ -1591,9 +1654,12 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
         # If so, use the existing value for the field (or the empty string default value) instead
         return related_url if related_url else self.related_url
 
-    def save(self, *args, **kwargs):
+    def set_computed_fields(self) -> None:
+        """Set the fields derived from a component's name, version, meta_attr, etc.
+        Called by save(), and by bulk ingestion code that writes components without save()"""
         self.nvr = self.get_nvr()
         self.nevra = self.get_nevra()
+        self.evr_key = get_evr_key(self.epoch, self.version, self.release)
         if self.type == Component.Type.RPM:
             # Filenames for non-RPM components are set with data from build system / meta_attr
             self.filename = f"{self.nevra}.rpm"
@@ -1606,6 +1672,8 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
         if el_match:
             self.el_match = [x for x in el_match.groups() if x]
 
+    def save(self, *args, **kwargs):
+        self.set_computed_fields()
         super().save(*args, **kwargs)
 
     def save_product_taxonomy(
@@ -1632,6 +1700,37 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
         self.productstreams.add(*product_pks_dict["productstreams"])
         self.productvariants.add(*product_pks_dict["productvariants"])
         self.channels.add(*product_pks_dict["channels"])
+        LatestComponent.refresh_for_components((self.pk,))
+        return None
+
+    @staticmethod
+    def bulk_save_product_taxonomy(
+        component_pks: list[str], product_pks_dict: dict[str, set[str]]
+    ) -> None:
+        """
+        Save links between ProductModel subclasses and many Components at once
+
+        Same as calling save_product_taxonomy() on each component, but with
+        a single INSERT ... SELECT for each of the five taxonomy tables,
+        so the number of queries doesn't grow with the number of components
+        """
+        if not component_pks:
+            return None
+        for field_name, product_pks in product_pks_dict.items():
+            if not product_pks:
+                continue
+            field = Component._meta.get_field(field_name)
+            through_table = field.remote_field.through._meta.db_table
+            # Existing links are skipped, so we only add, never replace, product details
+            sql = f"""
+                INSERT INTO {through_table} ({field.m2m_column_name()}, {field.m2m_reverse_name()})
+                SELECT component.uuid, product.uuid
+                FROM unnest(%s::uuid[]) AS component (uuid)
+                CROSS JOIN unnest(%s::uuid[]) AS product (uuid)
+                ON CONFLICT DO NOTHING
+            """
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [component_pks, list(product_pks)])
         return None
 
     def get_roots(self, using: str = "read_only") -> list[ComponentNode]:
@@ -1644,7 +1743,7 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
             return roots
         for cnode in self.cnodes.get_queryset().using(using).iterator():
             root = cnode.get_root()
-            if root.obj.type == Component.Type.CONTAINER_IMAGE:
+            if root.component_type == Component.Type.CONTAINER_IMAGE:
                 # TODO if we change the CONTAINER->RPM ComponentNode.type to something besides
                 # 'PROVIDES' we would check for that type here to prevent 'hardcoding' the
                 # container -> rpm relationship here.
@@ -1655,7 +1754,7 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
                 # and it's not true to say that rpms share upstreams with containers
                 rpm_descendant = (
                     cnode.get_ancestors(include_self=True)
-                    .filter(component__type=Component.Type.RPM)
+                    .filter(component_type=Component.Type.RPM)
                     .using(using)
                     .exists()
                 )
@@ -1776,11 +1875,29 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
             # Anything else (RPMMOD) just returns an empty string
             return self._build_download_url_for_type()
 
+    @staticmethod
+    def prefetch_errata() -> Prefetch:
+        """Load the errata for many components' builds in one query, for the errata property
+        Use like Component.objects.select_related("software_build").prefetch_related(...)"""
+        return Prefetch(
+            "software_build__relations",
+            queryset=ProductComponentRelation.objects.filter(
+                type=ProductComponentRelation.Type.ERRATA
+            ).only("software_build", "external_system_id"),
+            to_attr="errata_relations",
+        )
+
     @property
     def errata(self) -> list[str]:
         """Return errata that contain component."""
         if not self.software_build:
             return []
+        if hasattr(self.software_build, "errata_relations"):
+            # Already loaded by prefetch_errata(), so don't run another query
+            errata = (
+                relation.external_system_id for relation in self.software_build.errata_relations
+            )
+            return list(dict.fromkeys(erratum for erratum in errata if erratum))
         errata_qs = (
             ProductComponentRelation.objects.filter(
                 type=ProductComponentRelation.Type.ERRATA, software_build=self.software_build
@@ -1930,11 +2047,9 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
             # Cachito builds nest components under the relevant source component for that
             # container build, eg. buildID=1911112. In that case we need to walk up the
             # tree from the current node to find its relevant source
-            root_obj = root.obj
             if (
-                root_obj
-                and root_obj.type == Component.Type.CONTAINER_IMAGE
-                and root_obj.arch == "noarch"
+                root.component_type == Component.Type.CONTAINER_IMAGE
+                and root.arch == "noarch"
                 and source_descendants.count() > 1
             ):
                 upstreams.extend(
@@ -1942,7 +2057,7 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
                     .get_ancestors(include_self=True)
                     .filter(
                         type=ComponentNode.ComponentNodeType.SOURCE,
-                        component__namespace=Component.Namespace.UPSTREAM,
+                        namespace=Component.Namespace.UPSTREAM,
                     )
                     .using(using)
                     .iterator()
@@ -1965,6 +2080,130 @@ class ComponentTag(Tag):
     tagged_model = models.ForeignKey(Component, on_delete=models.CASCADE, related_name="tags")
 
 
+class LatestComponent(models.Model):
+    """The latest root component for some namespace / name / arch in some product model
+
+    Finding the latest version of a component means comparing the EVRs of every build in a group,
+    so this is done once when a build is ingested, retagged, or deleted instead of on every request.
+    Each product / version / stream / variant has one row per (namespace, name, arch) group,
+    and a second row for the latest released component in that group, which manifests use.
+    """
+
+    # Component fields that link root components to each kind of ProductModel
+    PRODUCT_FIELDS = ("products", "productversions", "productstreams", "productvariants")
+
+    product_model_type = models.CharField(max_length=20)  # Like "ProductStream"
+    product_model_uuid = models.UUIDField()
+    namespace = models.CharField(choices=Component.Namespace.choices, max_length=20)
+    name = models.TextField()
+    arch = models.CharField(max_length=1024)
+    # If True, this is the latest released component, otherwise the latest of any component
+    released = models.BooleanField()
+    component = models.ForeignKey(Component, on_delete=models.CASCADE, related_name="latest")
+
+    class Meta:
+        indexes = (
+            models.Index(fields=("namespace", "name", "arch"), name="core_latest_group_idx"),
+        )
+        constraints = [
+            models.UniqueConstraint(
+                fields=("product_model_uuid", "namespace", "name", "arch", "released"),
+                name="unique_latest_component",
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.product_model_type} {self.product_model_uuid}: {self.component_id}"
+
+    @classmethod
+    def refresh_for_components(cls, component_pks: Iterable[str]) -> None:
+        """Refresh the latest components for the groups that some components belong to
+        Components that aren't root components are skipped"""
+        groups = (
+            Component.objects.filter(pk__in=component_pks)
+            .root_components()
+            .values_list("namespace", "name", "arch")
+            .order_by()
+            .distinct()
+        )
+        cls.refresh(tuple(groups))
+
+    @classmethod
+    def refresh(cls, groups: Iterable[tuple[str, str, str]]) -> None:
+        """Find the latest root components in each (namespace, name, arch) group again"""
+        groups = sorted(set(groups))
+        if not groups:
+            return
+        group_query = Q()
+        for namespace, name, arch in groups:
+            group_query |= Q(namespace=namespace, name=name, arch=arch)
+
+        with transaction.atomic():
+            # Two tasks refreshing the same group at once could save results based on old data,
+            # so each group is locked until this transaction ends. Sorting avoids deadlocks
+            with connection.cursor() as cursor:
+                for group in groups:
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", ["/".join(group)])
+
+            # Component UUID to (group, EVR key, released) for every root component in these groups
+            versions: dict[str, tuple[tuple[str, str, str], bytes, bool]] = {}
+            for pk, namespace, name, arch, evr_key, released_errata_tags in (
+                Component.objects.filter(group_query)
+                .root_components()
+                .values_list(
+                    "pk",
+                    "namespace",
+                    "name",
+                    "arch",
+                    "evr_key",
+                    "software_build__meta_attr__released_errata_tags",
+                )
+                .iterator()
+            ):
+                # Same as ComponentQuerySet.released_components(), which only excludes
+                # components whose build has an empty list of released errata
+                versions[pk] = ((namespace, name, arch), bytes(evr_key), released_errata_tags != [])
+
+            # (product model type, product model UUID, group, released) to latest component UUID
+            latest: dict[tuple[str, str, tuple[str, str, str], bool], str] = {}
+            for field_name in cls.PRODUCT_FIELDS:
+                field = Component._meta.get_field(field_name)
+                product_model_type = field.related_model.__name__
+                links = field.remote_field.through.objects.filter(
+                    component_id__in=list(versions)
+                ).values_list("component_id", field.m2m_reverse_name())
+                for component_pk, product_model_pk in links.iterator():
+                    group, evr_key, is_released = versions[component_pk]
+                    for released in (False, True) if is_released else (False,):
+                        key = (product_model_type, product_model_pk, group, released)
+                        latest_pk = latest.get(key)
+                        if latest_pk is None or evr_key > versions[latest_pk][1]:
+                            latest[key] = component_pk
+
+            rows = []
+            for (product_model_type, product_model_pk, group, released), pk in latest.items():
+                namespace, name, arch = group
+                rows.append(
+                    cls(
+                        product_model_type=product_model_type,
+                        product_model_uuid=product_model_pk,
+                        namespace=namespace,
+                        name=name,
+                        arch=arch,
+                        released=released,
+                        component_id=pk,
+                    )
+                )
+            old_rows = cls.objects.filter(group_query)
+            # Lists of the latest components in these product models will change
+            product_model_pks = {row.product_model_uuid for row in rows}
+            if settings.API_CACHE_ENABLED:
+                product_model_pks.update(old_rows.values_list("product_model_uuid", flat=True))
+            old_rows.delete()
+            cls.objects.bulk_create(rows)
+        bump_generations(f"product_model:{pk}" for pk in product_model_pks)
+
+
 class AppStreamLifeCycle(TimeStampedModel):
     """LifeCycle model based on lifecycle-defs repo in CEE Gitlab"""
 
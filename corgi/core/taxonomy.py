@@ -0,0 +1,277 @@
+"""
+Save the component taxonomy (provides, sources, and upstreams) for a whole tree at once.
+Component.save_component_taxonomy() runs its own MPTT queries for every component,
+but every node in a tree can be loaded with one query, and the taxonomy derived in memory
+using the nested-set intervals. Only the links that changed are then written to the DB.
+"""
+import logging
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Any, Iterable
+
+from django.db import connection
+
+from corgi.core.instrumentation import span
+from corgi.core.models import Component, ComponentNode, SoftwareBuild
+
+logger = logging.getLogger(__name__)
+
+# Postgres arrays can be large, but this keeps each statement a reasonable size
+BATCH_SIZE = 10000
+
+NODE_COLUMNS = (
+    "node.id, node.parent_id, node.tree_id, node.lft, node.rght, node.type, node.component_id, "
+    "node.component_type, node.arch, node.namespace, component.software_build_uuid"
+)
+NODE_FIELDS = (
+    "pk",
+    "parent_id",
+    "tree_id",
+    "lft",
+    "rght",
+    "type",
+    "component_id",
+    "component_type",
+    "arch",
+    "namespace",
+    "software_build_id",
+)
+
+
+class TreeTaxonomy:
+    """Provides, sources, and upstreams for every component in some tree
+
+    These are the same as what get_provides_nodes(), get_sources_nodes(),
+    and get_upstreams_pks() return for each component. Those methods look at all nodes
+    for a component, not just the nodes in one tree, so we also load that component's nodes
+    in other trees, and their relatives, but nothing else from those other trees.
+    """
+
+    def __init__(self, tree_id: int) -> None:
+        self.tree_id = tree_id
+        self.nodes: dict[int, dict[str, Any]] = {}
+        # Nodes in each tree, sorted by lft, and a parallel list of just the lft values
+        self.trees: dict[int, list[dict[str, Any]]] = defaultdict(list)
+        self.tree_lfts: dict[int, list[int]] = {}
+        self.component_nodes: dict[str, list[dict[str, Any]]] = defaultdict(list)
+        # UUIDs for components in this tree. Only their taxonomies are saved
+        self.component_pks: set[str] = set()
+
+    def load(self) -> None:
+        """Load this tree, and any other nodes we need, in two queries"""
+        component_table = Component._meta.db_table
+        node_table = ComponentNode._meta.db_table
+        tree_sql = f"""
+            SELECT {NODE_COLUMNS} FROM {node_table} AS node
+            LEFT JOIN {component_table} AS component ON component.uuid = node.component_id
+            WHERE node.tree_id = %s
+        """
+        # Nodes in other trees for components in this tree, plus their ancestors,
+        # descendants, and the other SOURCE nodes in those trees (to find upstreams)
+        related_sql = f"""
+            WITH other_node AS (
+                SELECT id, tree_id, lft, rght FROM {node_table}
+                WHERE tree_id <> %s
+                AND component_id IN (SELECT component_id FROM {node_table} WHERE tree_id = %s)
+            ), related_node AS (
+                SELECT relative.id FROM other_node
+                INNER JOIN {node_table} AS relative ON (
+                    relative.tree_id = other_node.tree_id
+                    AND relative.lft <= other_node.lft
+                    AND relative.rght >= other_node.rght
+                )
+                UNION
+                SELECT relative.id FROM other_node
+                INNER JOIN {node_table} AS relative ON (
+                    relative.tree_id = other_node.tree_id
+                    AND relative.lft > other_node.lft
+                    AND relative.rght < other_node.rght
+                )
+                UNION
+                SELECT relative.id FROM {node_table} AS relative
+                WHERE relative.type = %s
+                AND relative.tree_id IN (SELECT tree_id FROM other_node)
+            )
+            SELECT {NODE_COLUMNS} FROM {node_table} AS node
+            LEFT JOIN {component_table} AS component ON component.uuid = node.component_id
+            WHERE node.id IN (SELECT id FROM related_node)
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(tree_sql, [self.tree_id])
+            self._add_nodes(cursor.fetchall())
+            self.component_pks = {node["component_id"] for node in self.trees[self.tree_id]}
+
+            cursor.execute(
+                related_sql,
+                [self.tree_id, self.tree_id, ComponentNode.ComponentNodeType.SOURCE],
+            )
+            self._add_nodes(cursor.fetchall())
+
+        for tree_id, tree in self.trees.items():
+            tree.sort(key=lambda node: node["lft"])
+            self.tree_lfts[tree_id] = [node["lft"] for node in tree]
+
+    def _add_nodes(self, rows: Iterable[tuple]) -> None:
+        for row in rows:
+            node = dict(zip(NODE_FIELDS, row))
+            self.nodes[node["pk"]] = node
+            self.trees[node["tree_id"]].append(node)
+            self.component_nodes[node["component_id"]].append(node)
+
+    def get_ancestors(self, node: dict[str, Any], include_self: bool = False) -> list[dict]:
+        ancestors = [node] if include_self else []
+        while node["parent_id"] is not None:
+            node = self.nodes[node["parent_id"]]
+            ancestors.append(node)
+        return ancestors
+
+    def get_descendants(self, node: dict[str, Any]) -> list[dict]:
+        # Descendants are exactly the nodes in the same tree with lft inside our interval
+        # In a list sorted by lft, that's one contiguous slice
+        lfts = self.tree_lfts[node["tree_id"]]
+        start = bisect_right(lfts, node["lft"])
+        end = bisect_left(lfts, node["rght"], lo=start)
+        return self.trees[node["tree_id"]][start:end]
+
+    def get_provides(self, component_pk: str) -> set[str]:
+        """Same as Component.get_provides_nodes()"""
+        return {
+            descendant["component_id"]
+            for node in self.component_nodes[component_pk]
+            for descendant in self.get_descendants(node)
+            if descendant["type"] in ComponentNode.PROVIDES_NODE_TYPES
+        }
+
+    def get_sources(self, component_pk: str) -> set[str]:
+        """Same as Component.get_sources_nodes()"""
+        return {
+            ancestor["component_id"]
+            for node in self.component_nodes[component_pk]
+            if node["type"] in ComponentNode.PROVIDES_NODE_TYPES
+            for ancestor in self.get_ancestors(node)
+        }
+
+    def get_roots(self, component_pk: str) -> list[dict]:
+        """Same as Component.get_roots()"""
+        roots = []
+        nodes = self.component_nodes[component_pk]
+        if not nodes or not nodes[0]["software_build_id"]:
+            return roots
+        for node in nodes:
+            ancestors = self.get_ancestors(node, include_self=True)
+            root = ancestors[-1]
+            # RPMs are included as children of Containers as well as SRPMs
+            # We don't want to include Containers in the RPMs roots, see get_roots()
+            if root["component_type"] == Component.Type.CONTAINER_IMAGE and any(
+                ancestor["component_type"] == Component.Type.RPM for ancestor in ancestors
+            ):
+                continue
+            roots.append(root)
+        return roots
+
+    def get_upstreams(self, component_pk: str) -> set[str]:
+        """Same as Component.get_upstreams_pks()"""
+        upstreams = set()
+        for root in self.get_roots(component_pk):
+            source_descendants = [
+                descendant["component_id"]
+                for descendant in self.get_descendants(root)
+                if descendant["type"] == ComponentNode.ComponentNodeType.SOURCE
+            ]
+            # Cachito builds nest components under the relevant source component for that
+            # container build, so walk up the tree to find the relevant source instead
+            if (
+                root["component_type"] == Component.Type.CONTAINER_IMAGE
+                and root["arch"] == "noarch"
+                and len(source_descendants) > 1
+            ):
+                upstreams.update(
+                    ancestor["component_id"]
+                    for node in self.component_nodes[component_pk]
+                    for ancestor in self.get_ancestors(node, include_self=True)
+                    if ancestor["type"] == ComponentNode.ComponentNodeType.SOURCE
+                    and ancestor["namespace"] == Component.Namespace.UPSTREAM
+                )
+            else:
+                upstreams.update(source_descendants)
+        return upstreams
+
+    def save(self) -> None:
+        """Write only the provides / sources and upstreams links that changed"""
+        # provides is the inverse of sources, so both are stored in the same table
+        # Setting component.sources manages (component, source) links
+        # and setting component.provides manages (provided, component) links
+        sources_links = set()
+        upstreams_links = set()
+        for component_pk in self.component_pks:
+            sources_links.update((component_pk, pk) for pk in self.get_sources(component_pk))
+            sources_links.update((pk, component_pk) for pk in self.get_provides(component_pk))
+            upstreams_links.update((component_pk, pk) for pk in self.get_upstreams(component_pk))
+
+        _save_links("sources", self.tree_id, sources_links, include_reverse=True)
+        _save_links("upstreams", self.tree_id, upstreams_links, include_reverse=False)
+
+
+def _save_links(
+    field_name: str, tree_id: int, links: set[tuple[str, str]], include_reverse: bool
+) -> None:
+    """Apply the difference between the existing and desired links for components in a tree"""
+    field = Component._meta.get_field(field_name)
+    table = field.remote_field.through._meta.db_table
+    from_column = field.m2m_column_name()
+    to_column = field.m2m_reverse_name()
+    tree_components = (
+        f"SELECT component_id FROM {ComponentNode._meta.db_table} WHERE tree_id = %(tree_id)s"
+    )
+    where = f"{from_column} IN ({tree_components})"
+    if include_reverse:
+        where = f"{where} OR {to_column} IN ({tree_components})"
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT {from_column}, {to_column} FROM {table} WHERE {where}", {"tree_id": tree_id}
+        )
+        existing_links = set(cursor.fetchall())
+
+        removed_links = list(existing_links - links)
+        for start in range(0, len(removed_links), BATCH_SIZE):
+            from_pks, to_pks = zip(*removed_links[start : start + BATCH_SIZE])
+            cursor.execute(
+                f"DELETE FROM {table} "
+                "USING unnest(%s::uuid[], %s::uuid[]) AS link (from_pk, to_pk) "
+                f"WHERE {from_column} = link.from_pk AND {to_column} = link.to_pk",
+                [list(from_pks), list(to_pks)],
+            )
+
+        added_links = list(links - existing_links)
+        for start in range(0, len(added_links), BATCH_SIZE):
+            from_pks, to_pks = zip(*added_links[start : start + BATCH_SIZE])
+            cursor.execute(
+                f"INSERT INTO {table} ({from_column}, {to_column}) "
+                "SELECT * FROM unnest(%s::uuid[], %s::uuid[]) ON CONFLICT DO NOTHING",
+                [list(from_pks), list(to_pks)],
+            )
+    logger.debug(
+        f"Saved {table} for tree {tree_id}: "
+        f"added {len(added_links)} and removed {len(removed_links)} links"
+    )
+
+
+@span("save_component_taxonomy")
+def save_component_taxonomy_for_tree(tree_id: int) -> None:
+    """Save the provides, sources, and upstreams for every component in some tree"""
+    taxonomy = TreeTaxonomy(tree_id)
+    taxonomy.load()
+    taxonomy.save()
+    Component.bump_generations(taxonomy.component_pks)
+
+
+def save_component_taxonomy_for_build(software_build: SoftwareBuild) -> None:
+    """Save the component taxonomy for every tree rooted at one of a build's components"""
+    tree_ids = (
+        ComponentNode.objects.filter(component__software_build=software_build, parent=None)
+        .values_list("tree_id", flat=True)
+        .distinct()
+    )
+    for tree_id in tree_ids:
+        save_component_taxonomy_for_tree(tree_id)
@@ -1,7 +1,9 @@
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Optional
 
 import koji
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton
 from django.conf import settings
@@ -12,19 +14,26 @@ from django.utils.timezone import make_aware
 
 from config.celery import app
 from corgi.collectors.brew import ADVISORY_REGEX, Brew, BrewBuildTypeNotSupported
+from corgi.core.ingest import ComponentTree
+from corgi.core.instrumentation import span
 from corgi.core.models import (
     Component,
     ComponentNode,
+    LatestComponent,
     ProductComponentRelation,
     ProductStream,
     SoftwareBuild,
 )
+from corgi.core.taxonomy import save_component_taxonomy_for_tree
 from corgi.tasks.common import (
     BUILD_TYPE,
+    FETCH_BATCH_TIME_BUDGET,
     RETRY_KWARGS,
     RETRYABLE_ERRORS,
     create_relations,
+    fetch_builds,
     get_last_success_for_task,
+    release_build,
 )
 from corgi.tasks.errata_tool import slow_load_errata
 from corgi.tasks.sca import cpu_software_composition_analysis
@@ -40,7 +49,126 @@ def slow_fetch_brew_build(
     force_process: bool = False,
 ):
     logger.info("Fetch brew build called with build id: %s", build_id)
+    build_ids, summary = _fetch_brew_build(build_id, build_type, save_product, force_process)
+    with span("fan_out"):
+        for b_id in build_ids:
+            logger.info("Requesting fetch of nested build: (%s, %s)", b_id, build_type)
+            slow_fetch_brew_build.delay(
+                b_id, build_type, save_product=save_product, force_process=force_process
+            )
+    return summary
 
+
+@app.task(
+    base=Singleton,
+    bind=True,
+    autoretry_for=RETRYABLE_ERRORS,
+    retry_kwargs=RETRY_KWARGS,
+    soft_time_limit=settings.CELERY_LONGEST_SOFT_TIME_LIMIT,
+)
+def slow_fetch_brew_builds(
+    self,
+    build_ids: list[str],
+    build_type: str = BUILD_TYPE,
+    check_modules: bool = True,
+    force_process: bool = False,
+) -> int:
+    """Fetch and save a batch of builds, queued by fetch_builds()
+
+    All the builds share one Brew session, and their data is fetched in one multicall.
+    Then each build is saved in turn, the same as slow_fetch_modular_build
+    (if check_modules is True) or slow_fetch_brew_build would save it.
+
+    Builds that aren't saved before FETCH_BATCH_TIME_BUDGET runs out are queued in a new batch.
+    Every build is claimed by fetch_builds() until it's saved, or until this batch gives up on it,
+    so fetch_builds() doesn't queue the same build again in the meantime."""
+    logger.info("Fetch brew builds called with %s build ids", len(build_ids))
+    start = time.monotonic()
+    build_ids = [str(build_id) for build_id in build_ids]
+    brew = Brew(build_type)
+    # Dicts instead of sets, so builds are fetched in a stable order
+    nested_build_ids: dict[str, None] = {}
+    module_build_ids: dict[str, None] = {}
+    saved_builds = 0
+    # Builds that are still claimed by this batch
+    pending_build_ids = list(build_ids)
+    keep_claims = False
+    try:
+        # Builds we already have only need their taxonomies saved, which doesn't need Brew data
+        processed_build_ids = set()
+        if not force_process:
+            processed_build_ids = set(
+                SoftwareBuild.objects.filter(
+                    build_id__in=build_ids, build_type=build_type
+                ).values_list("build_id", flat=True)
+            )
+        brew.prefetch_builds(
+            int(build_id) for build_id in build_ids if build_id not in processed_build_ids
+        )
+
+        while pending_build_ids:
+            if time.monotonic() - start > FETCH_BATCH_TIME_BUDGET:
+                logger.warning(
+                    f"Out of time after {saved_builds} brew builds in batch, "
+                    f"queueing the other {len(pending_build_ids)} in a new batch"
+                )
+                # The new batch takes over their claims
+                slow_fetch_brew_builds.delay(
+                    pending_build_ids,
+                    build_type,
+                    check_modules=check_modules,
+                    force_process=force_process,
+                )
+                keep_claims = True
+                break
+
+            build_id = pending_build_ids[0]
+            try:
+                if check_modules:
+                    module_build_ids.update(
+                        dict.fromkeys(str(b_id) for b_id in _save_modular_build(build_id) or ())
+                    )
+                build_ids_to_fetch, _ = _fetch_brew_build(
+                    build_id, build_type, True, force_process, brew
+                )
+                nested_build_ids.update(dict.fromkeys(str(b_id) for b_id in build_ids_to_fetch))
+                saved_builds += 1
+            except (SoftTimeLimitExceeded, *RETRYABLE_ERRORS):
+                # Stop the batch when it's out of time
+                # Or retry the whole batch, builds that were already saved are skipped quickly
+                raise
+            except Exception:
+                # Don't let one bad build stop the rest of the batch from being saved
+                logger.exception("Failed to fetch brew build %s in batch", build_id)
+            release_build(build_id, build_type)
+            pending_build_ids.pop(0)
+    except RETRYABLE_ERRORS:
+        # The builds stay claimed while the batch will be retried
+        keep_claims = self.max_retries is None or self.request.retries < self.max_retries
+        raise
+    finally:
+        # Otherwise, release the builds that weren't saved, so fetch_builds() can queue them again
+        if not keep_claims:
+            for build_id in pending_build_ids:
+                release_build(build_id, build_type)
+
+    # Nested and module builds are always plain Brew builds, never modules
+    # Like slow_fetch_modular_build, don't force reprocessing the builds for a module's RPMs
+    fetch_builds(tuple(nested_build_ids), build_type, slow_fetch_brew_build, force_process)
+    fetch_builds(tuple(module_build_ids), build_type, slow_fetch_brew_build)
+    logger.info("Finished fetching %s of %s brew builds", saved_builds, len(build_ids))
+    return saved_builds
+
+
+def _fetch_brew_build(
+    build_id: str,
+    build_type: str,
+    save_product: bool,
+    force_process: bool,
+    brew: Optional[Brew] = None,
+) -> tuple[tuple[int, ...], dict[str, int]]:
+    """Fetch and save a single build, and return the IDs of nested builds to fetch next
+    as well as a summary of what was saved, or an empty summary if nothing was saved"""
     try:
         softwarebuild = SoftwareBuild.objects.get(build_id=build_id, build_type=build_type)
     except SoftwareBuild.DoesNotExist:
@@ -50,24 +178,28 @@ def slow_fetch_brew_build(
             logger.info("Already processed build_id %s", build_id),
             if save_product:
                 logger.info("Only saving product taxonomy for build_id %s", build_id)
-                softwarebuild.save_product_taxonomy()
+                with span("save_product_taxonomy"):
+                    softwarebuild.save_product_taxonomy()
                 # Should only be one root component / node per build
                 for root_component in softwarebuild.components.get_queryset():
                     root_node = root_component.cnodes.get()
                     _save_component_taxonomy_for_tree(root_node)
-            return
+            return (), {}
         else:
             logger.info("Fetching brew build with build_id: %s", build_id)
 
+    if brew is None:
+        brew = Brew(build_type)
     try:
-        component = Brew(build_type).get_component_data(int(build_id))
+        with span("fetch_build"):
+            component = brew.get_component_data(int(build_id))
     except BrewBuildTypeNotSupported as exc:
         logger.warning(str(exc))
-        return
+        return (), {}
 
     if not component:
         logger.info("No data fetched for build %s from Brew, exiting...", build_id)
-        return
+        return (), {}
 
     build_meta = component["build_meta"]["build_info"]
     build_meta["corgi_ingest_start_dt"] = dateformat.format(timezone.now(), "Y-m-d H:i:s")
@@ -88,81 +220,81 @@ def slow_fetch_brew_build(
     # TODO: Should we update_or_create to pick up changed build_meta?
     #  Sometimes builds are deleted in Brew
     #  In that case, don't wipe out data - test this
-    softwarebuild, created = SoftwareBuild.objects.get_or_create(
-        build_id=build_id,
-        build_type=build_type,
-        defaults={
-            "source": build_meta.pop("source"),
-            "meta_attr": build_meta,
-            "name": component["meta"]["name"],
-        },
-        completion_time=completion_dt,
-    )
-    if created:
-        # Create foreign key from Relations to the new SoftwareBuild, where they don't already exist
-        ProductComponentRelation.objects.filter(
-            build_id=build_id, build_type=build_type, software_build__isnull=True
-        ).update(software_build=softwarebuild)
+    with span("save_build"):
+        softwarebuild, created = SoftwareBuild.objects.get_or_create(
+            build_id=build_id,
+            build_type=build_type,
+            defaults={
+                "source": build_meta.pop("source"),
+                "meta_attr": build_meta,
+                "name": component["meta"]["name"],
+            },
+            completion_time=completion_dt,
+        )
+        if created:
+            # Create foreign key from Relations to the new SoftwareBuild,
+            # where they don't already exist
+            ProductComponentRelation.objects.filter(
+                build_id=build_id, build_type=build_type, software_build__isnull=True
+            ).update(software_build=softwarebuild)
 
     if not force_process and not created:
         # If another task starts while this task is downloading data this can result in processing
         # the same build twice, let's just bail out here to save cpu
         logger.warning("SoftwareBuild with build_id %s already existed, not reprocessing", build_id)
-        return
-
-    if component["type"] == Component.Type.RPM:
-        root_node = save_srpm(softwarebuild, component)
-    elif component["type"] == Component.Type.CONTAINER_IMAGE:
-        root_node = save_container(softwarebuild, component)
-    elif component["type"] == Component.Type.RPMMOD:
-        root_node = save_module(softwarebuild, component)
-    else:
-        logger.warning(f"Build {build_id} type is not supported: {component['type']}")
-        return
-
-    for child_component in component.get("components", []):
-        save_component(child_component, root_node, softwarebuild)
+        return (), {}
+
+    with span("save_tree"):
+        tree = build_component_tree(softwarebuild, component)
+        if not tree:
+            logger.warning(f"Build {build_id} type is not supported: {component['type']}")
+            return (), {}
+        # When reprocessing an existing build, only write what changed since it was last saved
+        # Should only be one root component / node per build
+        (root_node,) = tree.save(reconcile=not created)
+        Component.bump_generations(softwarebuild.get_tree_component_pks())
+    logger.info(f"Saved component tree for build {build_id}: {tree.summary}")
 
     # for builds with any tag, check if the tag is used for product stream relations, and create the
     # relations if so.
     if not build_meta["tags"]:
         logger.info("no brew tags")
     else:
-        new_relations = load_brew_tags(softwarebuild, build_meta["tags"])
+        with span("save_relations"):
+            new_relations = load_brew_tags(softwarebuild, build_meta["tags"])
         logger.info(f"Created {new_relations} for brew tags in {build_type}:{build_id}")
 
     # Allow async call of slow_load_errata task, see CORGI-21
     if save_product:
-        softwarebuild.save_product_taxonomy()
+        with span("save_product_taxonomy"):
+            softwarebuild.save_product_taxonomy()
         # Save taxonomies for all components in this tree
         # Saving only the root component taxonomy from softwarebuild.components is not enough
         _save_component_taxonomy_for_tree(root_node)
 
     # for builds with errata tags set ProductComponentRelation
     # get_component_data always calls _extract_advisory_ids to set tags, but list may be empty
-    if not build_meta["errata_tags"]:
-        logger.info("no errata tags")
-    else:
-        for e in build_meta["errata_tags"]:
-            slow_load_errata.delay(e, force_process=force_process)
-
-    build_ids = component.get("nested_builds", ())
-    logger.info("Fetching brew builds for (%s, %s)", build_ids, build_type)
-    for b_id in build_ids:
-        logger.info("Requesting fetch of nested build: (%s, %s)", b_id, build_type)
-        slow_fetch_brew_build.delay(
-            b_id, build_type, save_product=save_product, force_process=force_process
-        )
+    with span("fan_out"):
+        if not build_meta["errata_tags"]:
+            logger.info("no errata tags")
+        else:
+            for e in build_meta["errata_tags"]:
+                slow_load_errata.delay(e, force_process=force_process)
 
-    logger.info("Requesting software composition analysis for %s", softwarebuild.pk)
-    if settings.SCA_ENABLED:
-        cpu_software_composition_analysis.delay(str(softwarebuild.pk), force_process=force_process)
+        logger.info("Requesting software composition analysis for %s", softwarebuild.pk)
+        if settings.SCA_ENABLED:
+            cpu_software_composition_analysis.delay(
+                str(softwarebuild.pk), force_process=force_process
+            )
 
     logger.info("Finished fetching brew build: (%s, %s)", build_id, build_type)
+    build_ids = tuple(component.get("nested_builds", ()))
+    logger.info("Fetching brew builds for (%s, %s)", build_ids, build_type)
+    return build_ids, tree.summary
 
 
 def _save_component_taxonomy_for_tree(root_node: ComponentNode) -> None:
-    """Call node.obj.save_component_taxonomy() for all
+    """Save the component taxonomy for all
     root and upstream components in some build,
     all components provided by the root components,
     all components provided by those provided components, and so on
@@ -174,24 +306,34 @@ def _save_component_taxonomy_for_tree(root_node: ComponentNode) -> None:
     # children of the provided components, e.g. Go packages and dev_provided components
     # as found in some Cachito manifest for the build, which are not linked to the build
     # We have to save the taxonomy for all of them, not just the root components
-    root_node.obj.save_component_taxonomy()  # type: ignore[union-attr]
-
-    # TODO: We can make this faster with a ForeignKey to Component
-    #  instead of a GenericForeignKey
-    #  That will also fix the silly mypy error above we're ignoring
-    for descendant in root_node.get_descendants().iterator():
-        descendant.obj.save_component_taxonomy()
+    # The whole tree is loaded at once, instead of walking it separately for each component
+    save_component_taxonomy_for_tree(root_node.tree_id)
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS)
 def slow_fetch_modular_build(build_id: str, force_process: bool = False) -> None:
     logger.info("Fetch modular build called with build id: %s", build_id)
-    rhel_module_data = Brew.fetch_rhel_module(build_id)
+    rpm_build_ids = _save_modular_build(build_id)
     # Some compose build_ids in the relations table will be for SRPMs, skip those here
-    if not rhel_module_data:
+    if rpm_build_ids is None:
         logger.info("No module data fetched for build %s from Brew, exiting...", build_id)
         slow_fetch_brew_build.delay(build_id, force_process=force_process)
         return
+    # Request fetch of the SRPM build_ids here to ensure software_builds are created and linked
+    # to the RPM components. We don't link the SRPM into the tree because some of it's RPMs
+    # might not be included in the module
+    for rpm_build_id in rpm_build_ids:
+        slow_fetch_brew_build.delay(rpm_build_id)
+    slow_fetch_brew_build.delay(build_id, force_process=force_process)
+    logger.info("Finished fetching modular build: %s", build_id)
+
+
+def _save_modular_build(build_id: str) -> Optional[list[str]]:
+    """Save the module and its RPMs for some build, and return the build IDs for those RPMs
+    Returns None if the build isn't a module"""
+    rhel_module_data = Brew.fetch_rhel_module(build_id)
+    if not rhel_module_data:
+        return None
     # Note: module builds don't include arch information, only the individual RPMs that make up a
     # module are built for specific architectures.
     # TODO: Merge below with similar logic in save_module() if possible
@@ -213,21 +355,17 @@ def slow_fetch_modular_build(build_id: str, force_process: bool = False) -> None
     # a new ComponentNode, instead the same one will be looked up and used as the root node
     node = save_node(ComponentNode.ComponentNodeType.SOURCE, None, obj)
 
+    rpm_build_ids = []
     for c in rhel_module_data.get("components", []):
-        # Request fetch of the SRPM build_ids here to ensure software_builds are created and linked
-        # to the RPM components. We don't link the SRPM into the tree because some of it's RPMs
-        # might not be included in the module
         if "brew_build_id" in c:
-            slow_fetch_brew_build.delay(c["brew_build_id"])
+            rpm_build_ids.append(c["brew_build_id"])
         save_component(c, node)
-    slow_fetch_brew_build.delay(build_id, force_process=force_process)
-    logger.info("Finished fetching modular build: %s", build_id)
+    return rpm_build_ids
 
 
-def save_component(
-    component: dict, parent: ComponentNode, softwarebuild: Optional[SoftwareBuild] = None
-):
-    logger.debug("Called save component with component %s", component)
+def _parse_component(component: dict) -> tuple[str, dict[str, Any]]:
+    """Map a child component from Brew / Cachito to its ComponentNode type,
+    and the fields to save on its Component"""
     component_type = component.pop("type")
     meta = component.get("meta", {})
 
@@ -254,19 +392,13 @@ def save_component(
         # Handle case when key is present but value is None
         related_url = ""
 
-    license_declared_raw = meta.pop("license", "")
-    # We can't build a purl before the component is saved,
-    # so we can't handle an IntegrityError (duplicate purl) here like we do in the SCA task
-    # But that's OK - this task shouldn't ever raise an IntegrityError
-    # The "original" component should be created here as part of normal ingestion
-    # The duplicate components (new name, same purl) are created by Syft / the SCA task later
-    obj, _ = Component.objects.update_or_create(
-        type=component_type,
-        name=meta.pop("name", ""),
-        version=meta.pop("version", ""),
-        release=meta.pop("release", ""),
-        arch=meta.pop("arch", "noarch"),
-        defaults={
+    fields = {
+        "component_type": component_type,
+        "name": meta.pop("name", ""),
+        "version": meta.pop("version", ""),
+        "release": meta.pop("release", ""),
+        "arch": meta.pop("arch", "noarch"),
+        "defaults": {
             "description": meta.pop("description", ""),
             "namespace": Component.Namespace.REDHAT
             if component_type == Component.Type.RPM
@@ -274,12 +406,38 @@ def save_component(
             "related_url": related_url,
             "epoch": int(meta.pop("epoch", 0)),
         },
+        "license_declared_raw": meta.pop("license", ""),
+        # Usually component_meta is an empty dict by the time we get here, but if it's not,
+        # any remaining keys are added to the existing meta_attr
+        "meta": meta,
+    }
+    return node_type, fields
+
+
+def save_component(
+    component: dict, parent: ComponentNode, softwarebuild: Optional[SoftwareBuild] = None
+):
+    logger.debug("Called save component with component %s", component)
+    node_type, fields = _parse_component(component)
+
+    # We can't build a purl before the component is saved,
+    # so we can't handle an IntegrityError (duplicate purl) here like we do in the SCA task
+    # But that's OK - this task shouldn't ever raise an IntegrityError
+    # The "original" component should be created here as part of normal ingestion
+    # The duplicate components (new name, same purl) are created by Syft / the SCA task later
+    obj, _ = Component.objects.update_or_create(
+        type=fields["component_type"],
+        name=fields["name"],
+        version=fields["version"],
+        release=fields["release"],
+        arch=fields["arch"],
+        defaults=fields["defaults"],
     )
 
-    set_license_declared_safely(obj, license_declared_raw)
+    set_license_declared_safely(obj, fields["license_declared_raw"])
 
-    # Usually component_meta is an empty dict by the time we get here, but if it's not, and we have
-    # new keys, add them to the existing meta_attr. Only call save if something has been added
+    # Only call save if something has been added to meta_attr
+    meta = fields["meta"]
     if meta:
         obj.meta_attr = obj.meta_attr | meta
         obj.save()
@@ -288,7 +446,34 @@ def save_component(
     recurse_components(component, node)
 
 
-def save_srpm(softwarebuild: SoftwareBuild, build_data: dict) -> ComponentNode:
+def build_component_tree(softwarebuild: SoftwareBuild, build_data: dict) -> Optional[ComponentTree]:
+    """Collect all the components and nodes for some Brew build, so they can be saved in bulk
+    Returns None if the build's type is not supported"""
+    tree = ComponentTree()
+    if build_data["type"] == Component.Type.RPM:
+        root = _add_srpm(tree, softwarebuild, build_data)
+    elif build_data["type"] == Component.Type.CONTAINER_IMAGE:
+        root = _add_container(tree, softwarebuild, build_data)
+    elif build_data["type"] == Component.Type.RPMMOD:
+        root = _add_module(tree, softwarebuild, build_data)
+    else:
+        return None
+
+    for child_component in build_data.get("components", []):
+        _add_component(tree, child_component, root)
+    return tree
+
+
+def _add_component(tree: ComponentTree, component: dict, parent: dict) -> None:
+    """Add a child component from Brew / Cachito, and all its children, to the tree"""
+    node_type, fields = _parse_component(component)
+    key = tree.add_component(**fields)
+    node = tree.add_node(node_type, parent, key)
+    for child in component.get("components", ()):
+        _add_component(tree, child, node)
+
+
+def _add_srpm(tree: ComponentTree, softwarebuild: SoftwareBuild, build_data: dict) -> dict:
     name = build_data["meta"].pop("name")
     version = build_data["meta"].pop("version")
     related_url = build_data["meta"].pop("url", "")
@@ -303,9 +488,9 @@ def save_srpm(softwarebuild: SoftwareBuild, build_data: dict) -> ComponentNode:
         "related_url": related_url,
     }
 
-    obj, created = Component.objects.update_or_create(
-        type=build_data["type"],
-        name=name,
+    key = tree.add_component(
+        build_data["type"],
+        name,
         version=version,
         release=build_data["meta"].pop("release", ""),
         arch=build_data["meta"].pop("arch", "noarch"),
@@ -317,9 +502,9 @@ def save_srpm(softwarebuild: SoftwareBuild, build_data: dict) -> ComponentNode:
             "epoch": int(epoch),
         },
     )
-    node = save_node(ComponentNode.ComponentNodeType.SOURCE, None, obj)
+    node = tree.add_node(ComponentNode.ComponentNodeType.SOURCE, None, key)
     if related_url:
-        save_upstream(build_data["type"], name, version, build_data["meta"], extra, node)
+        _add_upstream(tree, build_data["type"], name, version, build_data["meta"], extra, node)
     return node
 
 
@@ -346,16 +531,16 @@ def set_license_declared_safely(obj: Component, license_declared_raw: str) -> No
         obj.save()
 
 
-def save_container(softwarebuild: SoftwareBuild, build_data: dict) -> ComponentNode:
+def _add_container(tree: ComponentTree, softwarebuild: SoftwareBuild, build_data: dict) -> dict:
     license_declared_raw = build_data["meta"].pop("license", "")
     related_url = build_data["meta"].get("repository_url", "")
     if not related_url:
         # Handle case when key is present but value is None
         related_url = ""
 
-    obj, created = Component.objects.update_or_create(
-        type=build_data["type"],
-        name=build_data["meta"].pop("name"),
+    key = tree.add_component(
+        build_data["type"],
+        build_data["meta"].pop("name"),
         version=build_data["meta"].pop("version"),
         release=build_data["meta"].pop("release"),
         arch="noarch",
@@ -367,25 +552,25 @@ def save_container(softwarebuild: SoftwareBuild, build_data: dict) -> ComponentN
             "related_url": related_url,
             "software_build": softwarebuild,
         },
+        # Never erase an existing license, see set_license_declared_safely()
+        license_declared_raw=license_declared_raw,
     )
-
-    set_license_declared_safely(obj, license_declared_raw)
-    root_node = save_node(ComponentNode.ComponentNodeType.SOURCE, None, obj)
+    root_node = tree.add_node(ComponentNode.ComponentNodeType.SOURCE, None, key)
 
     if "upstream_go_modules" in build_data["meta"]:
         meta_attr = {"go_component_type": "gomod", "source": ["collectors/brew"]}
         for module in build_data["meta"]["upstream_go_modules"]:
             # the upstream commit is included in the dist-git commit history, but is not
             # exposed anywhere in the brew data that I can find, so can't set version
-            save_upstream(Component.Type.GOLANG, module, "", meta_attr, {}, root_node)
+            _add_upstream(tree, Component.Type.GOLANG, module, "", meta_attr, {}, root_node)
 
     if "image_components" in build_data:
         for image in build_data["image_components"]:
             license_declared_raw = image["meta"].pop("license", "")
 
-            obj, created = Component.objects.update_or_create(
-                type=image["type"],
-                name=image["meta"].pop("name"),
+            key = tree.add_component(
+                image["type"],
+                image["meta"].pop("name"),
                 version=image["meta"].pop("version"),
                 release=image["meta"].pop("release"),
                 arch=image["meta"].pop("arch"),
@@ -395,9 +580,9 @@ def save_container(softwarebuild: SoftwareBuild, build_data: dict) -> ComponentN
                     "meta_attr": image["meta"],
                     "namespace": Component.Namespace.REDHAT,
                 },
+                license_declared_raw=license_declared_raw,
             )
 
-            set_license_declared_safely(obj, license_declared_raw)
             # Based on a conversation with the container factory team,
             # almost all image components are build-time dependencies in a multi-stage build
             # and are discarded / do not end up in the final image.
@@ -405,11 +590,13 @@ def save_container(softwarebuild: SoftwareBuild, build_data: dict) -> ComponentN
             # So we should probably still use PROVIDES here, and not PROVIDES_DEV
             # Unless we can distinguish between these two types of components
             # using some other Brew metadata
-            image_arch_node = save_node(ComponentNode.ComponentNodeType.PROVIDES, root_node, obj)
+            image_arch_node = tree.add_node(
+                ComponentNode.ComponentNodeType.PROVIDES, root_node, key
+            )
 
             if "rpm_components" in image:
                 for rpm in image["rpm_components"]:
-                    save_component(rpm, image_arch_node)
+                    _add_component(tree, rpm, image_arch_node)
                     # SRPMs are loaded using nested_builds
 
     if "sources" in build_data:
@@ -432,12 +619,19 @@ def save_container(softwarebuild: SoftwareBuild, build_data: dict) -> ComponentN
                 source["meta"]["go_component_type"] = "gomod"
 
             extra = {"related_url": related_url}
-            _, upstream_node = save_upstream(
-                source["type"], component_name, component_version, source["meta"], extra, root_node
+            upstream_node = _add_upstream(
+                tree,
+                source["type"],
+                component_name,
+                component_version,
+                source["meta"],
+                extra,
+                root_node,
             )
 
             # Collect the Cachito dependencies
-            recurse_components(source, upstream_node)
+            for child in source.get("components", ()):
+                _add_component(tree, child, upstream_node)
     return root_node
 
 
@@ -450,16 +644,16 @@ def recurse_components(component: dict, parent: ComponentNode):
                 save_component(child, parent)
 
 
-def save_module(softwarebuild, build_data) -> ComponentNode:
+def _add_module(tree: ComponentTree, softwarebuild: SoftwareBuild, build_data: dict) -> dict:
     """Upstreams are not created because modules have no related source code. They are a
     collection of RPMs from other SRPMS. The upstreams can be looked up from all the RPM children.
     No child components are created here because we don't have enough data in Brew to determine
     the relationships. We create the relationships using data from RHEL_COMPOSE, or RPM repository
     See CORGI-200, and CORGI-163"""
     meta_attr = build_data["meta"]["meta_attr"]
-    obj, created = Component.objects.update_or_create(
-        type=build_data["type"],
-        name=build_data["meta"]["name"],
+    key = tree.add_component(
+        build_data["type"],
+        build_data["meta"]["name"],
         version=build_data["meta"].get("version", ""),
         release=build_data["meta"].get("release", ""),
         arch=build_data["meta"].get("arch", "noarch"),
@@ -471,18 +665,22 @@ def save_module(softwarebuild, build_data) -> ComponentNode:
             "software_build": softwarebuild,
         },
     )
-    node = save_node(ComponentNode.ComponentNodeType.SOURCE, None, obj)
-
-    return node
-
-
-def save_upstream(
-    component_type: str, name: str, version: str, meta_attr: dict, extra: dict, node: ComponentNode
-) -> tuple[Component, ComponentNode]:
-    """Helper function to save an upstream component and create a node for it"""
-    upstream_component, _ = Component.objects.update_or_create(
-        type=component_type,
-        name=name,
+    return tree.add_node(ComponentNode.ComponentNodeType.SOURCE, None, key)
+
+
+def _add_upstream(
+    tree: ComponentTree,
+    component_type: str,
+    name: str,
+    version: str,
+    meta_attr: dict,
+    extra: dict,
+    node: dict,
+) -> dict:
+    """Helper function to add an upstream component and a node for it to the tree"""
+    key = tree.add_component(
+        component_type,
+        name,
         version=version,
         release="",
         arch="noarch",
@@ -492,9 +690,7 @@ def save_upstream(
             "namespace": Component.Namespace.UPSTREAM,
         },
     )
-    upstream_node = save_node(ComponentNode.ComponentNodeType.SOURCE, node, upstream_component)
-
-    return upstream_component, upstream_node
+    return tree.add_node(ComponentNode.ComponentNodeType.SOURCE, node, key)
 
 
 def save_node(
@@ -599,19 +795,29 @@ def fetch_unprocessed_relations(
     relations_query = ProductComponentRelation.objects.filter(query).filter(software_build=None)
 
     processed_builds = 0
+    centos_build_ids = []
+    build_ids = []
     for relation in relations_query.iterator():
         logger.info(f"Processing {relation.type} relation build with id: {relation.build_id}")
         if relation.build_type == SoftwareBuild.Type.CENTOS:
-            # This skips use of the Collector models for builds in the CENTOS koji instance
-            # It was done to avoid updating the collector models not to use build_id as
-            # a primary key. It's possible because the only product stream (openstack-rdo)
-            # stored in CENTOS koji doesn't use modules
-            slow_fetch_brew_build.delay(
-                relation.build_id, SoftwareBuild.Type.CENTOS, force_process=force_process
-            )
+            centos_build_ids.append(relation.build_id)
         else:
-            slow_fetch_modular_build.delay(relation.build_id, force_process=force_process)
+            build_ids.append(relation.build_id)
         processed_builds += 1
+    # Builds are often in many relations, so only fetch each one once
+    # fetch_builds uses slow_fetch_brew_build directly for CENTOS builds, since they aren't modules
+    fetch_builds(
+        tuple(dict.fromkeys(centos_build_ids)),
+        SoftwareBuild.Type.CENTOS,
+        slow_fetch_brew_build,
+        force_process=force_process,
+    )
+    fetch_builds(
+        tuple(dict.fromkeys(build_ids)),
+        BUILD_TYPE,
+        slow_fetch_modular_build,
+        force_process=force_process,
+    )
     return processed_builds
 
 
@@ -680,6 +886,9 @@ def slow_update_brew_tags(build_id: str, tag_added: str = "", tag_removed: str =
             build.meta_attr["errata_tags"]
         )
         build.save()
+        # The build may have been released, so its latest released components may change
+        LatestComponent.refresh_for_components(build.components.values_list("pk", flat=True))
+        Component.bump_generations(build.get_tree_component_pks())
         return f"Added tag {tag_added} or removed tag {tag_removed} for build {build_id}"
 
 
@@ -711,6 +920,8 @@ def slow_refresh_brew_build_tags(build_id: int) -> None:
         build.meta_attr["errata_tags"] = errata_tags
         build.meta_attr["released_errata_tags"] = released_errata_tags
         build.save()
+        LatestComponent.refresh_for_components(build.components.values_list("pk", flat=True))
+        Component.bump_generations(build.get_tree_component_pks())
 
     for erratum_id in sorted(new_errata_tags):
         slow_load_errata.delay(erratum_id)
@@ -752,6 +963,14 @@ def slow_delete_brew_build(build_id: int, build_state: int) -> int:
         # Skip deleting child components when build doesn't exist
         if root_component_and_build_pks:
             root_component_pk, build_pk = root_component_and_build_pks
+            # Find the cached API responses to invalidate before the components are gone
+            Component.bump_generations(SoftwareBuild(pk=build_pk).get_tree_component_pks())
+            # Once the root component is deleted, some older build may become the latest
+            latest_groups = tuple(
+                Component.objects.filter(pk=root_component_pk).values_list(
+                    "namespace", "name", "arch"
+                )
+            )
             # The build has a root component, so delete the child components that are
             # provided by / upstreams of only this build's root, and not any other builds
             # Deleting the Component will automatically delete the ComponentNodes
@@ -782,6 +1001,8 @@ def slow_delete_brew_build(build_id: int, build_state: int) -> int:
         # But not the child components, so we handled those separately above
         builds = SoftwareBuild.objects.filter(build_id=build_id, build_type=SoftwareBuild.Type.BREW)
         deleted_count += _delete_queryset(builds, "build")
+        if root_component_and_build_pks:
+            LatestComponent.refresh(latest_groups)
 
     return deleted_count
 
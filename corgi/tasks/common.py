@@ -1,8 +1,10 @@
 import logging
 import subprocess
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Collection, Optional
 
+import redis
 from celery.local import PromiseProxy
 from django.conf import settings
 from django.db.utils import InterfaceError as DjangoInterfaceError
@@ -12,6 +14,7 @@ from psycopg2.errors import InterfaceError as Psycopg2InterfaceError
 from redis.exceptions import ConnectionError as RedisConnectionError
 from requests.exceptions import RequestException
 
+from config.celery import app
 from corgi.core.models import ProductComponentRelation, SoftwareBuild
 
 BACKOFF_KWARGS = {"max_tries": 5, "jitter": None}
@@ -35,6 +38,20 @@ RETRY_KWARGS = {
 
 BUILD_TYPE = SoftwareBuild.Type.KOJI if settings.COMMUNITY_MODE_ENABLED else SoftwareBuild.Type.BREW
 
+# Fewer builds than this are fetched by separate tasks, so they can be processed in parallel
+# More builds are fetched in batches, each with one Brew session and one task / broker message
+FETCH_BATCH_THRESHOLD = 10
+FETCH_BATCH_SIZE = 100
+# A batch stops starting new builds after this many seconds, and queues the rest in a new batch
+# This leaves time for the last build to finish before the batch's soft time limit
+FETCH_BATCH_TIME_BUDGET = (
+    settings.CELERY_LONGEST_SOFT_TIME_LIMIT - settings.CELERY_TASK_SOFT_TIME_LIMIT
+)
+# Sorted set of "build_type:build_id" members for builds in some batch that hasn't finished yet
+# Scores are the time the build was queued, so entries for batches that died can expire
+IN_FLIGHT_BUILDS_KEY = "corgi-in-flight-builds"
+IN_FLIGHT_BUILDS_EXPIRY = 60 * 60 * 24
+
 logger = logging.getLogger(__name__)
 
 
@@ -78,7 +95,7 @@ def create_relations(
     relation_type: ProductComponentRelation.Type,
     refresh_task: Optional[PromiseProxy],
 ) -> int:
-    no_of_relations = 0
+    created_build_ids = []
     for build_id in build_ids:
         _, created = ProductComponentRelation.objects.get_or_create(
             external_system_id=external_system_id,
@@ -88,20 +105,71 @@ def create_relations(
             defaults={"type": relation_type},
         )
         if created:
-            # When creating relations via fetch_brew_build we call save_product_taxonomy right after
-            # we call this function, so no need to refresh the build.
-            if refresh_task:
-                # Similar to fetch_unprocessed_relations
-                # This skips use of the Collector models for builds in the CENTOS koji instance
-                # It was done to avoid updating the collector models not to use build_id as
-                # a primary key. It's possible because the only product stream (openstack-rdo)
-                # stored in CENTOS koji doesn't use modules
-                if build_type == SoftwareBuild.Type.CENTOS:
-                    refresh_task.delay(build_id=build_id, build_type=SoftwareBuild.Type.CENTOS)
-                else:
-                    refresh_task.delay(build_id=build_id)
-            no_of_relations += 1
-    return no_of_relations
+            created_build_ids.append(build_id)
+    # When creating relations via fetch_brew_build we call save_product_taxonomy right after
+    # we call this function, so no need to refresh the build.
+    if refresh_task:
+        fetch_builds(created_build_ids, build_type, refresh_task)
+    return len(created_build_ids)
+
+
+def fetch_builds(
+    build_ids: Collection[str],
+    build_type: str,
+    refresh_task: PromiseProxy,
+    force_process: bool = False,
+) -> None:
+    """Fetch some builds from Brew and save them, using refresh_task for only a few builds
+    or the batch task slow_fetch_brew_builds for many, e.g. when backfilling a whole stream"""
+    # This skips use of the Collector models for builds in the CENTOS koji instance
+    # It was done to avoid updating the collector models not to use build_id as
+    # a primary key. It's possible because the only product stream (openstack-rdo)
+    # stored in CENTOS koji doesn't use modules
+    if len(build_ids) < FETCH_BATCH_THRESHOLD:
+        for build_id in build_ids:
+            if build_type == SoftwareBuild.Type.CENTOS:
+                refresh_task.delay(
+                    build_id=build_id,
+                    build_type=SoftwareBuild.Type.CENTOS,
+                    force_process=force_process,
+                )
+            else:
+                refresh_task.delay(build_id=build_id, force_process=force_process)
+        return
+
+    # Modules are looked up in the Collector models, before the build itself is fetched
+    check_modules = refresh_task.name == "corgi.tasks.brew.slow_fetch_modular_build"
+    build_ids = claim_builds(build_ids, build_type)
+    for start in range(0, len(build_ids), FETCH_BATCH_SIZE):
+        # Use the task name, since corgi.tasks.brew imports this module
+        app.send_task(
+            "corgi.tasks.brew.slow_fetch_brew_builds",
+            args=(build_ids[start : start + FETCH_BATCH_SIZE], build_type),
+            kwargs={"check_modules": check_modules, "force_process": force_process},
+        )
+    logger.info(f"Queued {len(build_ids)} {build_type} builds in batches of {FETCH_BATCH_SIZE}")
+
+
+def get_redis() -> redis.Redis:
+    return redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+
+def claim_builds(build_ids: Collection[str], build_type: str) -> list[str]:
+    """Mark builds as in flight, and return only the ones that weren't already"""
+    now = time.time()
+    # Don't queue the same build twice in one call either
+    unique_build_ids = list(dict.fromkeys(str(build_id) for build_id in build_ids))
+    with get_redis().pipeline() as pipe:
+        pipe.zremrangebyscore(IN_FLIGHT_BUILDS_KEY, "-inf", now - IN_FLIGHT_BUILDS_EXPIRY)
+        for build_id in unique_build_ids:
+            pipe.zadd(IN_FLIGHT_BUILDS_KEY, {f"{build_type}:{build_id}": now}, nx=True)
+        added = pipe.execute()[1:]
+    return [build_id for build_id, was_added in zip(unique_build_ids, added) if was_added]
+
+
+def release_build(build_id: str, build_type: str) -> None:
+    """Mark a build as no longer in flight, after it's been saved (or failed to save)"""
+    get_redis().zrem(IN_FLIGHT_BUILDS_KEY, f"{build_type}:{build_id}")
 
 
 def run_external(
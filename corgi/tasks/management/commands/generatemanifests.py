@@ -1,6 +1,11 @@
 from django.core.management.base import BaseCommand, CommandParser
 
-from corgi.tasks.manifest import cpu_update_ps_manifest, update_manifests
+from corgi.tasks.manifest import (
+    cpu_update_ps_manifest,
+    generate_manifests,
+    get_manifest_stream_names,
+    update_manifests,
+)
 
 
 class Command(BaseCommand):
@@ -19,11 +24,41 @@ class Command(BaseCommand):
             action="store_false",
             help="Skip applying manifest fixups",
         )
+        parser.add_argument(
+            "-p",
+            "--processes",
+            type=int,
+            help="Update the manifests for all streams in this many local processes, "
+            "instead of in Celery tasks",
+        )
 
     def handle(self, *args, **options) -> None:
         if options["stream"]:
             self.stdout.write(self.style.SUCCESS(f"Updating manifest for {options['stream']}"))
             cpu_update_ps_manifest(options["stream"], fixup=options["skip_fixups"])
+        elif options["processes"]:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Updating manifests for all streams in {options['processes']} processes"
+                )
+            )
+            results = generate_manifests(
+                get_manifest_stream_names(),
+                fixup=options["skip_fixups"],
+                processes=options["processes"],
+            )
+            for result in results:
+                self.stdout.write(
+                    f"{result['stream']}: {result['seconds']}s, {result['bytes']} bytes"
+                )
+            total_seconds = round(sum(result["seconds"] for result in results), 3)
+            total_bytes = sum(result["bytes"] for result in results)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Updated {len(results)} manifests in {total_seconds}s, "
+                    f"wrote {total_bytes} bytes"
+                )
+            )
         else:
             self.stdout.write(self.style.SUCCESS("Updating manifests for all streams"))
             update_manifests(fixup=options["skip_fixups"])
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand, CommandParser
 
 from corgi.core.models import SoftwareBuild
+from corgi.core.taxonomy import save_component_taxonomy_for_build
 
 
 class Command(BaseCommand):
@@ -37,5 +38,4 @@ class Command(BaseCommand):
                 )
             )
             sb.save_product_taxonomy()
-            for component in sb.components.get_queryset():
-                component.save_component_taxonomy()
+            save_component_taxonomy_for_build(sb)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from corgi.core.models import Component, LatestComponent
+
+# Number of (namespace, name, arch) groups to refresh in each transaction
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+
+    help = "Update the latest root components in each product model."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "component_names",
+            nargs="*",
+            type=str,
+            help="Specific component names to update.",
+        )
+
+    def handle(self, *args, **options):
+        roots = Component.objects.root_components()
+        if options["component_names"]:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"updating {options['component_names']} latest components",
+                )
+            )
+            roots = roots.filter(name__in=options["component_names"])
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    "updating all latest components",
+                )
+            )
+        groups = list(roots.values_list("namespace", "name", "arch").order_by().distinct())
+        for start in range(0, len(groups), BATCH_SIZE):
+            LatestComponent.refresh(groups[start : start + BATCH_SIZE])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"updated latest components for {len(groups)} namespaces / names / arches",
+            )
+        )
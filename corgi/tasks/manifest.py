@@ -1,14 +1,26 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Iterable, Optional
+
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton
 from django.conf import settings
+from django.db import connections
 from django.db.models import Count
 
 from config.celery import app
+from corgi.core.files import ComponentLinksCache, ProductManifestFile
+from corgi.core.instrumentation import span
 from corgi.core.models import ProductStream
 from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS
 
 logger = get_task_logger(__name__)
 
+# Links for the components seen by a process in generate_manifests(), shared by its streams
+_component_links: Optional[ComponentLinksCache] = None
+
 
 @app.task(
     base=Singleton,
@@ -17,10 +29,22 @@ logger = get_task_logger(__name__)
 )
 def update_manifests(fixup=True):
     # Note - temporarily setting fixup=True
-    for ps in ProductStream.objects.annotate(num_components=Count("components")).filter(
-        num_components__gt=0
-    ):
-        cpu_update_ps_manifest.delay(ps.name, fixup=fixup)
+    for product_stream in get_manifest_stream_names():
+        cpu_update_ps_manifest.delay(product_stream, fixup=fixup)
+
+
+def get_manifest_stream_names() -> list[str]:
+    """Return the names of all streams with components, largest first
+
+    Starting with the manifests that take longest keeps every worker busy until the end,
+    instead of leaving one worker with a large stream after the others have finished.
+    """
+    return list(
+        ProductStream.objects.annotate(num_components=Count("components"))
+        .filter(num_components__gt=0)
+        .order_by("-num_components", "name")
+        .values_list("name", flat=True)
+    )
 
 
 @app.task(
@@ -28,25 +52,97 @@ def update_manifests(fixup=True):
     autoretry_for=RETRYABLE_ERRORS,
     retry_kwargs=RETRY_KWARGS,
 )
-def cpu_update_ps_manifest(product_stream: str, fixup=True):
+def cpu_update_ps_manifest(product_stream: str, fixup=True) -> dict[str, Any]:
+    return update_ps_manifest(product_stream, fixup=fixup)
+
+
+def update_ps_manifest(
+    product_stream: str,
+    fixup: bool = True,
+    component_links: Optional[ComponentLinksCache] = None,
+) -> dict[str, Any]:
+    """Write the manifest for some stream if its content changed,
+    and return how long that took and how many bytes were written"""
     logger.info("Updating manifest for %s", product_stream)
+    start = time.monotonic()
+    bytes_written = 0
     ps = ProductStream.objects.get(name=product_stream)
-    # TODO figure out a way to skip updating files where the content doesnt need updating
-    # for example we could render the manifest in a temp file, remove the created_at line and diff
-    # the contents only if there is a difference we can overwrite the file.
-    # This would could save a lot of resource downstream, because clients could just check if the
+    # Manifests are only written when their content changes, so clients can check if the
     # file has been modified before obtaining the updated copy.
     # collectstatic does not modify a file in staticfiles directory if it
     # hasn't been updated in outputfiles.
     if ps.components.manifest_components(quick=True).exists():
-        logger.info(f"Generating manifest for {product_stream}")
-        with open(f"{settings.STATIC_ROOT}/{product_stream}-{ps.pk}.json", "w") as fh:
-            if fixup:
-                fh.write(ps.manifest_with_cpe_fixup)
-            else:
-                fh.write(ps.manifest)
+        file_name = f"{settings.STATIC_ROOT}/{product_stream}-{ps.pk}.json"
+        manifest_file = ProductManifestFile(ps, component_links=component_links)
+        with span("fingerprint"):
+            fingerprint = manifest_file.get_fingerprint(cpe_mapping=fixup)
+        if os.path.exists(file_name) and read_fingerprint(file_name) == fingerprint:
+            logger.info(
+                f"Manifest for {product_stream} hasn't changed, skipping manifest generation"
+            )
+        else:
+            logger.info(f"Generating manifest for {product_stream}")
+            # Write to a temporary file first, so the old manifest stays in place until the new
+            # one is complete, even though the manifest is written out as it's generated
+            with span("write_manifest"), open(f"{file_name}.tmp", "w") as fh:
+                manifest_file.write(fh, cpe_mapping=fixup)
+            bytes_written = os.path.getsize(f"{file_name}.tmp")
+            os.replace(f"{file_name}.tmp", file_name)
+            # Saved after the manifest, so it never matches a manifest that failed to be written
+            with open(f"{file_name}.fingerprint", "w") as fh:
+                fh.write(fingerprint)
     else:
         logger.info(
             f"Didn't find any released components for {product_stream}, "
             f"skipping manifest generation"
         )
+
+    result = {
+        "stream": product_stream,
+        "seconds": round(time.monotonic() - start, 3),
+        "bytes": bytes_written,
+    }
+    logger.info(
+        f"Updated manifest for {product_stream} in {result['seconds']}s, "
+        f"wrote {bytes_written} bytes"
+    )
+    return result
+
+
+def read_fingerprint(file_name: str) -> str:
+    """Return the fingerprint of the data in a manifest file, from when it was last written"""
+    try:
+        with open(f"{file_name}.fingerprint", "r") as fh:
+            return fh.read()
+    except FileNotFoundError:
+        return ""
+
+
+def generate_manifests(
+    stream_names: Iterable[str], fixup: bool = True, processes: int = 1
+) -> list[dict[str, Any]]:
+    """Update the manifests for many streams in a pool of processes, without Celery, in order
+
+    Each process remembers the provided nodes and upstreams of the root components it's seen
+    most recently, up to settings.MANIFEST_COMPONENT_LINKS_MAX_NODES provided nodes,
+    so components which are in many streams are usually only looked up once per process.
+    Returns how long each stream took, and how many bytes were written for it.
+    """
+    update = partial(_update_ps_manifest_in_pool, fixup=fixup)
+    if processes <= 1:
+        _start_manifest_process()
+        return [update(product_stream) for product_stream in stream_names]
+
+    # Each forked process must open its own DB connections, instead of sharing ours
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_start_manifest_process) as pool:
+        return list(pool.map(update, stream_names))
+
+
+def _start_manifest_process() -> None:
+    global _component_links
+    _component_links = ComponentLinksCache(settings.MANIFEST_COMPONENT_LINKS_MAX_NODES)
+
+
+def _update_ps_manifest_in_pool(product_stream: str, fixup: bool = True) -> dict[str, Any]:
+    return update_ps_manifest(product_stream, fixup=fixup, component_links=_component_links)
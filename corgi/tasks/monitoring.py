@@ -1,7 +1,7 @@
 from datetime import timedelta
 
 from celery import states as celery_states
-from celery.signals import beat_init
+from celery.signals import beat_init, task_postrun, task_prerun
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton, clear_locks
 from django.conf import settings
@@ -13,12 +13,24 @@ from django_celery_results.models import TaskResult
 
 from config.celery import app
 from config.utils import running_dev
+from corgi.core.instrumentation import finish_task, start_task
 
 from .common import get_last_success_for_task
 
 logger = get_task_logger(__name__)
 
 
+@task_prerun.connect
+def start_task_profile(sender=None, **kwargs):
+    """Record how long each stage of every task takes, see corgi.core.instrumentation"""
+    start_task(sender.name)
+
+
+@task_postrun.connect
+def finish_task_profile(sender=None, **kwargs):
+    finish_task()
+
+
 @beat_init.connect
 def setup_periodic_tasks(sender, **kwargs):
     def upsert_cron_task(module, task, **kwargs):
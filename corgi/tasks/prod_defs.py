@@ -10,6 +10,7 @@ from corgi.collectors.models import (
     CollectorErrataProductVersion,
 )
 from corgi.collectors.prod_defs import ProdDefs
+from corgi.core.cache import bump_generations
 from corgi.core.models import (
     Product,
     ProductNode,
@@ -252,3 +253,5 @@ def update_products() -> None:
                     product_stream.save_product_taxonomy()
                 product_version.save_product_taxonomy()
             product.save_product_taxonomy()
+        # Cached responses for every product model may have changed
+        bump_generations(("products", "product_streams"))
@@ -17,7 +17,9 @@ from requests import Response
 from config.celery import app
 from corgi.collectors.go_list import GoList
 from corgi.collectors.syft import Syft
+from corgi.core.instrumentation import external_call, span
 from corgi.core.models import Component, ComponentNode, SoftwareBuild
+from corgi.core.taxonomy import save_component_taxonomy_for_build
 from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS
 
 LOOKASIDE_SCRATCH_SUBDIR = "lookaside"
@@ -170,18 +172,21 @@ def cpu_software_composition_analysis(build_uuid, force_process: bool = False):
     if not root_node:
         raise ValueError(f"Didn't find root component node for {root_component.purl}")
 
-    distgit_sources = _get_distgit_sources(software_build.source, build_uuid)
+    with external_call("dist-git"):
+        distgit_sources = _get_distgit_sources(software_build.source, build_uuid)
 
-    no_of_new_components = _scan_files(root_node, distgit_sources)
+    with span("scan_files"):
+        no_of_new_components = _scan_files(root_node, distgit_sources)
     if no_of_new_components > 0 or force_process:
         if no_of_new_components > 0:
             logger.warning(
                 f"Root component {root_component.purl} for build {build_uuid}"
                 "had child components that were not found in remote-sources.json!"
             )
-        software_build.save_product_taxonomy()
-        for component in software_build.components.get_queryset():
-            component.save_component_taxonomy()
+        with span("save_product_taxonomy"):
+            software_build.save_product_taxonomy()
+        # Also saves the taxonomy for new components found by the scan, not just the root
+        save_component_taxonomy_for_build(software_build)
 
     # clean up source code so that we don't have to deal with reuse and an ever growing disk
     for source in distgit_sources:
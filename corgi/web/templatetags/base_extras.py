@@ -2,7 +2,7 @@ from django import template
 from django.conf import settings
 
 from corgi import __version__
-from corgi.core.models import Component
+from corgi.core.files import provided_relationship
 
 register = template.Library()
 
@@ -33,13 +33,5 @@ def app_git_ref():
     return f" ({git_ref[:8]})" if git_ref else ""
 
 
-@register.filter
-def provided_relationship(node_purl: str, node_type: str) -> str:
-    """Relate a provided component to its parent component, based on purl and provided node type"""
-    if node_purl.startswith(f"pkg:{Component.Type.CONTAINER_IMAGE.lower()}/"):
-        # Arch-specific container is a variant of (arch-independent / noarch) index-container
-        return "VARIANT_OF"
-    elif node_type == "PROVIDES_DEV":
-        return "DEV_DEPENDENCY_OF"
-    else:
-        return "CONTAINED_BY"
+# Relate a provided component to its parent component, based on purl and provided node type
+register.filter("provided_relationship", provided_relationship)
@@ -1,4 +1,6 @@
 import pytest
+from django.db import connections
+from django.db.models.signals import pre_migrate
 from rest_framework.test import APIClient
 
 from corgi.api.constants import CORGI_API_VERSION
@@ -11,6 +13,15 @@ from tests.factories import (
 )
 
 
+def create_trigram_extension(using, **kwargs):
+    """Tests skip migrations, so create the extension the trigram indexes need before tables"""
+    with connections[using].cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+
+pre_migrate.connect(create_trigram_extension, dispatch_uid="create_trigram_extension")
+
+
 @pytest.fixture
 def client():
     return APIClient()
@@ -26,10 +37,10 @@ def api_path(api_version):
     return f"/api/{api_version}"
 
 
-def setup_product():
+def setup_product(**stream_kwargs):
     product = ProductFactory()
     version = ProductVersionFactory(products=product)
-    stream = ProductStreamFactory(products=product, productversions=version)
+    stream = ProductStreamFactory(products=product, productversions=version, **stream_kwargs)
     variant = ProductVariantFactory(
         name="1", products=product, productversions=version, productstreams=stream
     )
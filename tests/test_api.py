@@ -1,18 +1,35 @@
+import gzip
+import json
 from urllib.parse import quote
 
 import pytest
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
 from rest_framework.authtoken.models import Token
 
+from corgi.api import views
+from corgi.api.cache import render_cache_metrics
+from corgi.api.constants import CORGI_API_URL
+from corgi.api.pagination import EstimatedCountPagination
+from corgi.api.serializers import get_component_purl_link
 from corgi.collectors.appstream_lifecycle import AppStreamLifeCycleCollector
-from corgi.core.models import Component, ComponentNode, SoftwareBuild
+from corgi.core.models import (
+    Component,
+    ComponentNode,
+    LatestComponent,
+    ProductComponentRelation,
+    SoftwareBuild,
+)
 
 from .factories import (
     ChannelFactory,
     ComponentFactory,
     ComponentTagFactory,
+    ContainerImageComponentFactory,
     LifeCycleFactory,
+    ProductComponentRelationFactory,
     ProductFactory,
     ProductStreamFactory,
     ProductVariantFactory,
@@ -244,6 +261,7 @@ def test_latest_components_by_stream_filter(client, api_path):
             older_upstream_component,
             newer_upstream_component,
         )
+    LatestComponent.refresh_for_components(Component.objects.values_list("pk", flat=True))
 
     response = client.get(f"{api_path}/components")
     assert response.status_code == 200
@@ -363,6 +381,7 @@ def test_latest_components_by_streams_filter(client, api_path):
         release="11",
     )
     newest_component.productstreams.add(ps2)
+    LatestComponent.refresh_for_components(Component.objects.values_list("pk", flat=True))
 
     response = client.get(f"{api_path}/components")
     assert response.status_code == 200
@@ -943,6 +962,436 @@ def test_product_variants(client, api_path):
     assert response.status_code == 200
 
 
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_cursor_pagination(client, api_path):
+    for name in ("a", "b"):
+        for version in ("1", "2", "3"):
+            ComponentFactory(name=name, type=Component.Type.RPM, arch="x86_64", version=version)
+
+    response = client.get(f"{api_path}/components?pagination=cursor&limit=4")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 6
+    assert data["previous"] is None
+    assert [(c["name"], c["version"]) for c in data["results"]] == [
+        ("a", "1"),
+        ("a", "2"),
+        ("a", "3"),
+        ("b", "1"),
+    ]
+    assert "cursor=" in data["next"]
+    assert "offset=" not in data["next"]
+
+    # The next link keeps the other query params, and skipping the count is optional
+    response = client.get(f"{data['next']}&count=false")
+    assert response.status_code == 200
+    data = response.json()
+    assert "count" not in data
+    assert data["next"] is None
+    assert [(c["name"], c["version"]) for c in data["results"]] == [("b", "2"), ("b", "3")]
+
+    # Offset pagination is still the default
+    response = client.get(f"{api_path}/components?limit=4&offset=4")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 6
+    # The previous page starts at the first result, so its link has no offset
+    assert data["previous"] == f"http://testserver{api_path}/components?limit=4"
+    assert [(c["name"], c["version"]) for c in data["results"]] == [("b", "2"), ("b", "3")]
+
+    response = client.get(f"{api_path}/components?cursor=not-a-cursor")
+    assert response.status_code == 404
+
+    ProductFactory(name="rhel")
+    ProductFactory(name="rhel-av")
+    response = client.get(f"{api_path}/products?pagination=cursor&limit=1&count=false")
+    assert response.status_code == 200
+    data = response.json()
+    assert [p["name"] for p in data["results"]] == ["rhel"]
+    response = client.get(data["next"])
+    assert response.status_code == 200
+    data = response.json()
+    assert [p["name"] for p in data["results"]] == ["rhel-av"]
+    assert data["next"] is None
+
+
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_estimated_count(client, api_path, monkeypatch):
+    for version in ("1", "2", "3", "4", "5", "6"):
+        ComponentFactory(name="a", type=Component.Type.RPM, arch="x86_64", version=version)
+    ProductStreamFactory()
+
+    response = client.get(f"{api_path}/components?limit=4")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 6
+    assert data["count_estimated"] is False
+    response = client.get(f"{api_path}/product_streams")
+    assert response.status_code == 200
+    assert response.json()["count"] == 1
+    assert response.json()["count_estimated"] is False
+
+    # Large results only get the query planner's estimate
+    monkeypatch.setattr(EstimatedCountPagination, "exact_count_threshold", 0)
+    response = client.get(f"{api_path}/components?limit=4")
+    assert response.status_code == 200
+    data = response.json()
+    assert isinstance(data["count"], int)
+    assert data["count_estimated"] is True
+    assert len(data["results"]) == 4
+    # Links don't depend on the count, since it may be wrong
+    assert data["previous"] is None
+    response = client.get(data["next"])
+    assert response.status_code == 200
+    data = response.json()
+    assert [c["version"] for c in data["results"]] == ["5", "6"]
+    assert data["next"] is None
+    assert "offset=" not in data["previous"]
+
+    # Or clients can skip counting completely
+    response = client.get(f"{api_path}/components?limit=4&count=false")
+    assert response.status_code == 200
+    data = response.json()
+    assert "count" not in data
+    assert "count_estimated" not in data
+    assert "offset=4" in data["next"]
+
+
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_component_list_query_count(client, api_path):
+    stream = ProductStreamFactory()
+    channel = ChannelFactory()
+
+    def create_components(count: int) -> None:
+        for _ in range(count):
+            name = f"component-{Component.objects.count()}"
+            srpm = SrpmComponentFactory(name=name)
+            srpm.productstreams.add(stream)
+            srpm.channels.add(channel)
+            rpm = ComponentFactory(
+                name=name, type=Component.Type.RPM, arch="x86_64", software_build=None
+            )
+            rpm.sources.add(srpm)
+            upstream = ComponentFactory(name=name, type=Component.Type.GENERIC, software_build=None)
+            srpm.upstreams.add(upstream)
+            ProductComponentRelationFactory(
+                type=ProductComponentRelation.Type.ERRATA, software_build=srpm.software_build
+            )
+
+    def count_queries(path: str) -> int:
+        with CaptureQueriesContext(connections["default"]) as default_queries:
+            with CaptureQueriesContext(connections["read_only"]) as read_only_queries:
+                response = client.get(path)
+        assert response.status_code == 200
+        return len(default_queries) + len(read_only_queries)
+
+    create_components(1)
+    full_page = count_queries(f"{api_path}/components?limit=50")
+    partial_page = count_queries(f"{api_path}/components?limit=50&include_fields=purl,sources")
+    # Only the relations that are shown get prefetched
+    assert partial_page < full_page
+
+    create_components(10)
+    assert count_queries(f"{api_path}/components?limit=50") == full_page
+    assert (
+        count_queries(f"{api_path}/components?limit=50&include_fields=purl,sources") == partial_page
+    )
+
+    # The prefetched data is the same as the data loaded for a single component
+    response = client.get(f"{api_path}/components?limit=50&type=RPM&arch=src")
+    assert response.status_code == 200
+    for result in response.json()["results"]:
+        component = Component.objects.get(uuid=result["uuid"])
+        assert result["errata"] == component.errata
+        assert len(result["errata"]) == 1
+        assert result["product_streams"] == [
+            {
+                "name": stream.name,
+                "link": f"{CORGI_API_URL}/product_streams?ofuri={stream.ofuri}",
+                "ofuri": stream.ofuri,
+            }
+        ]
+        assert result["channels"][0]["name"] == channel.name
+        assert result["provides"] == [
+            {"link": get_component_purl_link(purl), "purl": purl}
+            for purl in component.provides.values_list("purl", flat=True)
+        ]
+        assert len(result["upstreams"]) == 1
+        assert len(result["tags"]) == 1
+
+
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_component_export(client, api_path):
+    stream = ProductStreamFactory(name="rhel-8.8.0", version="8.8.0")
+    srpm = SrpmComponentFactory(name="curl", license_declared_raw="MIT and ASL 2.0")
+    srpm.productstreams.add(stream)
+    rpm = ComponentFactory(name="zlib", type=Component.Type.RPM, arch="x86_64")
+
+    response = client.get(f"{api_path}/components/export")
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/x-ndjson"
+    lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+    records = [json.loads(line) for line in lines]
+    assert [record["name"] for record in records] == ["curl", "zlib"]
+    assert records[0] == {
+        "link": f"{CORGI_API_URL}/components?purl={quote(srpm.purl)}",
+        "uuid": str(srpm.uuid),
+        "purl": srpm.purl,
+        "name": "curl",
+        "version": srpm.version,
+        "nvr": srpm.nvr,
+        "build_completion_dt": srpm.software_build.completion_time.isoformat().replace(
+            "+00:00", "Z"
+        ),
+    }
+
+    # The ofuri parameter and filters work the same way as the list endpoint
+    response = client.get(
+        f"{api_path}/components/export?ofuri={stream.ofuri}&fields=name,license_declared"
+    )
+    assert response.status_code == 200
+    records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+    assert records == [{"name": "curl", "license_declared": "MIT AND ASL-2.0"}]
+
+    response = client.get(f"{api_path}/components/export?arch=x86_64&fields=name")
+    assert response.status_code == 200
+    assert b"".join(response.streaming_content) == b'{"name":"zlib"}\n'
+
+    # Large exports can be compressed
+    response = client.get(
+        f"{api_path}/components/export?fields=name,build_id", HTTP_ACCEPT_ENCODING="gzip"
+    )
+    assert response.status_code == 200
+    assert response["Content-Encoding"] == "gzip"
+    lines = gzip.decompress(b"".join(response.streaming_content)).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"name": "curl", "build_id": srpm.software_build.build_id},
+        {"name": "zlib", "build_id": rpm.software_build.build_id},
+    ]
+
+    response = client.get(f"{api_path}/components/export?fields=name,sources")
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_component_resolve(client, api_path):
+    stream = ProductStreamFactory(name="rhel-8.8.0", version="8.8.0")
+    other_stream = ProductStreamFactory(name="rhel-8.6.0", version="8.6.0")
+    srpm = SrpmComponentFactory(name="curl")
+    srpm.productstreams.add(stream, other_stream)
+    rpm = ComponentFactory(name="curl-debuginfo", type=Component.Type.RPM, arch="x86_64")
+    # Purls are normalized before they're looked up, but the results use the purls as given
+    unnormalized_purl = srpm.purl.replace("pkg:rpm/", "pkg:RPM/")
+    purls = [srpm.purl, unnormalized_purl, rpm.purl, "pkg:rpm/redhat/missing@1.0", "not-a-purl"]
+
+    response = client.post(f"{api_path}/components/resolve", {"purls": purls}, format="json")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 3
+    assert data["results"] == {
+        srpm.purl: {
+            "link": f"{CORGI_API_URL}/components?purl={quote(srpm.purl)}",
+            "uuid": str(srpm.uuid),
+            "purl": srpm.purl,
+            "product_streams": [
+                {"name": "rhel-8.6.0", "ofuri": other_stream.ofuri},
+                {"name": "rhel-8.8.0", "ofuri": stream.ofuri},
+            ],
+        },
+        unnormalized_purl: data["results"][srpm.purl],
+        rpm.purl: {
+            "link": f"{CORGI_API_URL}/components?purl={quote(rpm.purl)}",
+            "uuid": str(rpm.uuid),
+            "purl": rpm.purl,
+            "product_streams": [],
+        },
+        "pkg:rpm/redhat/missing@1.0": None,
+        "not-a-purl": None,
+    }
+
+    response = client.post(
+        f"{api_path}/components/resolve",
+        {"purls": [rpm.purl], "fields": ["name", "arch", "license_declared"]},
+        format="json",
+    )
+    assert response.status_code == 200
+    assert response.json()["results"] == {
+        rpm.purl: {
+            "name": "curl-debuginfo",
+            "arch": "x86_64",
+            "license_declared": rpm.license_declared,
+        }
+    }
+
+    response = client.post(
+        f"{api_path}/components/resolve",
+        {"purls": [rpm.purl], "fields": ["sources"]},
+        format="json",
+    )
+    assert response.status_code == 400
+    response = client.post(f"{api_path}/components/resolve", {"purls": []}, format="json")
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_response_cache(client, api_path, settings):
+    settings.API_CACHE_ENABLED = True
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "api": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    }
+    stream = ProductStreamFactory(name="rhel-8.8.0", version="8.8.0")
+    srpm = SrpmComponentFactory(name="curl", description="old")
+    srpm.productstreams.add(stream)
+    LatestComponent.refresh_for_components((srpm.pk,))
+    other = SrpmComponentFactory(name="zlib", description="old")
+
+    def get_description(url: str) -> str:
+        response = client.get(url)
+        assert response.status_code == 200
+        data = response.json()
+        return data["results"][0]["description"] if "results" in data else data["description"]
+
+    component_url = f"{api_path}/components/{srpm.uuid}"
+    stream_url = f"{api_path}/components?ofuri={stream.ofuri}"
+    assert get_description(component_url) == "old"
+    assert get_description(stream_url) == "old"
+    assert get_description(f"{component_url}?include_fields=description&exclude_fields=name")
+
+    # Changes that don't bump any generations aren't visible until the cache expires
+    Component.objects.filter(pk__in=(srpm.pk, other.pk)).update(description="new")
+    assert get_description(component_url) == "old"
+    assert get_description(stream_url) == "old"
+    # Query parameters in a different order get the same cached response
+    url = f"{component_url}?exclude_fields=name&include_fields=description"
+    assert get_description(url) == "old"
+
+    # Only the responses for changed components, and their product models, are invalidated
+    other_url = f"{api_path}/components/{other.uuid}"
+    assert get_description(other_url) == "new"
+    Component.objects.filter(pk=other.pk).update(description="newer")
+    Component.bump_generations((srpm.pk,))
+    assert get_description(component_url) == "new"
+    assert get_description(stream_url) == "new"
+    assert get_description(other_url) == "new"
+
+    # Linking a newer build to the stream changes its latest components
+    newer = SrpmComponentFactory(name="curl", version="99", description="newest")
+    newer.productstreams.add(stream)
+    LatestComponent.refresh_for_components((newer.pk,))
+    assert get_description(stream_url) == "newest"
+
+    response = client.get(f"{api_path}/components/{srpm.uuid}/taxonomy")
+    assert response.status_code == 200
+    response = client.get(f"{api_path}/components/{srpm.uuid}/taxonomy")
+    assert response.status_code == 200
+
+    metrics = render_cache_metrics()
+    assert 'view="ComponentViewSet.retrieve",result="hit"} 3' in metrics
+    assert 'view="ComponentViewSet.retrieve",result="miss"} 4' in metrics
+    assert 'view="ComponentViewSet.list",result="hit"} 1' in metrics
+    assert 'view="ComponentViewSet.list",result="miss"} 3' in metrics
+    assert 'view="ComponentViewSet.taxonomy",result="hit"} 1' in metrics
+
+
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_component_taxonomy(client, api_path, monkeypatch):
+    root = ContainerImageComponentFactory(name="container")
+    root_node, _ = ComponentNode.objects.get_or_create(
+        type=ComponentNode.ComponentNodeType.SOURCE,
+        parent=None,
+        purl=root.purl,
+        defaults={"obj": root},
+    )
+
+    def add_node(parent: ComponentNode, name: str, node_type: str) -> ComponentNode:
+        component = ComponentFactory(name=name, type=Component.Type.RPM, arch="x86_64")
+        node, _ = ComponentNode.objects.get_or_create(
+            type=node_type, parent=parent, purl=component.purl, defaults={"obj": component}
+        )
+        return node
+
+    provided = add_node(root_node, "provided", ComponentNode.ComponentNodeType.PROVIDES)
+    nested = add_node(provided, "nested", ComponentNode.ComponentNodeType.PROVIDES_DEV)
+    required = add_node(root_node, "required", ComponentNode.ComponentNodeType.REQUIRES)
+
+    def count_queries(path: str) -> int:
+        with CaptureQueriesContext(connections["read_only"]) as queries:
+            response = client.get(path)
+        assert response.status_code == 200
+        return len(queries)
+
+    taxonomy_url = f"{api_path}/components/{root.uuid}/taxonomy"
+    query_count = count_queries(taxonomy_url)
+    response = client.get(taxonomy_url)
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 1
+    assert data[0]["purl"] == root.purl
+    assert data[0]["node_type"] == ComponentNode.ComponentNodeType.SOURCE
+    # Every descendant is listed, and each one also lists its own descendants
+    assert [node["purl"] for node in data[0]["provides"]] == [
+        provided.purl,
+        nested.purl,
+        required.purl,
+    ]
+    provided_data = data[0]["provides"][0]
+    assert provided_data == {
+        "purl": provided.purl,
+        "node_type": ComponentNode.ComponentNodeType.PROVIDES,
+        "node_id": provided.pk,
+        "obj_link": get_component_purl_link(provided.purl),
+        "obj_uuid": str(provided.component_id),
+        "namespace": provided.namespace,
+        "type": Component.Type.RPM,
+        "name": "provided",
+        "nvr": provided.component.nvr,
+        "release": provided.component.release,
+        "version": provided.component.version,
+        "arch": "x86_64",
+        "provides": [data[0]["provides"][1]],
+    }
+    assert data[0]["provides"][1]["name"] == "nested"
+    assert "provides" not in data[0]["provides"][1]
+
+    # Only the nodes for provided components are shown, but their descendants still are
+    response = client.get(f"{api_path}/components/{root.uuid}/provides")
+    assert response.status_code == 200
+    data = response.json()
+    assert data[0] == {"provides": [provided_data, provided_data["provides"][0], {}]}
+
+    response = client.get(f"{taxonomy_url}?max_depth=1")
+    assert response.status_code == 200
+    data = response.json()
+    assert [node["purl"] for node in data[0]["provides"]] == [provided.purl, required.purl]
+    assert "provides" not in data[0]["provides"][0]
+    response = client.get(f"{taxonomy_url}?max_depth=0")
+    assert response.status_code == 200
+    assert "provides" not in response.json()[0]
+    response = client.get(f"{taxonomy_url}?max_depth=-1")
+    assert response.status_code == 400
+
+    # The nested component's own taxonomy starts from its node
+    response = client.get(f"{api_path}/components/{nested.component_id}/taxonomy")
+    assert response.status_code == 200
+    assert [node["purl"] for node in response.json()] == [nested.purl]
+
+    # Bigger trees don't need more queries
+    for i in range(10):
+        add_node(nested, f"deeper-{i}", ComponentNode.ComponentNodeType.PROVIDES)
+    assert count_queries(f"{taxonomy_url}?max_depth=10") == query_count
+
+    # Very large taxonomies are streamed, with the same data
+    response = client.get(taxonomy_url)
+    assert response.status_code == 200
+    expected = response.json()
+    monkeypatch.setattr(views, "TAXONOMY_STREAMING_THRESHOLD", 0)
+    response = client.get(f"{taxonomy_url}?stream")
+    assert response.status_code == 200
+    assert response.streaming
+    assert json.loads(b"".join(response.streaming_content)) == expected
+
+
 @pytest.mark.django_db(databases=("read_only",))
 def test_status(client, api_path):
     response = client.get(f"{api_path}/status")
@@ -1058,6 +1507,25 @@ def test_product_components_versions(client, api_path):
     assert response.status_code == 200
     assert response.json()["count"] == 2
 
+    # One result for each (stream, component) pair, ordered by stream name and component purl
+    curl_srpm.productstreams.add(ps2)
+    response = client.get(f"{api_path}/components?name={curl.name}&view=product&limit=2")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 3
+    assert data["next"]
+    assert [(result["name"], result["component_purl"]) for result in data["results"]] == sorted(
+        [("rhel-7", curl.purl), ("rhel-7", curl_srpm.purl)]
+    )
+    assert data["results"][0]["component_link"] == get_component_purl_link(
+        data["results"][0]["component_purl"]
+    )
+    response = client.get(data["next"])
+    assert response.status_code == 200
+    assert [
+        (result["name"], result["component_purl"]) for result in response.json()["results"]
+    ] == [("rhel-8", curl_srpm.purl)]
+
 
 @pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
 def test_product_components(client, api_path):
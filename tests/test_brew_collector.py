@@ -1,12 +1,16 @@
 import copy
 import json
+import os
+import time
 from types import SimpleNamespace
-from unittest.mock import call, patch
+from unittest.mock import MagicMock, call, patch
 
 import koji
 import pytest
+from celery.exceptions import SoftTimeLimitExceeded
 from django.conf import settings
 from django.db import IntegrityError
+from requests.exceptions import RequestException
 from yaml import safe_load
 
 from corgi.collectors.brew import (
@@ -14,7 +18,11 @@ from corgi.collectors.brew import (
     BrewBuildInvalidState,
     BrewBuildNotFound,
     BrewBuildTypeNotSupported,
+    BrewCache,
+    BrewSession,
+    get_brew_cache,
 )
+from corgi.core.ingest import ComponentTree
 from corgi.core.models import (
     Component,
     ComponentNode,
@@ -22,13 +30,15 @@ from corgi.core.models import (
     SoftwareBuild,
 )
 from corgi.tasks.brew import (
+    build_component_tree,
     fetch_unprocessed_relations,
     load_brew_tags,
     load_stream_brew_tags,
     save_component,
     slow_fetch_brew_build,
+    slow_fetch_brew_builds,
 )
-from corgi.tasks.common import BUILD_TYPE
+from corgi.tasks.common import BUILD_TYPE, FETCH_BATCH_TIME_BUDGET
 from tests.conftest import setup_product
 from tests.data.image_archive_data import (
     KOJI_LIST_RPMS,
@@ -1030,6 +1040,189 @@ def test_save_component_skips_duplicates():
     assert Component.objects.filter(name=name).first() is None
 
 
+def _assert_valid_tree(root_node: ComponentNode) -> None:
+    """Check that the nested-set values for every node in a tree match its parent links"""
+    for node in ComponentNode.objects.filter(tree_id=root_node.tree_id):
+        descendants = set()
+        parents = [node.pk]
+        while parents:
+            children = ComponentNode.objects.filter(parent_id__in=parents).values_list(
+                "pk", flat=True
+            )
+            descendants.update(children)
+            parents = list(children)
+        assert set(node.get_descendants().values_list("pk", flat=True)) == descendants
+        assert node.level == node.get_ancestors().count()
+
+
+@pytest.mark.django_db
+def test_build_component_tree():
+    """Test that a build's components and nodes are saved in bulk,
+    and that new nodes are merged into the existing tree when the build is reprocessed"""
+    software_build = SoftwareBuildFactory()
+    build_data = {
+        "type": Component.Type.CONTAINER_IMAGE,
+        "meta": {"name": "mycontainer", "version": "1", "release": "1", "license": "MIT"},
+        "image_components": [
+            {
+                "type": Component.Type.CONTAINER_IMAGE,
+                "meta": {"name": "mycontainer", "version": "1", "release": "1", "arch": "x86_64"},
+                "rpm_components": [
+                    {
+                        "type": Component.Type.RPM,
+                        "meta": {"name": "myrpm", "version": "1", "release": "1", "arch": "x86_64"},
+                    }
+                ],
+            }
+        ],
+        "sources": [
+            {
+                "type": Component.Type.GOLANG,
+                "meta": {"name": "github.com/org/repo", "version": "v1.0.0"},
+                "components": [
+                    {
+                        "type": "gomod",
+                        "meta": {"name": "github.com/org/dep", "version": "v0.1.0", "dev": True},
+                    },
+                ],
+            }
+        ],
+    }
+
+    (root_node,) = build_component_tree(software_build, copy.deepcopy(build_data)).save()
+    root = root_node.obj
+    assert root.software_build == software_build
+    assert root.license_declared_raw == "MIT"
+    assert root_node.get_descendant_count() == 4
+    _assert_valid_tree(root_node)
+
+    rpm = Component.objects.get(name="myrpm")
+    assert rpm.purl == "pkg:rpm/redhat/myrpm@1-1?arch=x86_64"
+    assert rpm.nevra == "myrpm-1-1.x86_64"
+    assert rpm.namespace == Component.Namespace.REDHAT
+    assert rpm.software_build is None
+    rpm_node = rpm.cnodes.get()
+    assert rpm_node.type == ComponentNode.ComponentNodeType.PROVIDES
+    assert rpm_node.parent.obj.arch == "x86_64"
+    # Bulk-inserted nodes have the same linked component and denormalized fields as saved ones
+    assert rpm_node.component == rpm
+    assert rpm_node.component_type == Component.Type.RPM
+    assert rpm_node.namespace == Component.Namespace.REDHAT
+    assert rpm_node.arch == "x86_64"
+
+    dep = Component.objects.get(name="github.com/org/dep")
+    assert dep.type == Component.Type.GOLANG
+    assert dep.meta_attr == {"go_component_type": "gomod"}
+    dep_node = dep.cnodes.get()
+    assert dep_node.type == ComponentNode.ComponentNodeType.PROVIDES_DEV
+    assert dep_node.parent.obj.name == "github.com/org/repo"
+
+    # Reprocessing the same build doesn't create any new components or nodes
+    (same_root_node,) = build_component_tree(software_build, copy.deepcopy(build_data)).save()
+    assert same_root_node == root_node
+    assert Component.objects.count() == 5
+    assert ComponentNode.objects.count() == 5
+
+    # New components are added as the last child of their existing parent
+    build_data["image_components"][0]["rpm_components"].append(
+        {
+            "type": Component.Type.RPM,
+            "meta": {"name": "newrpm", "version": "1", "release": "1", "arch": "x86_64"},
+        }
+    )
+    (root_node,) = build_component_tree(software_build, copy.deepcopy(build_data)).save()
+    assert ComponentNode.objects.count() == 6
+    assert rpm_node.parent.get_children().order_by("lft").last().obj.name == "newrpm"
+    _assert_valid_tree(root_node)
+
+
+@pytest.mark.django_db
+def test_component_tree_updates_node_namespace():
+    """Test that a component's new namespace is copied to its existing nodes"""
+    tree = ComponentTree()
+    key = tree.add_component(
+        Component.Type.RPM, "myrpm", "1", "1", "x86_64", {"namespace": Component.Namespace.UPSTREAM}
+    )
+    tree.add_node(ComponentNode.ComponentNodeType.SOURCE, None, key)
+    (root_node,) = tree.save()
+    assert root_node.namespace == Component.Namespace.UPSTREAM
+
+    tree = ComponentTree()
+    key = tree.add_component(
+        Component.Type.RPM, "myrpm", "1", "1", "x86_64", {"namespace": Component.Namespace.REDHAT}
+    )
+    tree.add_node(ComponentNode.ComponentNodeType.SOURCE, None, key)
+    tree.save(reconcile=True)
+    root_node.refresh_from_db()
+    assert Component.objects.get(name="myrpm").namespace == Component.Namespace.REDHAT
+    assert root_node.namespace == Component.Namespace.REDHAT
+
+
+@pytest.mark.django_db
+def test_build_component_tree_reconcile():
+    """Test that reprocessing a build only writes the components and nodes that changed"""
+    software_build = SoftwareBuildFactory()
+    build_data = {
+        "type": Component.Type.CONTAINER_IMAGE,
+        "meta": {"name": "mycontainer", "version": "1", "release": "1"},
+        "image_components": [
+            {
+                "type": Component.Type.CONTAINER_IMAGE,
+                "meta": {"name": "mycontainer", "version": "1", "release": "1", "arch": "x86_64"},
+                "rpm_components": [
+                    {
+                        "type": Component.Type.RPM,
+                        "meta": {"name": "myrpm", "version": "1", "release": "1", "arch": "x86_64"},
+                    }
+                ],
+            }
+        ],
+        "sources": [
+            {
+                "type": Component.Type.GOLANG,
+                "meta": {"name": "github.com/org/repo", "version": "v1.0.0"},
+                "components": [
+                    {"type": "gomod", "meta": {"name": "github.com/org/dep", "version": "v0.1.0"}},
+                ],
+            }
+        ],
+    }
+    (root_node,) = build_component_tree(software_build, copy.deepcopy(build_data)).save()
+    # Software composition analysis adds its components directly under the root
+    scanned = Component.objects.create(type=Component.Type.PYPI, name="scanned", version="1")
+    ComponentNode.objects.create(
+        type=ComponentNode.ComponentNodeType.PROVIDES, parent=root_node, obj=scanned
+    )
+
+    tree = build_component_tree(software_build, copy.deepcopy(build_data))
+    tree.save(reconcile=True)
+    assert tree.summary == {
+        "components_created": 0,
+        "components_updated": 0,
+        "components_unchanged": 5,
+        "nodes_created": 0,
+        "nodes_deleted": 0,
+    }
+
+    # The dependency was removed, and the RPM has new metadata
+    build_data["sources"][0]["components"] = []
+    build_data["image_components"][0]["rpm_components"][0]["meta"]["source"] = ["koji"]
+    tree = build_component_tree(software_build, copy.deepcopy(build_data))
+    (root_node,) = tree.save(reconcile=True)
+    assert tree.summary == {
+        "components_created": 0,
+        "components_updated": 1,
+        "components_unchanged": 3,
+        "nodes_created": 0,
+        "nodes_deleted": 1,
+    }
+    assert Component.objects.get(name="myrpm").meta_attr == {"source": ["koji"]}
+    # The component itself is kept, since other trees may still use it
+    assert not Component.objects.get(name="github.com/org/dep").cnodes.exists()
+    assert scanned.cnodes.get().parent == root_node
+    _assert_valid_tree(root_node)
+
+
 @pytest.mark.django_db
 def test_get_component_data_handles_errors():
     """Test that get_component_data raises errors
@@ -1102,6 +1295,122 @@ def test_extract_image_components(mock_koji_session, monkeypatch):
     assert set(noarch_rpms_by_id.keys()) == set(NOARCH_RPM_IDS)
 
 
+def test_brew_session_caches_immutable_calls(tmp_path):
+    """Test that only immutable Brew data is cached, separately for each Brew / Koji instance"""
+    mock_session = MagicMock(baseurl="https://brew.example.com/brewhub")
+    mock_session.listArchives.return_value = [{"id": 1, "btype": "image"}]
+    mock_session.listTags.return_value = [{"name": "tag"}]
+    cache = BrewCache(str(tmp_path), max_bytes=1024**2)
+    session = BrewSession(mock_session, cache)
+
+    for _ in range(2):
+        assert session.listArchives(123) == [{"id": 1, "btype": "image"}]
+        assert session.listTags(123) == [{"name": "tag"}]
+    mock_session.listArchives.assert_called_once_with(123)
+    # Tags can be added to or removed from a build at any time, so they're always fetched
+    assert mock_session.listTags.call_count == 2
+
+    # Different arguments, or the same arguments on a different server, aren't cache hits
+    session.listArchives(456)
+    BrewSession(MagicMock(baseurl="https://koji.example.com/kojihub"), cache).listArchives(123)
+    assert mock_session.listArchives.call_count == 2
+
+    # Missing builds aren't cached, in case they're imported later
+    mock_session.getBuildType.return_value = None
+    session.getBuildType(789)
+    session.getBuildType(789)
+    assert mock_session.getBuildType.call_count == 2
+
+
+def test_brew_session_multicall(tmp_path):
+    """Test that uncached calls are pipelined into a single multicall, and cached afterwards"""
+    mock_session = MagicMock(baseurl="https://brew.example.com/brewhub")
+    mock_multicall = mock_session.multicall.return_value.__enter__.return_value
+    mock_multicall.listRPMs.side_effect = lambda imageID: SimpleNamespace(
+        result=[{"id": imageID * 10}]
+    )
+    session = BrewSession(mock_session, BrewCache(str(tmp_path), max_bytes=1024**2))
+
+    with session.multicall() as multicall:
+        calls = [multicall.listRPMs(imageID=archive_id) for archive_id in (1, 2)]
+    assert [call.result for call in calls] == [[{"id": 10}], [{"id": 20}]]
+    mock_session.multicall.assert_called_once_with(strict=False, batch=None)
+    assert mock_multicall.listRPMs.call_count == 2
+
+    # Only the new archive is requested from Brew, the others come from the cache
+    with session.multicall() as multicall:
+        calls = [multicall.listRPMs(imageID=archive_id) for archive_id in (1, 2, 3)]
+    assert [call.result for call in calls] == [[{"id": 10}], [{"id": 20}], [{"id": 30}]]
+    assert mock_session.multicall.call_count == 2
+    assert mock_multicall.listRPMs.call_count == 3
+
+    # Nothing is requested at all when every call is cached
+    with session.multicall() as multicall:
+        calls = [multicall.listRPMs(imageID=archive_id) for archive_id in (1, 2, 3)]
+    assert mock_session.multicall.call_count == 2
+
+
+def test_brew_session_prefetch():
+    """Test that prefetched results are used once, and failed calls are made again later"""
+    mock_session = MagicMock(baseurl="https://brew.example.com/brewhub")
+    mock_multicall = mock_session.multicall.return_value.__enter__.return_value
+    mock_multicall.getBuild.side_effect = lambda build_id: SimpleNamespace(result={"id": build_id})
+
+    class FailedCall:
+        @property
+        def result(self):
+            raise koji.GenericError("Brew is down")
+
+    mock_multicall.listTags.side_effect = lambda build_id: FailedCall()
+    session = BrewSession(mock_session)
+
+    session.prefetch(
+        (name, (build_id,)) for build_id in (1, 2) for name in ("getBuild", "listTags")
+    )
+    mock_session.multicall.assert_called_once()
+    assert session.getBuild(1) == {"id": 1}
+    assert session.getBuild(2) == {"id": 2}
+    mock_session.getBuild.assert_not_called()
+    session.listTags(1)
+    mock_session.listTags.assert_called_once_with(1)
+
+    # Each prefetched result is only returned once
+    session.getBuild(1)
+    mock_session.getBuild.assert_called_once_with(1)
+
+
+def test_brew_cache_evicts_least_recently_used(tmp_path):
+    """Test that the cache removes its oldest entries once it grows too large"""
+    cache = BrewCache(str(tmp_path), max_bytes=120)
+    keys = [BrewCache.get_key("server", "listRPMs", (build_id,), {}) for build_id in range(3)]
+    for age, key in zip((300, 200, 100), keys):
+        cache.set(key, ["x" * 40])
+        path = cache._get_path(key)
+        os.utime(path, (time.time() - age, time.time() - age))
+    # Reading an entry makes it the most recently used
+    assert cache.get(keys[0]) == (True, ["x" * 40])
+
+    cache.evict()
+    assert cache.get(keys[0])[0]
+    assert not cache.get(keys[1])[0]
+    assert cache.get(keys[2])[0]
+
+
+def test_brew_cache_shared_by_process(settings, tmp_path):
+    """Test that every Brew instance uses the same cache, so all their writes trigger eviction"""
+    settings.BREW_CACHE_DIR = str(tmp_path)
+    settings.BREW_CACHE_MAX_BYTES = 1024**2
+    cache = get_brew_cache()
+    assert get_brew_cache() is cache
+    cache.writes = BrewCache.EVICTION_INTERVAL - 1
+    with patch.object(BrewCache, "evict") as mock_evict:
+        get_brew_cache().set(BrewCache.get_key("server", "getBuild", (1,), {}), {"id": 1})
+    mock_evict.assert_called_once_with()
+
+    settings.BREW_CACHE_DIR = ""
+    assert get_brew_cache() is None
+
+
 @pytest.mark.django_db
 @patch("corgi.tasks.brew.Brew")
 @patch("corgi.tasks.sca.cpu_software_composition_analysis.delay")
@@ -1331,6 +1640,116 @@ def test_load_unprocessed_relations_filters(mock_fetch_modular_task):
     )
 
 
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+@patch("corgi.tasks.common.app.send_task")
+@patch("corgi.tasks.common.get_redis")
+@patch("corgi.tasks.brew.slow_fetch_modular_build.delay")
+def test_load_unprocessed_relations_in_batches(mock_fetch_modular_task, mock_redis, mock_send):
+    """Test that many builds are fetched in batches, and builds already in flight are skipped"""
+    for build_id in range(1, 13):
+        ProductComponentRelationFactory(
+            build_type=SoftwareBuild.Type.BREW,
+            build_id=build_id,
+            type=ProductComponentRelation.Type.BREW_TAG,
+        )
+    # Build 3 is already in some other batch, so only the new ones are claimed
+    mock_pipe = mock_redis.return_value.pipeline.return_value.__enter__.return_value
+    mock_pipe.execute.return_value = [0] + [build_id != 3 for build_id in range(1, 13)]
+
+    assert fetch_unprocessed_relations() == 12
+    mock_fetch_modular_task.assert_not_called()
+    mock_send.assert_called_once_with(
+        "corgi.tasks.brew.slow_fetch_brew_builds",
+        args=([str(build_id) for build_id in range(1, 13) if build_id != 3], BUILD_TYPE),
+        kwargs={"check_modules": True, "force_process": False},
+    )
+
+
+@pytest.mark.django_db
+@patch("corgi.tasks.brew.fetch_builds")
+@patch("corgi.tasks.brew.release_build")
+@patch("corgi.tasks.brew._save_modular_build")
+@patch("corgi.tasks.brew._fetch_brew_build")
+@patch("corgi.tasks.brew.Brew")
+def test_slow_fetch_brew_builds(
+    mock_brew, mock_fetch, mock_save_module, mock_release, mock_fetch_builds
+):
+    """Test that a batch prefetches only new builds, and one failed build doesn't stop the rest"""
+    sb = SoftwareBuildFactory(build_type=BUILD_TYPE, build_id="1")
+    mock_save_module.side_effect = lambda build_id: ["10"] if build_id == "2" else None
+    mock_fetch.side_effect = [((), {}), ValueError("bad build"), ((4, 5), {})]
+
+    assert slow_fetch_brew_builds([sb.build_id, 2, 3]) == 2
+    prefetched_ids = mock_brew.return_value.prefetch_builds.call_args.args[0]
+    assert list(prefetched_ids) == [2, 3]
+    assert mock_fetch.call_count == 3
+    # Every build is released, even the one that failed
+    mock_release.assert_has_calls([call(build_id, BUILD_TYPE) for build_id in ("1", "2", "3")])
+    # Nested and module builds are fetched afterwards
+    mock_fetch_builds.assert_has_calls(
+        [
+            call(("4", "5"), BUILD_TYPE, slow_fetch_brew_build, False),
+            call(("10",), BUILD_TYPE, slow_fetch_brew_build),
+        ]
+    )
+
+
+@pytest.mark.django_db
+@patch("corgi.tasks.brew.fetch_builds")
+@patch("corgi.tasks.brew.release_build")
+@patch("corgi.tasks.brew._fetch_brew_build")
+@patch("corgi.tasks.brew.Brew")
+def test_slow_fetch_brew_builds_stops(mock_brew, mock_fetch, mock_release, mock_fetch_builds):
+    """Test that a batch stops at its soft time limit, and releases the builds it didn't save"""
+    mock_fetch.side_effect = [((4,), {}), SoftTimeLimitExceeded()]
+
+    with pytest.raises(SoftTimeLimitExceeded):
+        slow_fetch_brew_builds([1, 2, 3], check_modules=False)
+    assert mock_fetch.call_count == 2
+    mock_release.assert_has_calls([call(build_id, BUILD_TYPE) for build_id in ("1", "2", "3")])
+    mock_fetch_builds.assert_not_called()
+
+    # Builds stay claimed while the batch will be retried, but not after its last retry
+    mock_release.reset_mock()
+    mock_fetch.side_effect = RequestException("Brew is down")
+    with pytest.raises(RequestException):
+        slow_fetch_brew_builds([1, 2], check_modules=False)
+    mock_release.assert_not_called()
+
+    slow_fetch_brew_builds.push_request(retries=slow_fetch_brew_builds.max_retries)
+    try:
+        with pytest.raises(RequestException):
+            slow_fetch_brew_builds([1, 2], check_modules=False)
+    finally:
+        slow_fetch_brew_builds.pop_request()
+    mock_release.assert_has_calls([call(build_id, BUILD_TYPE) for build_id in ("1", "2")])
+
+
+@pytest.mark.django_db
+@patch("corgi.tasks.brew.slow_fetch_brew_builds.delay")
+@patch("corgi.tasks.brew.fetch_builds")
+@patch("corgi.tasks.brew.release_build")
+@patch("corgi.tasks.brew._fetch_brew_build")
+@patch("corgi.tasks.brew.Brew")
+@patch("corgi.tasks.brew.time")
+def test_slow_fetch_brew_builds_time_budget(
+    mock_time, mock_brew, mock_fetch, mock_release, mock_fetch_builds, mock_requeue
+):
+    """Test that builds a batch doesn't have time for are queued in a new batch"""
+    # The batch runs out of time after saving the first build
+    mock_time.monotonic.side_effect = [0, 1, FETCH_BATCH_TIME_BUDGET + 1]
+    mock_fetch.return_value = ((4,), {})
+
+    assert slow_fetch_brew_builds([1, 2, 3], check_modules=False) == 1
+    assert mock_fetch.call_count == 1
+    # The new batch takes over the claims for the other builds
+    mock_release.assert_called_once_with("1", BUILD_TYPE)
+    mock_requeue.assert_called_once_with(
+        ["2", "3"], BUILD_TYPE, check_modules=False, force_process=False
+    )
+    mock_fetch_builds.assert_any_call(("4",), BUILD_TYPE, slow_fetch_brew_build, False)
+
+
 def test_extract_advisory_ids():
     """Test that we discover only errata / advisory names from a list of Brew build tag names"""
     tags = [
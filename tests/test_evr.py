@@ -0,0 +1,81 @@
+import json
+import random
+from pathlib import Path
+from typing import Any
+
+import pytest
+from rpm import labelCompare
+
+from corgi.core.evr import get_evr_key
+
+pytestmark = pytest.mark.unit
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+def _find_evrs(data: Any, evrs: set[tuple[int, str, str]]) -> None:
+    """Collect every (epoch, version, release) in some recorded build data"""
+    if isinstance(data, dict):
+        if isinstance(data.get("version"), str) and isinstance(data.get("release"), str):
+            evrs.add((data.get("epoch") or 0, data["version"], data["release"]))
+        for value in data.values():
+            _find_evrs(value, evrs)
+    elif isinstance(data, list):
+        for value in data:
+            _find_evrs(value, evrs)
+
+
+def load_fixture_evrs() -> list[tuple[int, str, str]]:
+    evrs: set[tuple[int, str, str]] = set()
+    for path in sorted(DATA_DIR.glob("brew/*/component_data.json")):
+        _find_evrs(json.loads(path.read_text()), evrs)
+    return sorted(evrs)
+
+
+def mutate(evr: tuple[int, str, str], rng: random.Random) -> tuple[int, str, str]:
+    """Change some real EVR the way packagers do, e.g. pre-releases, snapshots, and rebuilds"""
+    epoch, version, release = evr
+    suffix = rng.choice(("~rc1", "~~", "^20230101git1a2b3c", "^", ".1", "_1", "a", "+b", ".00"))
+    if rng.random() < 0.2:
+        epoch += 1
+    if rng.random() < 0.5:
+        return epoch, f"{version}{suffix}", release
+    return epoch, version, f"{release}{suffix}"
+
+
+def compare_keys(first: tuple[int, str, str], second: tuple[int, str, str]) -> int:
+    first_key, second_key = get_evr_key(*first), get_evr_key(*second)
+    return (first_key > second_key) - (first_key < second_key)
+
+
+def test_evr_key_examples():
+    assert compare_keys((0, "1.0", "1.el8"), (0, "1.0", "1.el8")) == 0
+    # Leading zeros and separators don't matter
+    assert compare_keys((0, "1.01", "1.el8"), (0, "1_1", "1.el8")) == 0
+    # Numbers are compared as numbers, and sort after letters
+    assert compare_keys((0, "1.10", "1"), (0, "1.9", "1")) == 1
+    assert compare_keys((0, "1.a", "1"), (0, "1.1", "1")) == -1
+    # Pre-releases sort before, and snapshots after, the release they're based on
+    assert compare_keys((0, "1.0~rc1", "1"), (0, "1.0", "1")) == -1
+    assert compare_keys((0, "1.0^git1", "1"), (0, "1.0", "1")) == 1
+    assert compare_keys((0, "1.0^git1", "1"), (0, "1.0.1", "1")) == -1
+    # The epoch is compared first, then the version, then the release
+    assert compare_keys((1, "1.0", "1"), (0, "2.0", "2")) == 1
+    assert compare_keys((0, "1.0", "2"), (0, "1.0.1", "1")) == -1
+    assert compare_keys((0, "1.2.0", "3.module+el8pki+8580+f0d97d6d"), (0, "1.2.0", "3")) == 1
+
+
+def test_evr_key_matches_label_compare():
+    """Property-based test that comparing keys gives the same result as rpm.labelCompare,
+    for every pair of real EVRs from our test data, and random changes to them"""
+    evrs = load_fixture_evrs()
+    assert len(evrs) > 50
+    rng = random.Random(0)
+    evrs.extend(mutate(rng.choice(evrs), rng) for _ in range(len(evrs)))
+
+    for first in evrs:
+        for second in evrs:
+            expected = labelCompare(
+                (str(first[0]), first[1], first[2]), (str(second[0]), second[1], second[2])
+            )
+            assert compare_keys(first, second) == expected, (first, second)
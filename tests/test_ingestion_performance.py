@@ -0,0 +1,199 @@
+"""
+Offline benchmarks for saving Brew builds, using recorded Koji data and synthetic builds
+Unlike test_performance.py, these only need a local database, not a live environment
+
+Run them with `pytest -m performance --no-cov tests/test_ingestion_performance.py`
+Timings can be compared between runs with pytest-benchmark's own options, e.g. run once with
+`--benchmark-autosave`, then later with `--benchmark-compare --benchmark-compare-fail=mean:20%`
+Query counts are also checked against a stored baseline, and so are throughput and peak memory
+when the baseline includes them. The committed baseline only has component and query counts,
+which are the same on every machine. Run with CORGI_UPDATE_BENCHMARK_BASELINE=1 to record new
+baseline results, e.g. after optimizing, or to record throughput and peak memory on some host
+"""
+import copy
+import json
+import os
+import tracemalloc
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any
+from unittest.mock import MagicMock, patch
+
+import pytest
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from corgi.tasks.brew import slow_fetch_brew_build
+
+pytestmark = [pytest.mark.performance, pytest.mark.django_db]
+
+DATA_DIR = Path(__file__).parent / "data"
+BASELINE_PATH = DATA_DIR / "ingestion_benchmark_baseline.json"
+RPM_BUILD_ID = "1705913"
+CONTAINER_BUILD_ID = "1781353"
+
+# Query counts should never go up, but memory use and throughput vary a little between runs
+# Throughput also depends on the machine, so allow more variation when comparing to a baseline
+MEMORY_TOLERANCE = 1.25
+THROUGHPUT_TOLERANCE = float(os.getenv("CORGI_BENCHMARK_THROUGHPUT_TOLERANCE", "0.5"))
+
+
+def load_recorded_build(build_id: str) -> dict[str, Any]:
+    """Load the data Brew.get_component_data() returned for some build"""
+    with open(DATA_DIR / "brew" / build_id / "component_data.json", "r") as component_data_file:
+        return json.load(component_data_file)
+
+
+def _copy_component(component: dict[str, Any], index: int) -> tuple[dict[str, Any], int]:
+    """Copy a component and its children, with new names so they're saved as new components
+    Returns the copy, and the number of components in it"""
+    component = copy.deepcopy(component)
+    components = [component]
+    count = 0
+    while components:
+        child = components.pop()
+        child["meta"]["name"] = f"{child['meta']['name']}-{index}"
+        components.extend(child.get("components", ()))
+        count += 1
+    return component, count
+
+
+def generate_container_build(component_count: int) -> dict[str, Any]:
+    """Scale the recorded container build up to roughly component_count child components
+
+    The recorded RPMs and Cachito packages are copied under new names, so the tree
+    keeps the same shape, just with more components in each arch image and upstream source.
+    Half the components are RPMs, split evenly between the arch images, and half are packages.
+    Packages can have children of their own, so the last package may go a little over."""
+    build_data = load_recorded_build(CONTAINER_BUILD_ID)
+    images = build_data["image_components"]
+    rpm_count = component_count // 2 // len(images)
+    for image in images:
+        recorded_rpms = image["rpm_components"]
+        image["rpm_components"] = [
+            _copy_component(recorded_rpms[index % len(recorded_rpms)], index)[0]
+            for index in range(rpm_count)
+        ]
+
+    source = build_data["sources"][0]
+    recorded_packages = source["components"]
+    package_count = component_count - rpm_count * len(images)
+    packages = []
+    while package_count > 0:
+        index = len(packages)
+        package, count = _copy_component(recorded_packages[index % len(recorded_packages)], index)
+        packages.append(package)
+        package_count -= count
+    source["components"] = packages
+    return build_data
+
+
+@pytest.fixture
+def mock_brew():
+    """Patch Brew and any tasks that slow_fetch_brew_build calls,
+    so only the code that saves a build's components and taxonomies runs"""
+    with ExitStack() as stack:
+        for target in (
+            "corgi.tasks.brew.load_brew_tags",
+            "corgi.tasks.brew.slow_load_errata.delay",
+            "corgi.tasks.brew.cpu_software_composition_analysis.delay",
+            "corgi.tasks.brew.slow_fetch_brew_build.delay",
+        ):
+            stack.enter_context(patch(target))
+        yield stack.enter_context(patch("corgi.tasks.brew.Brew"))
+
+
+def ingest(build_id: str) -> dict[str, int]:
+    """Save a build, then roll back so the next round also starts with an empty database"""
+    with transaction.atomic():
+        summary = slow_fetch_brew_build(build_id, force_process=True)
+        transaction.set_rollback(True)
+    return summary
+
+
+def measure(mock_brew: MagicMock, build_id: str, build_data: dict[str, Any]) -> dict[str, Any]:
+    """Count the components and queries for saving a build, as well as its peak memory use
+    Memory is measured separately, so the queries Django records aren't included"""
+    mock_brew.return_value.get_component_data.return_value = copy.deepcopy(build_data)
+    with CaptureQueriesContext(connection) as queries:
+        summary = ingest(build_id)
+
+    mock_brew.return_value.get_component_data.return_value = copy.deepcopy(build_data)
+    tracemalloc.start()
+    try:
+        ingest(build_id)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "components": sum(
+            summary[key]
+            for key in ("components_created", "components_updated", "components_unchanged")
+        ),
+        "queries": len(queries),
+        "peak_memory_mb": round(peak_memory / 1024**2, 1),
+    }
+
+
+def check_baseline(case: str, results: dict[str, Any]) -> None:
+    """Fail if some case is slower, makes more queries, or uses more memory than its baseline"""
+    baselines = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    if os.getenv("CORGI_UPDATE_BENCHMARK_BASELINE"):
+        baselines[case] = results
+        BASELINE_PATH.write_text(f"{json.dumps(baselines, indent=2, sort_keys=True)}\n")
+        return
+
+    baseline = baselines.get(case)
+    assert baseline, f"No baseline for {case}, record one with CORGI_UPDATE_BENCHMARK_BASELINE=1"
+    regressions = []
+    if results["queries"] > baseline["queries"]:
+        regressions.append(f"{results['queries']} queries, was {baseline['queries']}")
+    # Memory use and throughput depend on the machine, so they're only compared when recorded
+    if (
+        "peak_memory_mb" in baseline
+        and results["peak_memory_mb"] > baseline["peak_memory_mb"] * MEMORY_TOLERANCE
+    ):
+        regressions.append(
+            f"{results['peak_memory_mb']} MB peak memory, was {baseline['peak_memory_mb']} MB"
+        )
+    if (
+        "components_per_second" in baseline
+        and results["components_per_second"]
+        < baseline["components_per_second"] * THROUGHPUT_TOLERANCE
+    ):
+        regressions.append(
+            f"{results['components_per_second']} components / second, "
+            f"was {baseline['components_per_second']}"
+        )
+    assert not regressions, f"Ingestion of {case} regressed: {', '.join(regressions)}"
+
+
+# Build ID, a function that returns the build's data, and how many times to save it
+CASES = {
+    "rpm": (RPM_BUILD_ID, lambda: load_recorded_build(RPM_BUILD_ID), 5),
+    "container": (CONTAINER_BUILD_ID, lambda: load_recorded_build(CONTAINER_BUILD_ID), 5),
+    "container-1k": (CONTAINER_BUILD_ID, lambda: generate_container_build(1000), 5),
+    "container-10k": (CONTAINER_BUILD_ID, lambda: generate_container_build(10000), 3),
+    "container-50k": (CONTAINER_BUILD_ID, lambda: generate_container_build(50000), 1),
+}
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_ingestion_benchmark(benchmark, mock_brew, case):
+    """Benchmark saving a build, and check it's not slower than the stored baseline"""
+    build_id, get_build_data, rounds = CASES[case]
+    build_data = get_build_data()
+    results = measure(mock_brew, build_id, build_data)
+
+    def setup() -> None:
+        # The build data is modified as it's saved, so every round needs its own copy
+        mock_brew.return_value.get_component_data.return_value = copy.deepcopy(build_data)
+
+    benchmark.pedantic(ingest, args=(build_id,), setup=setup, rounds=rounds, iterations=1)
+    if benchmark.disabled:
+        return
+
+    results["components_per_second"] = round(results["components"] / benchmark.stats.stats.mean)
+    benchmark.extra_info.update(results)
+    check_baseline(case, results)
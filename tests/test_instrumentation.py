@@ -0,0 +1,109 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from django.db import connection
+
+from corgi.collectors.brew import BrewSession
+from corgi.core.instrumentation import (
+    TASK_STAGE,
+    TaskProfile,
+    external_call,
+    finish_task,
+    get_profile,
+    render_metrics,
+    save_metrics,
+    span,
+    start_task,
+)
+from corgi.core.models import Component
+
+pytestmark = [
+    pytest.mark.unit,
+    pytest.mark.django_db(databases=("default",)),
+]
+
+
+def test_span_outside_task():
+    """Spans do nothing when no task is being profiled"""
+    with span("stage"), external_call("koji"):
+        pass
+    assert get_profile() is None
+    assert finish_task() is None
+
+
+def test_task_profile_stages():
+    mock_session = MagicMock(baseurl="https://brew.example.com/brewhub")
+    start_task("corgi.tasks.brew.slow_fetch_brew_build")
+    with span("fetch_build"):
+        BrewSession(mock_session).getBuild(123)
+        Component.objects.count()
+        # Only the outermost span counts, when it's nested inside itself
+        with span("fetch_build"):
+            Component.objects.count()
+    with span("save_build"):
+        Component.objects.count()
+
+    profile = finish_task()
+    assert profile.task_name == "corgi.tasks.brew.slow_fetch_brew_build"
+    assert profile.execute_wrapper not in connection.execute_wrappers
+    assert get_profile() is None
+
+    stages = profile.stages
+    assert stages["fetch_build"]["calls"] == 1
+    assert stages["fetch_build"]["db_queries"] == 2
+    assert stages["fetch_build"]["external_calls"] == 1
+    assert stages["koji"]["calls"] == 1
+    assert stages["koji"]["external_calls"] == 1
+    assert stages["save_build"]["calls"] == 1
+    assert stages["save_build"]["db_queries"] == 1
+    assert stages["save_build"]["external_calls"] == 0
+    # The task's total includes every stage
+    assert stages[TASK_STAGE]["calls"] == 1
+    assert stages[TASK_STAGE]["db_queries"] == 3
+    assert stages[TASK_STAGE]["external_calls"] == 1
+    assert stages[TASK_STAGE]["wall_time"] >= stages["fetch_build"]["wall_time"]
+
+
+def test_nested_task_profiles():
+    """Eager tasks that run inside other tasks are recorded separately"""
+    start_task("outer")
+    start_task("inner")
+    Component.objects.count()
+    inner = finish_task()
+    assert get_profile().task_name == "outer"
+    outer = finish_task()
+
+    assert inner.stages[TASK_STAGE]["db_queries"] == 1
+    assert outer.stages[TASK_STAGE]["db_queries"] == 0
+
+
+def test_render_metrics():
+    profile = TaskProfile("slow_task")
+    profile.get_stage(TASK_STAGE).update(calls=1, wall_time=2.5, db_queries=10, db_time=0.5)
+
+    # Record the fields that save_metrics() increments, then read them back
+    saved: dict[bytes, float] = {}
+
+    def increment(key, field, amount):
+        saved[field.encode()] = saved.get(field.encode(), 0) + amount
+
+    mock_redis = MagicMock()
+    pipe = mock_redis.pipeline.return_value.__enter__.return_value
+    pipe.hincrby.side_effect = increment
+    pipe.hincrbyfloat.side_effect = increment
+    mock_redis.hgetall.return_value = saved
+    with patch("corgi.core.instrumentation.get_redis", return_value=mock_redis):
+        save_metrics(profile)
+        save_metrics(profile)
+        metrics = render_metrics()
+
+    labels = 'task="slow_task",stage="total"'
+    assert "# TYPE corgi_task_stage_seconds histogram" in metrics
+    assert f'corgi_task_stage_seconds_bucket{{{labels},le="1"}} 0\n' in metrics
+    # Buckets are cumulative
+    assert f'corgi_task_stage_seconds_bucket{{{labels},le="5"}} 2\n' in metrics
+    assert f'corgi_task_stage_seconds_bucket{{{labels},le="+Inf"}} 2\n' in metrics
+    assert f"corgi_task_stage_seconds_sum{{{labels}}} 5.0\n" in metrics
+    assert f"corgi_task_stage_seconds_count{{{labels}}} 2\n" in metrics
+    assert f"corgi_task_stage_db_queries_total{{{labels}}} 20.0\n" in metrics
+    assert f"corgi_task_stage_db_seconds_total{{{labels}}} 1.0\n" in metrics
@@ -1,11 +1,32 @@
+import io
 import json
 import logging
+from datetime import datetime
+from datetime import timezone as dt_timezone
 from json import JSONDecodeError
 
 import pytest
-
-from corgi.core.files import ProductManifestFile
-from corgi.core.models import Component, ComponentNode, ProductComponentRelation
+from django.utils import timezone
+from jsonschema import ValidationError
+
+from corgi.core.files import (
+    ComponentLinksCache,
+    ComponentManifestFile,
+    ManifestFile,
+    ProductManifestFile,
+)
+from corgi.core.models import (
+    Component,
+    ComponentNode,
+    LatestComponent,
+    ProductComponentRelation,
+    ProductNode,
+)
+from corgi.tasks.manifest import (
+    cpu_update_ps_manifest,
+    generate_manifests,
+    get_manifest_stream_names,
+)
 from corgi.web.templatetags.base_extras import provided_relationship
 
 from .conftest import setup_product
@@ -14,6 +35,7 @@ from .factories import (
     ContainerImageComponentFactory,
     ProductComponentRelationFactory,
     ProductStreamFactory,
+    ProductVariantFactory,
     SoftwareBuildFactory,
     SrpmComponentFactory,
 )
@@ -127,6 +149,434 @@ def test_component_manifest_backslash():
         assert False
 
 
+def test_product_manifest_golden_file(monkeypatch):
+    """Test that product manifests are byte-identical to the ones rendered by the old template"""
+    stream = setup_golden_manifest_stream()
+    # The golden file was generated at this time
+    monkeypatch.setattr(
+        timezone, "now", lambda: datetime(2023, 5, 1, 12, 34, 56, tzinfo=dt_timezone.utc)
+    )
+    with open("tests/data/manifests/product_manifest.json", "r") as golden_file:
+        golden_manifest = golden_file.read()
+
+    assert ProductManifestFile(stream).render_content() == golden_manifest
+
+    # Writing the manifest out as it's generated gives the same content
+    manifest_file = io.StringIO()
+    ProductManifestFile(stream).write(manifest_file)
+    assert manifest_file.getvalue() == golden_manifest
+
+
+def test_product_manifest_without_saved_latest_components(client, api_path, monkeypatch):
+    """Test that a stream's components are still listed and manifested
+    before the latest components for the stream have been saved"""
+    stream = setup_golden_manifest_stream()
+    monkeypatch.setattr(
+        timezone, "now", lambda: datetime(2023, 5, 1, 12, 34, 56, tzinfo=dt_timezone.utc)
+    )
+    with open("tests/data/manifests/product_manifest.json", "r") as golden_file:
+        golden_manifest = golden_file.read()
+    response = client.get(f"{api_path}/components?ofuri={stream.ofuri}")
+    assert response.status_code == 200
+    latest_purls = {component["purl"] for component in response.json()["results"]}
+    assert latest_purls
+
+    LatestComponent.objects.all().delete()
+    assert ProductManifestFile(stream).render_content() == golden_manifest
+    response = client.get(f"{api_path}/components?ofuri={stream.ofuri}")
+    assert response.status_code == 200
+    assert {component["purl"] for component in response.json()["results"]} == latest_purls
+
+
+def test_manifest_validation_modes(monkeypatch, settings):
+    """Test that the SPDX schema is loaded once, and manifests are validated based on the mode"""
+    monkeypatch.setattr(ManifestFile, "_validators", {})
+    validator = ManifestFile.get_validator()
+
+    def load_schema_again():
+        assert False, "The SPDX schema was loaded more than once"
+
+    monkeypatch.setattr(ManifestFile, "_load_schema", load_schema_again)
+    assert ProductManifestFile.get_validator() is validator
+    assert ComponentManifestFile.get_validator("packages") is ManifestFile.get_validator("packages")
+
+    invalid_manifest = json.dumps({"name": "missing required fields"})
+    assert settings.SPDX_VALIDATION_MODE == "always"
+    with pytest.raises(ValidationError):
+        ManifestFile._validate_and_clean(invalid_manifest)
+
+    settings.SPDX_VALIDATION_MODE = "off"
+    assert json.loads(ManifestFile._validate_and_clean(invalid_manifest)) == json.loads(
+        invalid_manifest
+    )
+
+    settings.SPDX_VALIDATION_MODE = "sampled"
+    settings.SPDX_VALIDATION_SAMPLE_RATE = 0.0
+    ManifestFile._validate_and_clean(invalid_manifest)
+    settings.SPDX_VALIDATION_SAMPLE_RATE = 1.0
+    with pytest.raises(ValidationError):
+        ManifestFile._validate_and_clean(invalid_manifest)
+
+
+def test_product_manifest_validates_each_item(monkeypatch):
+    """Test that each package in a product manifest is validated as it's generated"""
+    stream = setup_golden_manifest_stream()
+    get_component_package = ProductManifestFile.get_component_package
+
+    def invalid_package(component, upstream=False):
+        package = get_component_package(component, upstream=upstream)
+        package["filesAnalyzed"] = "no"
+        return package
+
+    monkeypatch.setattr(ProductManifestFile, "get_component_package", staticmethod(invalid_package))
+    with pytest.raises(ValidationError):
+        ProductManifestFile(stream).render_content()
+
+
+def test_product_manifest_fingerprint(monkeypatch):
+    """Test that product manifests have the same fingerprint until their content changes"""
+    stream = setup_golden_manifest_stream()
+    fingerprint = ProductManifestFile(stream).get_fingerprint()
+    assert len(fingerprint) == 64
+
+    # The time the manifest was created isn't included
+    monkeypatch.setattr(timezone, "now", lambda: datetime(2023, 5, 1, tzinfo=dt_timezone.utc))
+    assert ProductManifestFile(stream).get_fingerprint() == fingerprint
+
+    # But the data in each package is
+    provided = Component.objects.get(name="librados2")
+    provided.copyright_text = "Copyright (C) 2023 Red Hat, Inc."
+    provided.save()
+    new_fingerprint = ProductManifestFile(stream).get_fingerprint()
+    assert new_fingerprint != fingerprint
+
+    # And so are the nodes each component provides, which the relationships come from
+    dev_node = ComponentNode.objects.get(purl=Component.objects.get(name="left-pad").purl)
+    dev_node.type = ComponentNode.ComponentNodeType.PROVIDES
+    dev_node.save()
+    type_fingerprint = ProductManifestFile(stream).get_fingerprint()
+    assert type_fingerprint not in (fingerprint, new_fingerprint)
+
+    container = Component.objects.get(name="rhceph-container")
+    ComponentNode.objects.get(parent__object_id=container.uuid, object_id=provided.uuid).delete()
+    assert ProductManifestFile(stream).get_fingerprint() not in (
+        fingerprint,
+        new_fingerprint,
+        type_fingerprint,
+    )
+
+
+def test_update_manifest_skips_unchanged_content(monkeypatch, settings, tmp_path):
+    """Test that manifest files are only written again when their content changes"""
+    stream = setup_golden_manifest_stream()
+    settings.STATIC_ROOT = str(tmp_path)
+    manifest_path = tmp_path / f"{stream.name}-{stream.pk}.json"
+    write_manifest = ProductManifestFile.write
+    written = []
+
+    def count_writes(manifest_file, fh, cpe_mapping=True):
+        written.append(manifest_file.obj.name)
+        write_manifest(manifest_file, fh, cpe_mapping=cpe_mapping)
+
+    monkeypatch.setattr(ProductManifestFile, "write", count_writes)
+
+    cpu_update_ps_manifest(stream.name)
+    assert written == [stream.name]
+    manifest = json.loads(manifest_path.read_text())
+    assert len(manifest["packages"]) == 6
+
+    cpu_update_ps_manifest(stream.name)
+    assert written == [stream.name]
+
+    component = Component.objects.get(name="rhceph-container")
+    component.license_declared_raw = "Apache-2.0"
+    component.save()
+    cpu_update_ps_manifest(stream.name)
+    assert written == [stream.name, stream.name]
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest["packages"][1]["licenseDeclared"] == "APACHE-2.0"
+
+    # The manifest is written again if it's missing, even when its content hasn't changed
+    manifest_path.unlink()
+    cpu_update_ps_manifest(stream.name)
+    assert len(written) == 3
+    assert manifest_path.exists()
+
+
+def test_product_manifest_etag(client, api_path):
+    """Test that clients can skip downloading manifests they already have"""
+    stream = setup_golden_manifest_stream()
+    response = client.get(f"{api_path}/product_streams/{stream.uuid}/manifest")
+    assert response.status_code == 200
+    assert response.streaming
+    etag = response["ETag"]
+    assert etag == f'W/"{ProductManifestFile(stream).get_fingerprint(cpe_mapping=False)}"'
+    manifest = json.loads(b"".join(response.streaming_content))
+    assert manifest["name"] == stream.name
+
+    response = client.get(
+        f"{api_path}/product_streams/{stream.uuid}/manifest", HTTP_IF_NONE_MATCH=etag
+    )
+    assert response.status_code == 304
+    assert response["ETag"] == etag
+
+    response = client.get(
+        f"{api_path}/product_streams/{stream.uuid}/manifest", HTTP_IF_NONE_MATCH='"outdated"'
+    )
+    assert response.status_code == 200
+    assert response.streaming
+
+
+def test_generate_manifests(monkeypatch, settings, tmp_path):
+    """Test that manifests are generated for the largest streams first, and that streams
+    which share components only look up the links for those components once"""
+    stream = setup_golden_manifest_stream()
+    other_stream = setup_stream_sharing_container(stream)
+    empty_stream = ProductStreamFactory()
+    settings.STATIC_ROOT = str(tmp_path)
+
+    stream_names = get_manifest_stream_names()
+    assert stream_names == [stream.name, other_stream.name]
+    assert empty_stream.name not in stream_names
+
+    get_provides_nodes = Component.get_provides_nodes_queryset
+    looked_up = []
+
+    def count_lookups(component, *args, **kwargs):
+        looked_up.append(component.name)
+        return get_provides_nodes(component, *args, **kwargs)
+
+    monkeypatch.setattr(Component, "get_provides_nodes_queryset", count_lookups)
+
+    results = generate_manifests(stream_names)
+    assert [result["stream"] for result in results] == stream_names
+    for result, product_stream in zip(results, (stream, other_stream)):
+        manifest_path = tmp_path / f"{product_stream.name}-{product_stream.pk}.json"
+        assert result["bytes"] == manifest_path.stat().st_size
+        assert result["seconds"] >= 0
+    # The container is in both streams, but its provided components are only looked up once
+    assert sorted(looked_up) == ["ceph", "rhceph-container"]
+    other_manifest = json.loads(
+        (tmp_path / f"{other_stream.name}-{other_stream.pk}.json").read_text()
+    )
+    # The container, its upstream, librados2 and the stream itself
+    assert len(other_manifest["packages"]) == 4
+
+    # Nothing is written when no content has changed
+    results = generate_manifests(stream_names)
+    assert [result["bytes"] for result in results] == [0, 0]
+
+
+def test_component_links_cache():
+    """Test that the least-recently-used links are evicted once there are too many nodes"""
+    node = ("pkg:rpm/redhat/librados2@16.2.0-117.el8cp?arch=x86_64", "SOURCE", "uuid")
+    cache = ComponentLinksCache(max_nodes=3)
+    cache.set("first", ((node, node), ()))
+    cache.set("second", ((node,), ("upstream",)))
+    assert cache.get("first") == ((node, node), ())
+    assert cache.nodes == 3
+
+    # "second" was used least recently, so it's evicted first
+    cache.set("third", ((node,), ()))
+    assert cache.get("second") is None
+    assert cache.nodes == 3
+    assert len(cache) == 2
+
+    # Links with more nodes than the limit are still kept, until the next links are added
+    cache.set("large", ((node,) * 4, ()))
+    assert len(cache) == 1
+    assert cache.get("large") == ((node,) * 4, ())
+    cache.set("first", ((node,), ()))
+    assert cache.get("large") is None
+    assert cache.nodes == 1
+
+
+def test_product_manifest_fragment_cache(monkeypatch, settings):
+    """Test that the packages and relationships for each component are cached, shared by
+    every stream with that component, and built again when the component changes"""
+    settings.MANIFEST_CACHE_ENABLED = True
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "api": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    }
+    stream = setup_golden_manifest_stream()
+    other_stream = setup_stream_sharing_container(stream)
+    monkeypatch.setattr(
+        timezone, "now", lambda: datetime(2023, 5, 1, 12, 34, 56, tzinfo=dt_timezone.utc)
+    )
+    with open("tests/data/manifests/product_manifest.json", "r") as golden_file:
+        golden_manifest = golden_file.read()
+
+    get_component_package = ProductManifestFile.get_component_package
+    packaged = []
+
+    def count_packages(component, upstream=False):
+        packaged.append(component.name)
+        return get_component_package(component, upstream=upstream)
+
+    monkeypatch.setattr(ProductManifestFile, "get_component_package", staticmethod(count_packages))
+
+    # Manifests assembled from fragments are the same as the ones generated without the cache
+    assert ProductManifestFile(stream).render_content() == golden_manifest
+    assert len(packaged) == 5
+    assert ProductManifestFile(stream).render_content() == golden_manifest
+    assert len(packaged) == 5
+
+    # The other stream's container, its upstream, and librados2 are already cached
+    other_manifest = ProductManifestFile(other_stream).render_content()
+    assert len(packaged) == 5
+    settings.MANIFEST_CACHE_ENABLED = False
+    assert ProductManifestFile(other_stream).render_content() == other_manifest
+    assert len(packaged) == 8
+    settings.MANIFEST_CACHE_ENABLED = True
+
+    # Only the fragments for changed components are built again
+    container = Component.objects.get(name="rhceph-container")
+    container.license_declared_raw = "Apache-2.0"
+    container.save()
+    Component.bump_generations((container.pk,))
+    manifest = json.loads(ProductManifestFile(stream).render_content())
+    assert packaged[8:] == ["rhceph-container"]
+    assert manifest["packages"][1]["licenseDeclared"] == "APACHE-2.0"
+
+
+def setup_golden_manifest_stream():
+    """Create the stream and components in tests/data/manifests/product_manifest.json
+    Every field that's in the manifest is fixed, including UUIDs"""
+    stream, variant = setup_product(
+        uuid="e3f2a1b0-c9d8-4e7f-a6b5-4c3d2e1f0a98",
+        name="ceph-4",
+        version="4",
+        lifecycle_url="https://access.redhat.com/support/policy/updates/ceph-storage",
+    )
+    srpm_build = SoftwareBuildFactory(
+        build_id=1, meta_attr={"released_errata_tags": ["RHBA-2023:1234"]}
+    )
+    container_build = SoftwareBuildFactory(
+        build_id=2, meta_attr={"released_errata_tags": ["RHBA-2023:1234"]}
+    )
+    srpm = SrpmComponentFactory(
+        uuid="2c7d5bde-6a43-4d5e-9f3b-6f0c1a8d4e21",
+        name="ceph",
+        version="14.2.22",
+        release="110.el8cp",
+        copyright_text='Copyright (C) 2004-2019 Sage Weil <sage@newdream.net> & "contributors"',
+        license_declared_raw="LGPLv2.1 and CC-BY-SA-3.0 and GPLv2 and BSL-1.0",
+        license_concluded_raw="LGPL-2.1-only AND MIT",
+        software_build=srpm_build,
+    )
+    container = ContainerImageComponentFactory(
+        uuid="6e1f0a3b-8c2d-4b7e-a5f9-3d2c1b0a9e87",
+        name="rhceph-container",
+        version="4-80",
+        release="",
+        meta_attr={"repository_url": "registry.redhat.io/rhceph/rhceph-4-rhel8"},
+        copyright_text="© 2023 Red Hat, Inc.",
+        filename="rhceph-container-4-80.tar",
+        license_declared_raw="",
+        license_concluded_raw="",
+        software_build=container_build,
+    )
+    upstream = ComponentFactory(
+        uuid="8f3a2c1d-0b9e-4d7f-8a6b-5c4d3e2f1a09",
+        type=Component.Type.GENERIC,
+        namespace=Component.Namespace.UPSTREAM,
+        name="github.com/ceph/ceph-container",
+        version="4.3",
+        release="",
+        arch="noarch",
+        license_declared_raw="",
+        license_concluded_raw="",
+    )
+    provided = ComponentFactory(
+        uuid="a4b3c2d1-e5f6-4a7b-9c8d-0e1f2a3b4c5d",
+        type=Component.Type.RPM,
+        namespace=Component.Namespace.REDHAT,
+        name="librados2",
+        epoch=2,
+        version="14.2.22",
+        release="110.el8cp",
+        arch="x86_64",
+        license_declared_raw="LGPLv2.1",
+        license_concluded_raw="",
+    )
+    dev_provided = ComponentFactory(
+        uuid="c9d8e7f6-a5b4-4c3d-8e2f-1a0b9c8d7e6f",
+        type=Component.Type.NPM,
+        namespace=Component.Namespace.UPSTREAM,
+        name="left-pad",
+        version="1.3.0",
+        release="",
+        arch="noarch",
+        license_declared_raw="",
+        license_concluded_raw="",
+    )
+
+    srpm_node = ComponentNode.objects.create(
+        type=ComponentNode.ComponentNodeType.SOURCE, parent=None, purl=srpm.purl, obj=srpm
+    )
+    container_node = ComponentNode.objects.create(
+        type=ComponentNode.ComponentNodeType.SOURCE,
+        parent=None,
+        purl=container.purl,
+        obj=container,
+    )
+    for parent, child, node_type in (
+        (srpm_node, provided, ComponentNode.ComponentNodeType.PROVIDES),
+        (srpm_node, dev_provided, ComponentNode.ComponentNodeType.PROVIDES_DEV),
+        (container_node, upstream, ComponentNode.ComponentNodeType.SOURCE),
+        (container_node, provided, ComponentNode.ComponentNodeType.PROVIDES),
+    ):
+        ComponentNode.objects.create(type=node_type, parent=parent, purl=child.purl, obj=child)
+    # Link the components to each other
+    srpm.save_component_taxonomy()
+    container.save_component_taxonomy()
+
+    for build in (srpm_build, container_build):
+        ProductComponentRelationFactory(
+            software_build=build,
+            build_id=build.build_id,
+            build_type=build.build_type,
+            product_ref=variant.name,
+            type=ProductComponentRelation.Type.ERRATA,
+        )
+        # Link the components to the ProductModel instances
+        build.save_product_taxonomy()
+    return stream
+
+
+def setup_stream_sharing_container(stream):
+    """Create another stream in the same product version as the golden manifest stream,
+    which only has the rhceph-container build"""
+    product_version = stream.productversions
+    other_stream = ProductStreamFactory(
+        name="ceph-4-containers",
+        products=stream.products,
+        productversions=product_version,
+    )
+    variant = ProductVariantFactory(
+        name="2",
+        products=stream.products,
+        productversions=product_version,
+        productstreams=other_stream,
+    )
+    version_node = product_version.pnodes.get()
+    stream_node = ProductNode.objects.create(parent=version_node, obj=other_stream)
+    ProductNode.objects.create(parent=stream_node, obj=variant)
+    other_stream.save_product_taxonomy()
+
+    container_build = Component.objects.get(name="rhceph-container").software_build
+    ProductComponentRelationFactory(
+        software_build=container_build,
+        build_id=container_build.build_id,
+        build_type=container_build.build_type,
+        product_ref=variant.name,
+        type=ProductComponentRelation.Type.ERRATA,
+    )
+    container_build.save_product_taxonomy()
+    return other_stream
+
+
 def test_slim_rpm_in_containers_manifest():
     containers, stream, rpm_in_container = setup_products_and_rpm_in_containers()
 
@@ -1,12 +1,17 @@
+from importlib import import_module
+
 import pytest
 from django.apps import apps
+from django.db import connection
 from django.db.utils import IntegrityError, ProgrammingError
+from django.test.utils import CaptureQueriesContext
 from packageurl import PackageURL
 
 from corgi.core.constants import CONTAINER_DIGEST_FORMATS
 from corgi.core.models import (
     Component,
     ComponentNode,
+    LatestComponent,
     Product,
     ProductComponentRelation,
     ProductNode,
@@ -14,6 +19,7 @@ from corgi.core.models import (
     ProductVersion,
     SoftwareBuild,
 )
+from corgi.core.taxonomy import save_component_taxonomy_for_tree
 
 from .factories import (
     ComponentFactory,
@@ -202,6 +208,110 @@ def test_component_provides():
     assert upstream.provides.filter(purl=dev_comp.purl).exists()
 
 
+def test_component_node_denormalized_fields():
+    """Test that nodes link directly to their component, and copy its type / namespace / arch"""
+    srpm = SrpmComponentFactory(name="srpm")
+    srpm_node, _ = ComponentNode.objects.get_or_create(
+        type=ComponentNode.ComponentNodeType.SOURCE,
+        parent=None,
+        purl=srpm.purl,
+        defaults={"obj": srpm},
+    )
+    rpm = ComponentFactory(name="rpm", type=Component.Type.RPM, arch="x86_64")
+    rpm_node, _ = ComponentNode.objects.get_or_create(
+        type=ComponentNode.ComponentNodeType.PROVIDES,
+        parent=srpm_node,
+        purl=rpm.purl,
+        defaults={"obj": rpm},
+    )
+    rpm_node = ComponentNode.objects.get(pk=rpm_node.pk)
+    assert rpm_node.component_id == rpm.uuid
+    assert rpm_node.component_type == Component.Type.RPM
+    assert rpm_node.namespace == rpm.namespace
+    assert rpm_node.arch == "x86_64"
+    assert srpm_node.arch == "src"
+
+    # Tree walks can filter on the node's own columns, or join to the component
+    assert list(srpm_node.get_descendants().filter(component_type=Component.Type.RPM)) == [rpm_node]
+    assert ComponentNode.objects.get(component__name="rpm") == rpm_node
+    assert Component.objects.get(cnodes__parent=srpm_node) == rpm
+
+    # Deleting a component still deletes its nodes
+    rpm.delete()
+    assert not ComponentNode.objects.filter(pk=rpm_node.pk).exists()
+
+
+def test_save_component_taxonomy_for_tree():
+    """Test that saving the taxonomy for a whole tree at once gives the same results
+    as calling save_component_taxonomy() on each component in the tree"""
+
+    def add_node(node_type, parent, component):
+        return ComponentNode.objects.create(
+            type=node_type, parent=parent, purl=component.purl, obj=component
+        )
+
+    # An SRPM with an upstream, which provides an RPM
+    srpm = SrpmComponentFactory(name="srpm")
+    srpm_node = add_node(ComponentNode.ComponentNodeType.SOURCE, None, srpm)
+    srpm_upstream = ComponentFactory(
+        name="srpm", type=Component.Type.RPM, namespace=Component.Namespace.UPSTREAM, arch="noarch"
+    )
+    add_node(ComponentNode.ComponentNodeType.SOURCE, srpm_node, srpm_upstream)
+    rpm = ComponentFactory(name="rpm", type=Component.Type.RPM, software_build=srpm.software_build)
+    add_node(ComponentNode.ComponentNodeType.PROVIDES, srpm_node, rpm)
+
+    # An index container with two upstream Go modules, each with their own dependencies
+    # and an arch-specific container, which includes the same RPM
+    container = ContainerImageComponentFactory(name="container")
+    container_node = add_node(ComponentNode.ComponentNodeType.SOURCE, None, container)
+    for name in ("module-one", "module-two"):
+        module = ComponentFactory(
+            name=name,
+            type=Component.Type.GOLANG,
+            namespace=Component.Namespace.UPSTREAM,
+            software_build=None,
+        )
+        module_node = add_node(ComponentNode.ComponentNodeType.SOURCE, container_node, module)
+        dependency = ComponentFactory(
+            name=f"{name}-dependency", type=Component.Type.GOLANG, software_build=None
+        )
+        add_node(ComponentNode.ComponentNodeType.PROVIDES_DEV, module_node, dependency)
+    arch_container = ContainerImageComponentFactory(
+        name="container", arch="x86_64", software_build=None
+    )
+    arch_container_node = add_node(
+        ComponentNode.ComponentNodeType.PROVIDES, container_node, arch_container
+    )
+    add_node(ComponentNode.ComponentNodeType.PROVIDES, arch_container_node, rpm)
+
+    # Stale links should be removed
+    unrelated = ComponentFactory(name="unrelated", type=Component.Type.NPM, software_build=None)
+    rpm.sources.add(unrelated)
+    container.upstreams.add(unrelated)
+
+    save_component_taxonomy_for_tree(container_node.tree_id)
+
+    tree_components = Component.objects.filter(cnodes__tree_id=container_node.tree_id).distinct()
+    assert tree_components.count() == 7
+    for component in tree_components:
+        assert set(component.provides.values_list("pk", flat=True)) == component.get_provides_nodes(
+            using="default"
+        )
+        assert set(component.sources.values_list("pk", flat=True)) == component.get_sources_nodes(
+            using="default"
+        )
+        assert set(component.upstreams.values_list("pk", flat=True)) == {
+            node.object_id for node in component.get_upstreams_nodes(using="default")
+        }
+
+    # The RPM's sources come from both trees
+    assert set(rpm.sources.get_queryset()) == {srpm, container, arch_container}
+    # But its upstreams only come from the SRPM, not the container
+    assert set(rpm.upstreams.get_queryset()) == {srpm_upstream}
+    assert not unrelated.downstreams.exists()
+    assert not unrelated.provides.exists()
+
+
 @pytest.mark.parametrize("build_type", SoftwareBuild.Type.values)
 def test_software_build_model(build_type):
     sb1 = SoftwareBuildFactory(
@@ -317,6 +427,54 @@ def test_product_component_relations_errata():
     assert rhel_8_2 in c.productstreams.get_queryset()
 
 
+def test_save_product_taxonomy_query_count():
+    """Test that saving a build's product taxonomy uses the same number of queries,
+    no matter how many components are in the build's tree"""
+    rhel, rhel_7, rhel_7_1, *_ = create_product_hierarchy()
+    query_counts = []
+    for build_id, component_count in ((1, 2), (2, 50)):
+        sb = SoftwareBuildFactory(build_id=build_id)
+        ProductComponentRelation.objects.create(
+            type=ProductComponentRelation.Type.COMPOSE,
+            product_ref=rhel_7_1.name,
+            software_build=sb,
+            build_id=build_id,
+            build_type=sb.build_type,
+        )
+        srpm = SrpmComponentFactory(software_build=sb)
+        root = ComponentNode.objects.create(
+            type=ComponentNode.ComponentNodeType.SOURCE, parent=None, purl=srpm.purl, obj=srpm
+        )
+        # Components provided by the SRPM aren't linked to its build
+        # so they can only be found by walking the tree
+        children = []
+        for i in range(component_count):
+            child = ComponentFactory(
+                name=f"{build_id}-child-{i}", type=Component.Type.RPM, software_build=None
+            )
+            ComponentNode.objects.create(
+                type=ComponentNode.ComponentNodeType.PROVIDES,
+                parent=root,
+                purl=child.purl,
+                obj=child,
+            )
+            children.append(child)
+
+        with CaptureQueriesContext(connection) as queries:
+            sb.save_product_taxonomy()
+        query_counts.append(len(queries))
+
+        for component in (srpm, *children):
+            assert rhel in component.products.get_queryset()
+            assert rhel_7 in component.productversions.get_queryset()
+            assert rhel_7_1 in component.productstreams.get_queryset()
+
+    assert query_counts[0] == query_counts[1]
+    # Saving the same taxonomy twice doesn't fail or create duplicate links
+    sb.save_product_taxonomy()
+    assert rhel_7_1.components.count() == (1 + 2) + (1 + 50)
+
+
 @pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
 def test_product_stream_builds():
     rhel_8_2_build = SoftwareBuildFactory()
@@ -934,6 +1092,104 @@ def test_latest_filter_components_modular():
     assert latest_components[0] == modular_rpm_2
 
 
+@pytest.mark.django_db
+def test_latest_component_index():
+    """Test the latest root components are saved for each product model, and kept up to date"""
+    stream = ProductStreamFactory(name="rhel-8.6.0", version="8.6.0")
+    other_stream = ProductStreamFactory(name="rhel-8.5.0", version="8.5.0")
+    released = SrpmComponentFactory(
+        name="openssl",
+        version="1.1.1k",
+        release="5.el8_5",
+        software_build=SoftwareBuildFactory(meta_attr={"released_errata_tags": ["RHBA-2023:1234"]}),
+    )
+    unreleased = SrpmComponentFactory(
+        name="openssl",
+        version="1.1.1k",
+        release="6.el8_5",
+        software_build=SoftwareBuildFactory(meta_attr={"released_errata_tags": []}),
+    )
+    binary_rpm = ComponentFactory(
+        type=Component.Type.RPM,
+        namespace=Component.Namespace.REDHAT,
+        name="openssl",
+        version="1.1.1k",
+        release="6.el8_5",
+        arch="x86_64",
+    )
+    for component in released, unreleased, binary_rpm:
+        component.productstreams.add(stream)
+    other_stream.components.add(released)
+    # Linking components one at a time doesn't refresh anything, callers refresh once afterwards
+    assert not LatestComponent.objects.exists()
+    LatestComponent.refresh_for_components([released.pk, unreleased.pk, binary_rpm.pk])
+
+    assert list(Component.objects.latest_components_for(stream)) == [unreleased]
+    assert list(Component.objects.latest_components_for(stream, released=True)) == [released]
+    assert list(Component.objects.latest_components_for(other_stream)) == [released]
+    # Binary RPMs aren't root components, so they're never saved as the latest
+    assert not binary_rpm.latest.exists()
+
+    # Removing the newer build from the stream makes the older build the latest again
+    stream.components.remove(unreleased)
+    LatestComponent.refresh_for_components([unreleased.pk])
+    assert list(Component.objects.latest_components_for(stream)) == [released]
+
+    # Saving taxonomies in bulk doesn't refresh either, so refresh the latest components afterwards
+    newer = SrpmComponentFactory(name="openssl", version="1.1.1k", release="7.el8_6")
+    Component.bulk_save_product_taxonomy(
+        [newer.pk],
+        {
+            "products": {stream.products.pk},
+            "productversions": set(),
+            "productstreams": {stream.pk},
+            "productvariants": set(),
+            "channels": set(),
+        },
+    )
+    assert list(Component.objects.latest_components_for(stream)) == [released]
+    LatestComponent.refresh_for_components([newer.pk])
+    assert list(Component.objects.latest_components_for(stream)) == [newer]
+    assert list(Component.objects.latest_components_for(stream.products)) == [newer]
+    assert list(Component.objects.latest_components_for(other_stream)) == [released]
+
+    # When the latest component is deleted, refreshing its group finds the next latest
+    newer.delete()
+    LatestComponent.refresh((("REDHAT", "openssl", "src"),))
+    assert list(Component.objects.latest_components_for(stream)) == [released]
+    assert LatestComponent.objects.count() == 4
+
+
+@pytest.mark.django_db
+def test_latest_component_backfill():
+    """Test that the migration which fills the LatestComponent table saves the same rows"""
+    stream = ProductStreamFactory()
+    released = SrpmComponentFactory(
+        name="openssl",
+        version="1.1.1k",
+        release="5.el8_5",
+        software_build=SoftwareBuildFactory(meta_attr={"released_errata_tags": ["RHBA-2023:1234"]}),
+    )
+    unreleased = SrpmComponentFactory(name="openssl", version="1.1.1k", release="6.el8_5")
+    curl = SrpmComponentFactory(
+        name="curl",
+        software_build=SoftwareBuildFactory(meta_attr={"released_errata_tags": ["RHBA-2023:5678"]}),
+    )
+    for component in released, unreleased, curl:
+        component.productstreams.add(stream)
+    LatestComponent.refresh_for_components([released.pk, unreleased.pk, curl.pk])
+    fields = ("product_model_type", "product_model_uuid", "name", "released", "component_id")
+    expected = set(LatestComponent.objects.values_list(*fields))
+    # The latest and latest released openssl, and curl which is both
+    assert len(expected) == 4
+
+    LatestComponent.objects.all().delete()
+    migration = import_module("corgi.core.migrations.0079_latestcomponent_data")
+    with connection.schema_editor() as schema_editor:
+        migration.backfill_latest_components(apps, schema_editor)
+    assert set(LatestComponent.objects.values_list(*fields)) == expected
+
+
 def test_el_match():
     """Test that el_match field is set correctly based on target RHEL version"""
     c = ComponentFactory(
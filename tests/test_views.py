@@ -1,12 +1,15 @@
 import logging
 
 import pytest
+from django.db import connection
 from rest_framework.request import Request
 from rest_framework.test import APIRequestFactory
 from rest_framework.viewsets import GenericViewSet
 
 from corgi.api import views
-from tests.factories import ProductFactory
+from corgi.api.filters import ComponentFilter, ILikeSearchFilter
+from corgi.core.models import Component
+from tests.factories import ComponentFactory, ProductFactory
 
 logger = logging.getLogger(__name__)
 
@@ -79,3 +82,51 @@ def test_viewset_ordering(api_path):
             # These viewsets are ordered based on some other fields
             # and the query should contain some SQL to sort the objects
             assert "Sort " in viewset.get_queryset().explain()
+
+
+@pytest.mark.django_db
+def test_component_filters_use_indexes(api_path):
+    """Test that the text and regex filters for components can use the trigram / GIN indexes"""
+    for i in range(50):
+        component = ComponentFactory(
+            name=f"component-{i}",
+            description=f"Description of component {i}",
+            release=f"{i}.el8_6",
+            meta_attr={"source": [f"component-{i}.tar.gz"]},
+        )
+        component.sources.add(ComponentFactory(name=f"provided-{i}", software_build=None))
+
+    queryset = Component.objects.all()
+    assert list(ComponentFilter({"el_match": "8"}, queryset=queryset).qs)
+    assert list(ComponentFilter({"el_match": "8.6"}, queryset=queryset).qs)
+    # Commas separate the parts too, like in queries from before el_match was a prefix match
+    assert list(ComponentFilter({"el_match": "8,6"}, queryset=queryset).qs)
+    assert not ComponentFilter({"el_match": "6"}, queryset=queryset).qs.exists()
+    assert ComponentFilter({"description": "OF COMPONENT 7"}, queryset=queryset).qs.count() == 1
+
+    # The tables are too small for the planner to prefer an index over a sequential scan
+    # so forbid sequential scans, to check that an index can be used at all
+    # Plain index scans are forbidden too, since scanning the whole primary key index
+    # and filtering each row looks just as cheap. Bitmap scans need a matching index condition
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("SET LOCAL enable_indexscan = off")
+
+    filter_indexes = {
+        "re_name": ("component-1", "compon_name_trgm_idx"),
+        "re_purl": ("component-1", "compon_purl_trgm_idx"),
+        "re_provides": ("component-1", "compon_purl_trgm_idx"),
+        "re_sources": ("provided-1", "compon_purl_trgm_idx"),
+        "re_upstreams": ("component-1", "compon_purl_trgm_idx"),
+        "description": ("component 1", "compon_description_trgm_idx"),
+        "related_url": ("example.com", "compon_related_url_trgm_idx"),
+        "el_match": ("8.6", "compon_el_match_idx"),
+    }
+    for name, (value, index) in filter_indexes.items():
+        plan = ComponentFilter({name: value}, queryset=queryset).qs.explain()
+        assert index in plan, f"{name} didn't use {index}:\n{plan}"
+
+    request = Request(APIRequestFactory().get(f"{api_path}/components?search=component-1"))
+    plan = ILikeSearchFilter().filter_queryset(request, queryset, views.ComponentViewSet).explain()
+    for field in ("name", "description", "version", "release", "meta_attr"):
+        assert f"compon_{field}_trgm_idx" in plan, f"search didn't use the {field} index:\n{plan}"